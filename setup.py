@@ -32,6 +32,7 @@ setup(
         "tqdm",
         "pyvmomi",
         "hurry.filesize",
+        "PyYAML",
     ],
     entry_points="""
         [console_scripts]
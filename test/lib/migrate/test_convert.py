@@ -0,0 +1,127 @@
+""" Tests for offline guest conversion plans """
+import pytest
+
+import voithos.lib.migrate.convert as convert
+
+
+PLAN = {
+    "os": "rhel",
+    "devices": ["/dev/vdb", "/dev/vdc"],
+    "steps": [
+        {"repair-partitions": {"workers": 2}},
+        "add-virtio-drivers",
+        {"uninstall": "vmware-tools"},
+        {"uninstall": "cloud-init"},
+        {"set-interface": {"name": "eth0", "mac": "fa:16:3e:00:00:01"}},
+    ],
+}
+
+
+class FakeWorker:
+    """ Records what a conversion asks of the worker """
+
+    instances = []
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.calls = []
+        self.was_root_mounted = False
+        FakeWorker.instances.append(self)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+
+def test_run_plan_mounts_once(monkeypatch):
+    """ One worker repairs first, then runs every other step in one mount session """
+    FakeWorker.instances = []
+    monkeypatch.setattr(convert, "WORKERS", {"rhel": FakeWorker})
+    convert.run_plan(PLAN)
+    (worker,) = FakeWorker.instances
+    assert worker.devices == PLAN["devices"]
+    assert [call[0] for call in worker.calls] == [
+        "repair_partitions",
+        "mount_volumes",
+        "add_virtio_drivers",
+        "uninstall",
+        "uninstall",
+        "set_udev_interface_mapping",
+        "set_interface",
+        "unmount_volumes",
+    ]
+    assert worker.calls[0][2] == {"workers": 2}
+    assert worker.calls[3][1] == ("vm-tools",)
+    assert worker.calls[6][2]["is_dhcp"] is True
+
+
+def test_run_plan_unmounts_after_failure(monkeypatch):
+    """ A failed step still unmounts the volumes """
+    FakeWorker.instances = []
+    monkeypatch.setattr(convert, "WORKERS", {"rhel": FakeWorker})
+
+    def fail(worker, name, options):
+        raise SystemExit(1)
+
+    monkeypatch.setattr(convert, "run_step", fail)
+    with pytest.raises(SystemExit):
+        convert.run_plan({"os": "rhel", "devices": ["/dev/vdb"], "steps": ["add-virtio-drivers"]})
+    assert [call[0] for call in FakeWorker.instances[0].calls] == [
+        "mount_volumes",
+        "unmount_volumes",
+    ]
+
+
+def test_run_plan_unmounts_after_failed_mount(monkeypatch):
+    """ Volumes mounted before a mount failed are unmounted too """
+
+    class FailingMountWorker(FakeWorker):
+        """ Fails part way through mounting """
+
+        def mount_volumes(self, print_progress=False):
+            self.calls.append(("mount_volumes", (), {}))
+            raise SystemExit(1)
+
+    FakeWorker.instances = []
+    monkeypatch.setattr(convert, "WORKERS", {"rhel": FailingMountWorker})
+    with pytest.raises(SystemExit):
+        convert.run_plan({"os": "rhel", "devices": ["/dev/vdb"], "steps": ["add-virtio-drivers"]})
+    assert [call[0] for call in FakeWorker.instances[0].calls] == [
+        "mount_volumes",
+        "unmount_volumes",
+    ]
+
+
+@pytest.mark.parametrize(
+    "plan",
+    [
+        {"os": "windows", "devices": ["/dev/vdb"], "steps": []},
+        {"os": "rhel", "devices": [], "steps": []},
+        {"os": "rhel", "devices": ["/dev/vdb"], "steps": ["reboot"]},
+        {"os": "ubuntu", "devices": ["/dev/vdb"], "steps": ["add-virtio-drivers"]},
+        {"os": "rhel", "devices": ["/dev/vdb"], "steps": ["uninstall"]},
+        {
+            "os": "rhel",
+            "devices": ["/dev/vdb"],
+            "steps": ["add-virtio-drivers", "repair-partitions"],
+        },
+        {
+            "os": "rhel",
+            "devices": ["/dev/vdb"],
+            "steps": [{"set-interface": {"name": "eth0", "mac": "m", "ip_addr": "10.0.0.5"}}],
+        },
+    ],
+)
+def test_validate_plan_rejects(plan):
+    """ Invalid plans fail before anything runs """
+    with pytest.raises(SystemExit):
+        convert.validate_plan(plan)
+
+
+def test_load_plan(tmp_path):
+    """ Plans can be YAML or JSON """
+    yaml_path = tmp_path / "plan.yaml"
+    yaml_path.write_text("os: ubuntu\ndevices: [/dev/vdb]\nsteps:\n  - uninstall: cloud-init\n")
+    json_path = tmp_path / "plan.json"
+    json_path.write_text('{"os": "ubuntu", "devices": ["/dev/vdb"], "steps": []}')
+    assert convert.load_plan(str(yaml_path))["steps"] == [{"uninstall": "cloud-init"}]
+    assert convert.load_plan(str(json_path))["os"] == "ubuntu"
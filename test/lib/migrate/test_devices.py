@@ -0,0 +1,143 @@
+""" Tests for the block device discovery of migrated guests """
+import json
+
+import voithos.lib.migrate.devices as devices
+
+
+LSBLK = {
+    "blockdevices": [
+        {
+            "name": "/dev/vdb",
+            "type": "disk",
+            "fstype": None,
+            "uuid": None,
+            "pttype": "dos",
+            "pkname": None,
+            "size": 21474836480,
+            "children": [
+                {
+                    "name": "/dev/vdb1",
+                    "type": "part",
+                    "fstype": "ext4",
+                    "uuid": "boot-uuid",
+                    "pkname": "/dev/vdb",
+                    "size": 524288000,
+                },
+                {
+                    "name": "/dev/vdb2",
+                    "type": "part",
+                    "fstype": "LVM2_member",
+                    "uuid": "pv-uuid",
+                    "pkname": "/dev/vdb",
+                    "size": 20949499904,
+                    "children": [
+                        {
+                            "name": "/dev/mapper/vg_root-lv_root",
+                            "type": "lvm",
+                            "fstype": "xfs",
+                            "uuid": "root-uuid",
+                            "pkname": "/dev/vdb2",
+                            "size": 10737418240,
+                        }
+                    ],
+                },
+            ],
+        },
+        {
+            "name": "/dev/vdc",
+            "type": "disk",
+            "pttype": "gpt",
+            "size": 10737418240,
+            "children": [
+                {
+                    "name": "/dev/vdc1",
+                    "type": "part",
+                    "fstype": "LVM2_member",
+                    "pkname": "/dev/vdc",
+                    "size": 10736369664,
+                    "children": [
+                        {
+                            "name": "/dev/mapper/vg_root-lv_root",
+                            "type": "lvm",
+                            "fstype": "xfs",
+                            "uuid": "root-uuid",
+                            "pkname": "/dev/vdb2",
+                            "size": 10737418240,
+                        }
+                    ],
+                }
+            ],
+        },
+    ]
+}
+LVS = {
+    "report": [
+        {
+            "lv": [
+                {
+                    "lv_name": "lv_root",
+                    "vg_name": "vg_root",
+                    "lv_path": "/dev/vg_root/lv_root",
+                    "lv_dm_path": "/dev/mapper/vg_root-lv_root",
+                    "devices": "/dev/vdb2(0),/dev/vdc1(0)",
+                }
+            ]
+        }
+    ]
+}
+
+
+def test_device_graph(monkeypatch):
+    """ One lsblk and one lvs call describe every partition, PV and LV """
+    commands = []
+
+    def fake_run(cmd):
+        commands.append(cmd.split(" ")[0])
+        return json.dumps(LSBLK if cmd.startswith("lsblk") else LVS).split("\n")
+
+    monkeypatch.setattr(devices, "run", fake_run)
+    graph = devices.DeviceGraph(["/dev/vdb", "/dev/vdc"])
+    assert commands == ["lsblk", "lvs"]
+    assert graph.partitions == ["/dev/vdb1", "/dev/vdb2", "/dev/vdc1"]
+    assert graph.pvs == ["/dev/vdb2", "/dev/vdc1"]
+    (root,) = graph.lvs
+    assert root.path == "/dev/mapper/vg_root-lv_root"
+    assert root.lv_path == "/dev/vg_root/lv_root"
+    assert root.pvs == ["/dev/vdb2", "/dev/vdc1"]
+    assert graph.get("/dev/vdb1").uuid == "boot-uuid"
+    assert graph.get_disk("/dev/vdb1").pttype == "dos"
+    assert graph.get_disk("/dev/vdc1").pttype == "gpt"
+
+
+def test_device_graph_without_lvm(monkeypatch):
+    """ lvs isn't run when no partition is an LVM PV """
+    commands = []
+    lsblk = {"blockdevices": [dict(LSBLK["blockdevices"][0], children=[])]}
+
+    def fake_run(cmd):
+        commands.append(cmd)
+        return [json.dumps(lsblk)]
+
+    monkeypatch.setattr(devices, "run", fake_run)
+    graph = devices.DeviceGraph(["/dev/vdb"])
+    assert len(commands) == 1
+    assert not graph.partitions
+    assert not graph.lvs
+
+
+def test_has_file(monkeypatch):
+    """ debugfs and xfs_db output gives a yes, a no or can't tell """
+    outputs = {
+        "/dev/ext-root": (0, "Inode: 12   Type: regular    Mode:  0644\n"),
+        "/dev/ext-data": (0, "/etc/fstab: File not found by ext2_lookup\n"),
+        "/dev/xfs-root": (0, "/etc:\n12   16777344   regular   0x4a6b3c8b   5 fstab (good)\n"),
+        "/dev/xfs-data": (0, "/etc: No such file or directory\n"),
+        "/dev/xfs-old": (0, "command ls not found\n"),
+    }
+    monkeypatch.setattr(devices, "_run_probe", lambda cmd: outputs[cmd[-1]])
+    assert devices.has_file("/dev/ext-root", "ext4", "/etc/fstab") is True
+    assert devices.has_file("/dev/ext-data", "ext4", "/etc/fstab") is False
+    assert devices.has_file("/dev/xfs-root", "xfs", "/etc/fstab") is True
+    assert devices.has_file("/dev/xfs-data", "xfs", "/etc/fstab") is False
+    assert devices.has_file("/dev/xfs-old", "xfs", "/etc/fstab") is None
+    assert devices.has_file("/dev/btrfs", "btrfs", "/etc/fstab") is None
@@ -0,0 +1,198 @@
+""" Tests for the Linux migration worker """
+import json
+from threading import Lock
+
+import pytest
+
+import voithos.lib.migrate.convert as convert
+import voithos.lib.migrate.devices as devices
+import voithos.lib.migrate.linux_worker as linux_worker
+
+
+def _part(name, disk, fstype, children=None):
+    """ Return the lsblk JSON of a partition """
+    return {
+        "name": name,
+        "type": "part",
+        "fstype": fstype,
+        "pkname": disk,
+        "size": 1024,
+        **({"children": children} if children else {}),
+    }
+
+
+def _lv(name, pv):
+    """ Return the lsblk JSON of an LV """
+    return {"name": name, "type": "lvm", "fstype": "xfs", "pkname": pv, "size": 1024}
+
+
+LSBLK = {
+    "blockdevices": [
+        {
+            "name": "/dev/vdb",
+            "type": "disk",
+            "pttype": "dos",
+            "size": 4096,
+            "children": [
+                _part("/dev/vdb1", "/dev/vdb", "ext4"),
+                _part(
+                    "/dev/vdb2",
+                    "/dev/vdb",
+                    "LVM2_member",
+                    [_lv("/dev/mapper/vg-root", "/dev/vdb2")],
+                ),
+            ],
+        },
+        {
+            "name": "/dev/vdc",
+            "type": "disk",
+            "pttype": "dos",
+            "size": 4096,
+            "children": [
+                _part(
+                    "/dev/vdc1",
+                    "/dev/vdc",
+                    "LVM2_member",
+                    [_lv("/dev/mapper/vg-root", "/dev/vdb2")],
+                ),
+            ],
+        },
+        {
+            "name": "/dev/vdd",
+            "type": "disk",
+            "pttype": "gpt",
+            "size": 4096,
+            "children": [
+                _part("/dev/vdd1", "/dev/vdd", "xfs"),
+                _part("/dev/vdd2", "/dev/vdd", "swap"),
+                _part("/dev/vdd3", "/dev/vdd", "vfat"),
+            ],
+        },
+    ]
+}
+LVS = {
+    "report": [
+        {
+            "lv": [
+                {
+                    "lv_name": "root",
+                    "vg_name": "vg",
+                    "lv_path": "/dev/vg/root",
+                    "lv_dm_path": "/dev/mapper/vg-root",
+                }
+            ]
+        }
+    ]
+}
+
+
+@pytest.fixture(name="worker")
+def fixture_worker(monkeypatch):
+    """ A worker of three disks: vdb and vdc share an LV, vdd is independent """
+    monkeypatch.setattr(
+        devices, "run", lambda cmd: [json.dumps(LSBLK if cmd.startswith("lsblk") else LVS)]
+    )
+    monkeypatch.setattr(linux_worker, "is_mounted", lambda mpoint: False)
+    return linux_worker.LinuxWorker(["/dev/vdb", "/dev/vdc", "/dev/vdd"])
+
+
+def test_device_properties(worker):
+    """ The partition, LVM and blkid properties come from the device graph """
+    assert worker.lvm_pvs == ["/dev/vdb2", "/dev/vdc1"]
+    assert worker.lvm_lvs == {
+        "/dev/mapper/vg-root": {"name": "/dev/vg/root", "devices": ["/dev/vdb2", "/dev/vdc1"]}
+    }
+    assert worker.data_volumes == ["/dev/vdb1", "/dev/vdd1", "/dev/vdd3", "/dev/mapper/vg-root"]
+
+
+def test_repair_groups(worker):
+    """ Volumes sharing a disk, directly or through an LV's PVs, are grouped together """
+    groups = worker.get_repair_groups()
+    assert sorted(group["volumes"] for group in groups) == [
+        ["/dev/vdb1", "/dev/mapper/vg-root"],
+        ["/dev/vdd1", "/dev/vdd3"],
+    ]
+
+
+def test_repair_partitions(worker, monkeypatch, capsys):
+    """ Each volume gets a report entry, failures exit after the report """
+    ran = []
+    lock = Lock()
+
+    def fake_run_capture(cmd):
+        with lock:
+            ran.append(cmd)
+        if cmd == "xfs_repair /dev/vdd1":
+            return 2, "log needs replay"
+        return (1, "fixed") if cmd.startswith("fsck") else (0, "")
+
+    monkeypatch.setattr(linux_worker, "run_capture", fake_run_capture)
+    with pytest.raises(SystemExit):
+        worker.repair_partitions(workers=2)
+    assert sorted(ran) == [
+        "fsck.ext4 -y /dev/vdb1",
+        "xfs_repair /dev/mapper/vg-root",
+        "xfs_repair /dev/vdd1",
+    ]
+    report = capsys.readouterr().out
+    assert "/dev/vdd3" in report and "skipped" in report
+    assert "repaired" in report and "log needs replay" in report
+
+
+def test_root_volume_ranked_and_probed(worker, monkeypatch):
+    """ The LV named root is probed first and found without mounting anything """
+    probed = []
+
+    def fake_has_file(device, fstype, path):
+        probed.append(device)
+        return device == "/dev/mapper/vg-root"
+
+    monkeypatch.setattr(linux_worker, "has_file", fake_has_file)
+    monkeypatch.setattr(linux_worker, "mount", lambda *args, **kwargs: pytest.fail("mounted"))
+    assert worker.root_volume == "/dev/mapper/vg-root"
+    assert probed == ["/dev/mapper/vg-root"]
+
+
+def test_root_volume_trial_mounts_unreadable(worker, monkeypatch):
+    """ Volumes that can't be read directly are trial mounted read-only, as a last resort """
+    mounted = []
+    monkeypatch.setattr(
+        linux_worker, "has_file", lambda device, fstype, path: None if fstype == "vfat" else False
+    )
+    monkeypatch.setattr(
+        linux_worker, "mount", lambda dev, mpoint, **kwargs: mounted.append((dev, kwargs))
+    )
+    monkeypatch.setattr(linux_worker, "unmount", lambda mpoint: None)
+    monkeypatch.setattr(linux_worker, "get_file_contents", lambda path: "UUID=x / xfs")
+    assert worker.root_volume == "/dev/vdd3"
+    assert mounted == [("/dev/vdd3", {"fail": False, "options": "ro"})]
+
+
+def test_failed_mount_unmounts_everything(worker, monkeypatch):
+    """ A conversion whose mounts fail part way unmounts what was mounted, innermost first """
+    mounted = []
+
+    def fake_mount(dev_path, mpoint, bind=False, **kwargs):
+        if mpoint == "/convert/root/proc":
+            raise SystemExit(1)
+        mounted.append(mpoint)
+
+    def fake_unmount(mpoint, prompt=False, fail=True):
+        if any(other.startswith(f"{mpoint}/") for other in mounted):
+            # umount fails with "target is busy", run() exits
+            raise SystemExit(1)
+        if mpoint in mounted:
+            mounted.remove(mpoint)
+
+    monkeypatch.setattr(linux_worker, "mount", fake_mount)
+    monkeypatch.setattr(linux_worker, "unmount", fake_unmount)
+    worker._root_volume = "/dev/mapper/vg-root"
+    worker._fstab = [
+        {"path": "/dev/mapper/vg-root", "mountpoint": "/", "fstype": "xfs", "options": ""},
+        {"path": "/dev/vdb1", "mountpoint": "/boot", "fstype": "ext4", "options": "defaults"},
+    ]
+    monkeypatch.setattr(convert, "WORKERS", {"rhel": lambda devices: worker})
+    with pytest.raises(SystemExit):
+        convert.run_plan({"os": "rhel", "devices": worker.devices, "steps": ["add-virtio-drivers"]})
+    assert mounted == []
+    assert not worker.was_root_mounted
@@ -0,0 +1,41 @@
+""" Tests for the shared system functions """
+from voithos.lib.system import MountTable, parse_mountinfo
+
+
+MOUNTINFO = (
+    "22 1 253:0 / / rw,relatime shared:1 - xfs /dev/mapper/rhel-root rw,attr2\n"
+    "40 22 252:17 / /convert/root rw,relatime shared:20 - ext4 /dev/vdb1 rw\n"
+    "41 40 252:17 /var /convert/root/my\\040var rw,relatime - ext4 /dev/vdb1 rw\n"
+    "42 22 252:18 / /convert/root rw,relatime shared:21 master:3 - xfs /dev/vdc1 rw\n"
+)
+
+
+def test_parse_mountinfo():
+    """ Optional fields are skipped and escaped spaces decoded """
+    mounts = parse_mountinfo(MOUNTINFO)
+    assert mounts[0] == {
+        "device": "/dev/mapper/rhel-root",
+        "mpoint": "/",
+        "fstype": "xfs",
+        "root": "/",
+    }
+    assert mounts[2]["mpoint"] == "/convert/root/my var"
+    assert mounts[2]["root"] == "/var"
+    assert mounts[3]["device"] == "/dev/vdc1"
+
+
+def test_mount_table(tmp_path):
+    """ Lookups are exact, see the top mount, and re-read only after invalidate """
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(MOUNTINFO)
+    table = MountTable(str(mountinfo))
+    assert table.get_by_mountpoint("/convert/root")["device"] == "/dev/vdc1"
+    assert table.get_by_mountpoint("/convert") is None
+    assert [mnt["mpoint"] for mnt in table.get_by_device("/dev/vdb1")] == [
+        "/convert/root",
+        "/convert/root/my var",
+    ]
+    mountinfo.write_text(MOUNTINFO.splitlines(keepends=True)[0])
+    assert table.get_by_mountpoint("/convert/root") is not None
+    table.invalidate()
+    assert table.get_by_mountpoint("/convert/root") is None
@@ -0,0 +1,62 @@
+""" Unit tests for the on-disk VMware inventory cache """
+
+from functools import partial
+from unittest.mock import MagicMock, patch
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.cache import InventoryCache
+from voithos.lib.vmware.mgr import VMWareMgr
+
+
+def test_inventory_cache_updates(tmp_path):
+    """ Full reads replace the cache, incremental ones merge changes and drop removed VMs """
+    cache = InventoryCache("vcenter", path=str(tmp_path / "inventory.sqlite"), ttl=60)
+    assert cache.get_state() is None
+    cache.update(
+        {
+            "vm-1": {"name": "web01", "config.uuid": "uuid-1", "runtime.powerState": "poweredOn"},
+            "vm-2": {"name": "db01", "config.uuid": "uuid-2", "runtime.powerState": "poweredOff"},
+        },
+        "session[1]collector-1",
+        "1",
+        replace=True,
+    )
+    changes = {"vm-1": {"runtime.powerState": "poweredOff"}, "vm-2": None}
+    cache.update(changes, "session[1]collector-1", "2")
+    assert cache.load() == {
+        "vm-1": {"name": "web01", "config.uuid": "uuid-1", "runtime.powerState": "poweredOff"}
+    }
+    age, collector, version = cache.get_state()
+    assert age < 60 and collector == "session[1]collector-1" and version == "2"
+    cache.remove(["vm-1"])
+    assert cache.load() == {} and cache.get_state()[2] == "2"
+    other = InventoryCache("other", path=str(tmp_path / "inventory.sqlite"))
+    assert other.load() == {} and other.get_state() is None
+
+
+@patch("voithos.lib.vmware.mgr.connect")
+@patch("voithos.lib.vmware.mgr.collect_updates")
+@patch("voithos.lib.vmware.mgr.create_inventory_collector")
+@patch.object(VMWareMgr, "connect")
+def test_mgr_cached_inventory(mock_connect, mock_create, mock_collect, mock_pyvim, tmp_path):
+    """ The first load reads vCenter into the cache, later loads within the TTL don't """
+    cache_path = str(tmp_path / "inventory.sqlite")
+    mock_create.return_value = MagicMock(_moId="collector-1")
+    updates = {vim.VirtualMachine("vm-1"): {"name": "web01", "config.uuid": "uuid-1"}}
+    mock_collect.return_value = ("1", updates)
+    with patch("voithos.lib.vmware.mgr.InventoryCache", partial(InventoryCache, path=cache_path)):
+        for _ in range(2):
+            mgr = VMWareMgr(username="user", password="pass", ip_addr="vcenter", cache_ttl=60)
+            mgr.conn = MagicMock()
+            vms = mgr.find_vms_by_name(["web"])
+            assert [vm._moId for vm in vms] == ["vm-1"]
+        assert mock_create.call_count == 1
+        assert mock_collect.call_count == 1
+        # Each user has their own cache, vCenter may show them different VMs
+        other = VMWareMgr(username="other", password="pass", ip_addr="vcenter", cache_ttl=60)
+        assert other.cache is None
+        other.conn = MagicMock()
+        other.find_vms_by_name(["web"])
+        assert other.cache.vcenter == "other@vcenter"
+    assert mock_collect.call_count == 2
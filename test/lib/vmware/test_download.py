@@ -0,0 +1,141 @@
+""" Unit tests for the VMware NFC download lib """
+
+import io
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+import voithos.lib.vmware.download as download
+from voithos.lib.vmware.journal import DownloadJournal
+from voithos.lib.vmware.manifest import ChunkDigests, hash_file
+
+
+def _fake_session(payload, status_code=200, headers=None):
+    """ Return a mock requests session whose GET streams payload """
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.raw = io.BytesIO(payload)
+    resp.headers = headers or {}
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    return session
+
+
+def test_stream_download(tmp_path):
+    """ stream_download writes every byte and reports exact counts to the callback """
+    payload = b"x" * (download.BUFFER_SIZE + 100)
+    file_path = tmp_path / "disk.vmdk"
+    counts = []
+    written = download.stream_download(
+        _fake_session(payload), "https://esxi/disk.vmdk", str(file_path), callback=counts.append
+    )
+    assert written == len(payload)
+    assert counts == [download.BUFFER_SIZE, 100]
+    assert file_path.read_bytes() == payload
+
+
+def test_ranged_download(tmp_path, monkeypatch):
+    """ ranged_download places each Range response at its own offset, digesting every chunk """
+    monkeypatch.setattr(download, "RANGE_CHUNK_SIZE", 10)
+    payload = bytes(range(256)) * 4
+
+    def _get(url, headers=None, **kwargs):
+        start, end = headers["Range"].replace("bytes=", "").split("-")
+        resp = MagicMock()
+        resp.status_code = 206
+        resp.raw = io.BytesIO(payload[int(start) : int(end) + 1])
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        return ctx
+
+    session = MagicMock()
+    session.get.side_effect = _get
+    file_path = tmp_path / "disk.vmdk"
+    counts = []
+    digests = ChunkDigests(chunk_size=16)
+    download.ranged_download(
+        session,
+        "https://esxi/disk.vmdk",
+        str(file_path),
+        len(payload),
+        4,
+        callback=counts.append,
+        digests=digests,
+    )
+    assert sum(counts) == len(payload)
+    assert file_path.read_bytes() == payload
+    assert digests.finish(len(payload)) == hash_file(str(file_path), chunk_size=16)
+
+
+def test_ranged_download_stops_after_failure(tmp_path, monkeypatch):
+    """ A range that fails for good cancels the rest instead of letting each retry in turn """
+    monkeypatch.setattr(download, "RANGE_CHUNK_SIZE", 10)
+    session = MagicMock()
+    session.get.side_effect = requests.ConnectionError("unreachable")
+    with pytest.raises(download.VMWareDownloadFailed, match="unreachable"):
+        download.ranged_download(
+            session, "https://esxi/disk.vmdk", str(tmp_path / "disk.vmdk"), 1000, 2, retries=1
+        )
+    # 100 ranges of 2 tries each, only the few running when the first gave up made requests
+    assert session.get.call_count <= 6
+
+
+def test_split_ranges():
+    """ split_ranges covers every byte exactly once with inclusive ranges """
+    assert download.split_ranges(25, chunk_size=10) == [(0, 9), (10, 19), (20, 24)]
+    assert download.split_ranges(0, chunk_size=10) == []
+
+
+def test_stream_download_resumes_from_journal(tmp_path):
+    """ A journaled stream resumes after its completed prefix with a Range request """
+    payload = b"abcdefghij"
+    file_path = tmp_path / "disk.vmdk"
+    file_path.write_bytes(payload[:4])
+    journal = DownloadJournal(str(file_path), "vm-uuid", "disk.vmdk", "https://esxi/disk.vmdk")
+    journal.add(0, 3)
+    session = _fake_session(payload[4:], status_code=206)
+    download.download_disk(session, "https://esxi/disk.vmdk", str(file_path), journal=journal)
+    assert session.get.call_args[1]["headers"] == {"Range": "bytes=4-"}
+    assert file_path.read_bytes() == payload
+    assert journal.complete
+
+
+def test_stream_journal_resumes_with_ranges(tmp_path, monkeypatch):
+    """ A single-stream journal keeps its completed prefix when resumed over Range requests """
+    monkeypatch.setattr(download, "RANGE_CHUNK_SIZE", 4)
+    monkeypatch.setattr(download, "CHECKPOINT_SIZE", 4)
+    payload = b"abcdefghij"
+    file_path = tmp_path / "disk.vmdk"
+    journal = DownloadJournal(str(file_path), "vm-uuid", "disk.vmdk", "https://esxi/disk.vmdk")
+    # The first attempt streamed 8 bytes before the connection dropped
+    stream = _fake_session(payload[:8], headers={"Content-Length": "10"})
+    download.stream_download(stream, "https://esxi/disk.vmdk", str(file_path), journal=journal)
+    assert journal.size == 10
+    journal = DownloadJournal(str(file_path), "vm-uuid", "disk.vmdk", "https://esxi/disk.vmdk")
+    journal.size = None  # journals from before sizes were recorded
+    requested = []
+
+    def _get(url, headers=None, **kwargs):
+        start, end = headers["Range"].replace("bytes=", "").split("-")
+        requested.append((int(start), int(end)))
+        resp = MagicMock(status_code=206, raw=io.BytesIO(payload[int(start) : int(end) + 1]))
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        return ctx
+
+    session = MagicMock()
+    session.get.side_effect = _get
+    resumed = []
+    download.ranged_download(
+        session,
+        "https://esxi/disk.vmdk",
+        str(file_path),
+        len(payload),
+        2,
+        journal=journal,
+        resumed=resumed.append,
+    )
+    assert requested == [(8, 9)]
+    assert resumed == [8]
+    assert file_path.read_bytes() == payload
@@ -0,0 +1,95 @@
+""" Unit tests for the VMware exporter's disk bookkeeping """
+
+import io
+from unittest.mock import MagicMock
+
+from pyVmomi import vim
+
+import voithos.lib.vmware.exporter as exporter_lib
+from voithos.lib.vmware.exporter import VMWareExporter, download_thread
+from voithos.lib.vmware.journal import DownloadJournal
+
+
+def _exporter(devices, device_urls):
+    """ Return an exporter of a VM with devices and a lease of device_urls, without ExportVm """
+    exporter = VMWareExporter.__new__(VMWareExporter)
+    exporter.vm = MagicMock()
+    exporter.vm.config.hardware.device = devices
+    exporter.lease = MagicMock()
+    exporter.lease.info.deviceUrl = device_urls
+    return exporter
+
+
+def test_lease_disk_map():
+    """ Lease disks map to hardware disks by controller and unit, then by order """
+    controller = vim.vm.device.VirtualLsiLogicController(key=1000, busNumber=0)
+    disk_a = vim.vm.device.VirtualDisk(
+        key=2000, controllerKey=1000, unitNumber=0, capacityInBytes=1
+    )
+    disk_b = vim.vm.device.VirtualDisk(
+        key=2001, controllerKey=1000, unitNumber=1, capacityInBytes=2
+    )
+    device_urls = [
+        vim.HttpNfcLease.DeviceUrl(
+            key="/vm-7/VirtualLsiLogicController0:1", targetId="b", disk=True
+        ),
+        vim.HttpNfcLease.DeviceUrl(key="/vm-7/unknown", targetId="a", disk=True),
+        vim.HttpNfcLease.DeviceUrl(key="/vm-7/cdrom", targetId="iso", disk=False),
+    ]
+    exporter = _exporter([controller, disk_a, disk_b], device_urls)
+    disk_map = exporter.get_lease_disk_map()
+    assert disk_map["/vm-7/VirtualLsiLogicController0:1"].capacityInBytes == 2
+    assert disk_map["/vm-7/unknown"].capacityInBytes == 1
+    assert len(disk_map) == 2
+
+
+def test_lease_percent():
+    """ Disks count by size, by the share of their transfer that is done """
+    exporter = _exporter([], [])
+    first = MagicMock(total=100, bytes=50, done=False)
+    second = MagicMock(total=10, bytes=10, done=True)
+    exporter.downloads = [
+        {"progress": first, "thick_size": 300},
+        {"progress": second, "thick_size": 100},
+    ]
+    assert exporter.lease_percent() == 62
+
+
+def _download(file_path, payload, prefix, complete=False):
+    """ Return a download of payload whose journal already holds its first prefix bytes """
+    file_path.write_bytes(payload[:prefix])
+    journal = DownloadJournal(str(file_path), "vm-uuid", "disk.vmdk", "https://esxi/disk.vmdk")
+    journal.add(0, prefix - 1)
+    if complete:
+        journal.finish()
+    return {
+        "url": "https://esxi/disk.vmdk",
+        "file_path": str(file_path),
+        "journal": journal,
+        "target": None,
+        "progress": MagicMock(),
+        "thick_size": len(payload),
+    }
+
+
+def test_download_thread_limits_only_new_bytes(tmp_path, monkeypatch):
+    """ Bytes a journal already has on disk count as progress but not against the bandwidth """
+    monkeypatch.setattr(exporter_lib, "DIGEST_CHUNK_SIZE", 4)
+    payload = b"abcdefghij"
+    for prefix, complete, received in ((10, True, 0), (4, False, 6)):
+        resp = MagicMock(status_code=206, raw=io.BytesIO(payload[prefix:]), headers={})
+        session = MagicMock()
+        session.get.return_value.__enter__.return_value = resp
+        counted = []
+        tracker = MagicMock()
+        tracker.callback.return_value = counted.append
+        limiter = MagicMock()
+        file_path = tmp_path / str(prefix) / "disk.vmdk"
+        file_path.parent.mkdir()
+        download_thread(
+            session, _download(file_path, payload, prefix, complete), tracker, limiter=limiter
+        )
+        consumed = sum(call.args[0] for call in limiter.consume.call_args_list)
+        assert consumed == received
+        assert sum(counted) == len(payload)
+        assert file_path.read_bytes() == payload
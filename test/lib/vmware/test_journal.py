@@ -0,0 +1,41 @@
+""" Unit tests for the VMware download checkpoint journal """
+
+from voithos.lib.vmware.journal import DownloadJournal
+
+
+def test_journal_merges_and_resumes(tmp_path):
+    """ Completed ranges merge, persist, and are only trusted for the same disk """
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"")
+    journal = DownloadJournal(str(file_path), "vm-uuid", "disk-0.vmdk", "https://esxi/a")
+    journal.add(10, 19)
+    journal.add(0, 9)
+    journal.add(30, 39)
+    assert journal.completed == [[0, 19], [30, 39]]
+    assert journal.prefix_bytes == 20
+    assert journal.completed_bytes == 30
+    assert journal.is_done(30, 39)
+    assert not journal.is_done(20, 29)
+    reloaded = DownloadJournal(str(file_path), "vm-uuid", "disk-0.vmdk", "https://esxi/b")
+    assert reloaded.completed == [[0, 19], [30, 39]]
+    other_vm = DownloadJournal(str(file_path), "other-uuid", "disk-0.vmdk", "https://esxi/b")
+    assert other_vm.completed == []
+
+
+def test_journal_reset_when_disk_changed(tmp_path):
+    """ A journal, even a complete one, is dropped once its disk's contents changed """
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"")
+    journal = DownloadJournal(
+        str(file_path), "vm-uuid", "disk-0.vmdk", "https://esxi/a", identity={"content_id": "1"}
+    )
+    journal.add(0, 9)
+    journal.finish()
+    same = DownloadJournal(
+        str(file_path), "vm-uuid", "disk-0.vmdk", "https://esxi/b", identity={"content_id": "1"}
+    )
+    assert same.complete and same.completed == [[0, 9]]
+    changed = DownloadJournal(
+        str(file_path), "vm-uuid", "disk-0.vmdk", "https://esxi/b", identity={"content_id": "2"}
+    )
+    assert not changed.complete and changed.completed == []
@@ -0,0 +1,20 @@
+""" Unit tests for the NFC lease heartbeat """
+
+from time import sleep
+from unittest.mock import MagicMock
+
+from voithos.lib.vmware.lease import LeaseHeartbeat
+
+
+def test_lease_heartbeat():
+    """ The heartbeat renews the lease on its own until stopped, capping progress at 99% """
+    lease = MagicMock()
+    heartbeat = LeaseHeartbeat(lease, lambda: 150, interval=0.01)
+    heartbeat.start()
+    sleep(0.1)
+    heartbeat.stop()
+    assert lease.HttpNfcLeaseProgress.called
+    lease.HttpNfcLeaseProgress.assert_called_with(99)
+    calls = lease.HttpNfcLeaseProgress.call_count
+    sleep(0.05)
+    assert lease.HttpNfcLeaseProgress.call_count == calls
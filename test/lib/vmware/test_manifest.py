@@ -0,0 +1,44 @@
+""" Unit tests for streamed disk digests and manifests """
+
+import hashlib
+import os
+
+import pytest
+
+from voithos.lib.vmware import manifest
+
+
+def _digest(data):
+    """ Return the manifest digest of data """
+    return hashlib.blake2b(data, digest_size=manifest.DIGEST_SIZE).hexdigest()
+
+
+def test_chunk_digests_any_chunk_order():
+    """ Chunks can complete in any order, as long as each one's bytes arrive in order """
+    data = os.urandom(100)
+    digests = manifest.ChunkDigests(chunk_size=40, size=100)
+    digests.update(80, data[80:100])
+    digests.update(40, data[40:60])
+    digests.update(0, data[0:30])
+    digests.update(60, data[60:80])
+    digests.update(30, data[30:40])
+    assert digests.finish(100) == [_digest(data[0:40]), _digest(data[40:80]), _digest(data[80:])]
+    with pytest.raises(manifest.ManifestError):
+        manifest.ChunkDigests(chunk_size=40).update(10, b"x")
+
+
+def test_verify_manifest(tmp_path):
+    """ A manifest written from the streamed digests verifies until the file changes """
+    disk = tmp_path / "disk.vmdk"
+    data = os.urandom(1000)
+    disk.write_bytes(data)
+    digests = manifest.ChunkDigests(chunk_size=256)
+    for offset in range(0, 1000, 100):
+        digests.update(offset, data[offset : offset + 100])
+    manifest.write_manifest(str(disk), 1000, 256, digests.finish(1000))
+    manifest.verify_manifest(str(disk))
+    with open(disk, "r+b") as disk_file:
+        disk_file.seek(600)
+        disk_file.write(b"corrupt")
+    with pytest.raises(manifest.ManifestError, match=r"offsets \[512\]"):
+        manifest.verify_manifest(str(disk))
@@ -0,0 +1,54 @@
+""" Unit tests for the VMware manager's inventory lookups """
+
+from unittest.mock import patch
+
+import pytest
+
+from voithos.lib.vmware.mgr import VMWareMgr
+
+VM_PROPS = {
+    "vm-1": {"name": "web01-prod", "config.uuid": "uuid-1"},
+    "vm-2": {"name": "web02-prod", "config.uuid": "uuid-2"},
+    "vm-3": {"name": "db01", "config.uuid": "uuid-3"},
+}
+
+
+@patch("voithos.lib.vmware.mgr.connect")
+@patch("voithos.lib.vmware.mgr.retrieve_properties", return_value=VM_PROPS)
+@patch.object(VMWareMgr, "connect")
+def test_mgr_lookups(mock_connect, mock_retrieve, mock_pyvim_connect):
+    """ UUID and name substring lookups are served from the in-memory indexes """
+    mgr = VMWareMgr(username="user", password="pass", ip_addr="vcenter", cache_ttl=0)
+    assert mgr.find_vms_by_name(["web"]) == ["vm-1", "vm-2"]
+    assert mock_retrieve.call_count == 1
+    assert mgr.find_vm_by_uuid("uuid-2") == "vm-2"
+    assert mgr.find_vm_by_uuid("missing") is None
+    assert mgr.find_vms_by_name(["01"]) == ["vm-3", "vm-1"]
+    assert mgr.find_vms_by_name(["-prod", "db"]) == ["vm-3", "vm-1", "vm-2"]
+    assert mgr.find_vms_by_name(["nothing"]) == []
+    assert mgr.find_vms_by_name(["*"]) == ["vm-1", "vm-2", "vm-3"]
+
+
+@patch("voithos.lib.vmware.mgr.connect")
+@patch("voithos.lib.vmware.mgr.retrieve_properties")
+@patch.object(VMWareMgr, "connect")
+def test_mgr_lazy_uuid_lookup(mock_connect, mock_retrieve, mock_pyvim_connect):
+    """ A UUID lookup before any listing uses the SearchIndex, not the full inventory """
+    mgr = VMWareMgr(username="user", password="pass", ip_addr="vcenter", cache_ttl=0)
+    mgr.conn = mock_pyvim_connect.SmartConnect.return_value
+    search_index = mgr.conn.content.searchIndex
+    search_index.FindByUuid.return_value = "vm-2"
+    assert mgr.find_vm_by_uuid("uuid-2") == "vm-2"
+    search_index.FindByUuid.assert_called_once_with(None, "uuid-2", True, False)
+    assert not mock_retrieve.called
+
+
+@patch.object(VMWareMgr, "connect")
+def test_mgr_needs_one_vcenter(mock_connect, monkeypatch):
+    """ A VMWARE_IP_ADDR list is rejected, unless it holds a single vCenter """
+    monkeypatch.setenv("VMWARE_IP_ADDR", "vc1, vc2")
+    with pytest.raises(SystemExit):
+        VMWareMgr(username="user", password="pass", cache_ttl=0)
+    assert VMWareMgr(username="user", password="pass", ip_addr="vc3", cache_ttl=0).ip_addr == "vc3"
+    monkeypatch.setenv("VMWARE_IP_ADDR", "vc1,")
+    assert VMWareMgr(username="user", password="pass", cache_ttl=0).ip_addr == "vc1"
@@ -0,0 +1,56 @@
+""" Unit tests for the migration wave planner """
+
+from voithos.lib.vmware.planner import MigrationPlanner, get_makespan
+
+
+def _vm_report(name, capacity_gb, used_gb=0):
+    """ Return the parts of a VM report the planner reads """
+    return {
+        "name": name,
+        "uuid": f"{name}-uuid",
+        "storage": {
+            "disks": [{"capacity_gb": capacity_gb, "thin_provisioned": True}],
+            "partitions": {"total_used_gb": used_gb},
+        },
+    }
+
+
+def test_get_makespan():
+    """ Transfers are spread over the streams, largest first """
+    assert get_makespan([4, 3, 3, 2], streams=2, rate=1) == 6
+    assert get_makespan([4, 3, 3, 2], streams=1, rate=2) == 6
+
+
+def test_plan_waves():
+    """ VMs are packed into as few windows as fit, oversized VMs get their own wave """
+    # 2 streams of 1800 MB/s each: 1 GB every ~0.57s, a 1h window fits ~6328 GB per stream
+    planner = MigrationPlanner(3600, streams=2, window_hours=1)
+    plan = planner.plan(
+        [
+            _vm_report("big", 20000),
+            _vm_report("a", 6000, used_gb=3000),
+            _vm_report("b", 3000),
+            _vm_report("c", 4000),
+            _vm_report("d", 5000),
+        ]
+    )
+    assert [[vm["name"] for vm in wave["vms"]] for wave in plan["waves"]] == [
+        ["big"],
+        ["d", "c"],
+        ["a", "b"],
+    ]
+    assert plan["waves"][0]["exceeds_window"]
+    assert not plan["waves"][1]["exceeds_window"]
+    assert plan["waves"][2]["vms"][0]["basis"] == "used"
+    assert plan["transfer_gb"] == 35000
+
+
+def test_plan_single_vm_wave():
+    """ A VM alone in its wave has the whole link, up to the per stream cap """
+    plan = MigrationPlanner(3600, streams=4, window_hours=1).plan([_vm_report("solo", 3000)])
+    (wave,) = plan["waves"]
+    assert wave["stream_mbs"] == 3600 and plan["stream_mbs"] == 900
+    assert wave["hours"] == wave["vms"][0]["hours"] == round(3000 * 1024 / 3600 / 3600, 2)
+    assert not wave["exceeds_window"]
+    capped = MigrationPlanner(3600, streams=4, window_hours=1, stream_mbs=1000)
+    assert capped.plan([_vm_report("solo", 3000)])["waves"][0]["stream_mbs"] == 1000
@@ -0,0 +1,43 @@
+""" Unit tests for VMware transfer progress tracking """
+
+import json
+from threading import Timer
+from time import monotonic
+
+from voithos.lib.vmware.progress import ProgressTracker
+
+
+def test_tracker_rates_and_eta():
+    """ Byte callbacks feed per-disk and aggregate rates and the ETA """
+    tracker = ProgressTracker("vm-uuid", interval=0)
+    disk_a = tracker.add_disk("a.vmdk", total=1000)
+    disk_b = tracker.add_disk("b.vmdk", total=1000)
+    tracker.callback(disk_a)(300)
+    tracker.callback(disk_b)(100)
+    tracker.sample(2)
+    assert disk_a.rate == 150
+    assert tracker.rate == 200
+    assert tracker.eta_seconds == 8
+
+
+def test_tracker_wait_returns_on_completion(capsys):
+    """ wait() returns as soon as the last disk finishes and reports it as JSON """
+    tracker = ProgressTracker("vm-uuid", interval=60, output="json")
+    disk = tracker.add_disk("a.vmdk")
+    tracker.callback(disk)(42)
+    Timer(0.1, tracker.finish, args=(disk,), kwargs={"total": 42}).start()
+    start = monotonic()
+    tracker.wait()
+    assert monotonic() - start < 1
+    report = json.loads(capsys.readouterr().out.strip())
+    assert report["event"] == "done"
+    assert report["bytes"] == 42
+    assert report["disks"][0]["done"]
+
+
+def test_tracker_wait_without_disks():
+    """ wait() returns at once when the export had no disks to download """
+    tracker = ProgressTracker("vm-uuid", interval=0)
+    start = monotonic()
+    tracker.wait()
+    assert monotonic() - start < 1
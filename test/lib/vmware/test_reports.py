@@ -0,0 +1,129 @@
+""" Unit tests for VMware VM report generation """
+
+from unittest.mock import MagicMock, patch
+
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware import reports
+
+
+def _vm_props(name):
+    """ Return REPORT_PROPERTIES values for a VM with one disk and one NIC """
+    disk = vim.vm.device.VirtualDisk(
+        key=2000,
+        capacityInBytes=10 * 1024**3,
+        deviceInfo=vim.Description(label="Hard disk 1", summary=""),
+        backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName="[ds] vm/vm.vmdk",
+            diskMode="persistent",
+            sharing="sharingNone",
+            thinProvisioned=True,
+            uuid="disk-uuid",
+        ),
+    )
+    nic = vim.vm.device.VirtualVmxnet3(
+        key=4000,
+        macAddress="00:50:56:00:00:01",
+        deviceInfo=vim.Description(label="Network adapter 1", summary=""),
+        backing=vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName="VM Network"),
+        connectable=vim.vm.device.VirtualDevice.ConnectInfo(connected=True),
+        slotInfo=vim.vm.device.VirtualDevice.PciBusSlotInfo(pciSlotNumber=192),
+    )
+    return {
+        "name": name,
+        "summary.config": vim.vm.Summary.ConfigSummary(
+            uuid=f"{name}-uuid",
+            guestFullName="Ubuntu Linux (64-bit)",
+            numCpu=2,
+            memorySizeMB=4096,
+            numVirtualDisks=1,
+            numEthernetCards=1,
+        ),
+        "runtime.powerState": "poweredOff",
+        "config.hardware.device": [disk, nic],
+    }
+
+
+def _fake_conn(vm_props):
+    """Return a connection whose PropertyCollector reads vm_props, {VM: props}
+
+    Like vCenter, a request naming a VM it doesn't have fails as a whole
+    """
+
+    def _retrieve(filter_specs, options):
+        objs = [spec.obj for spec in filter_specs[0].objectSet]
+        for obj in objs:
+            if obj not in vm_props:
+                raise vmodl.fault.ManagedObjectNotFound(obj=obj)
+        page = MagicMock(token=None, objects=[])
+        for obj in objs:
+            prop_set = []
+            for path, val in vm_props[obj].items():
+                prop = MagicMock(val=val)
+                prop.name = path
+                prop_set.append(prop)
+            page.objects.append(MagicMock(obj=obj, propSet=prop_set))
+        return page
+
+    conn = MagicMock()
+    conn.content.propertyCollector.RetrievePropertiesEx.side_effect = _retrieve
+    return conn
+
+
+def test_get_vms_data():
+    """ All VMs come from one property fetch, keep the requested order and skip deleted VMs """
+    web, db, gone = (vim.VirtualMachine(moid) for moid in ("vm-1", "vm-2", "vm-gone"))
+    conn = _fake_conn({db: _vm_props("db01"), web: _vm_props("web01")})
+    missing = []
+    vm_data = reports.get_vms_data(conn, [web, gone, db], missing=missing)
+    assert missing == [gone]
+    assert conn.content.propertyCollector.RetrievePropertiesEx.call_count == 2
+    assert [vm["name"] for vm in vm_data] == ["web01", "db01"]
+    web = vm_data[0]
+    assert web["uuid"] == "web01-uuid" and web["num_cpu"] == 2
+    assert web["storage"]["disks"] == [
+        {
+            "label": "Hard disk 1",
+            "uuid": "disk-uuid",
+            "thin_provisioned": True,
+            "shared": False,
+            "capacity_gb": 10.0,
+        }
+    ]
+    assert web["storage"]["partitions"]["total_used_gb"] == 0
+    assert web["network"]["networks"][0]["vswitch_name"] == "VM Network"
+    assert web["network"]["networks"][0]["pci_slot_num"] == 192
+
+
+@patch("voithos.lib.vmware.reports.iter_vms_data")
+@patch("voithos.lib.vmware.reports.VMWareMgr")
+def test_get_estate_data(mock_mgr, mock_iter_vms_data):
+    """ Every vCenter is read, reports are tagged by source and failures don't stop the rest """
+
+    def _get_mgr(username=None, password=None, ip_addr=None):
+        if ip_addr == "vc-bad":
+            raise ConnectionError("unreachable")
+        return MagicMock()
+
+    mock_mgr.side_effect = _get_mgr
+    mock_iter_vms_data.side_effect = lambda conn, vms, missing=None: iter(
+        [{"name": "vm"}, {"name": "vm"}]
+    )
+    vm_reports, errors = reports.get_estate_data(["*"], ["vc-1", "vc-bad", "vc-2"])
+    assert [vm["vcenter"] for vm in vm_reports] == ["vc-1", "vc-1", "vc-2", "vc-2"]
+    assert list(errors) == ["vc-bad"]
+    errors = {}
+    streamed = reports.iter_estate_data(["*"], ["vc-1", "vc-bad", "vc-2"], errors)
+    assert sorted(vm["vcenter"] for vm in streamed) == ["vc-1", "vc-1", "vc-2", "vc-2"]
+    assert list(errors) == ["vc-bad"]
+
+
+@patch("voithos.lib.vmware.reports.iter_vms_data")
+@patch("voithos.lib.vmware.reports.VMWareMgr")
+def test_iter_estate_data_early_exit(mock_mgr, mock_iter_vms_data, monkeypatch):
+    """ Closing the stream early doesn't leave producers blocked on a full queue """
+    monkeypatch.setattr(reports, "ESTATE_QUEUE_SIZE", 1)
+    mock_iter_vms_data.side_effect = lambda conn, vms, missing=None: iter([{"name": "vm"}] * 10)
+    streamed = reports.iter_estate_data(["*"], ["vc-1", "vc-2"], {})
+    assert next(streamed)["name"] == "vm"
+    streamed.close()
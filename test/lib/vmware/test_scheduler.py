@@ -0,0 +1,83 @@
+""" Unit tests for the multi-VM export scheduler """
+
+from unittest.mock import MagicMock, patch
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.scheduler import ExportScheduler
+
+
+def _fake_vm(uuid, host, disk_sizes):
+    """ Return a VM with the given disks, hosted on host, and its properties """
+    vm = vim.VirtualMachine(f"vm-{uuid}")
+    props = {
+        "name": uuid,
+        "config.uuid": uuid,
+        "runtime.host": vim.HostSystem(host),
+        "config.hardware.device": [
+            vim.vm.device.VirtualDisk(capacityInBytes=size) for size in disk_sizes
+        ],
+    }
+    return vm, props
+
+
+def _fake_retrieve(vms):
+    """ Return a retrieve_properties that reads the properties of vms, and counts its calls """
+
+    def _retrieve(conn, obj_type, path_set, objs=None):
+        if obj_type is vim.HostSystem:
+            return {host: {"name": host._moId} for host in objs}
+        return {vm: props for vm, props in vms if vm in objs}
+
+    return MagicMock(side_effect=_retrieve)
+
+
+@patch("voithos.lib.vmware.scheduler.VMWareExporter")
+def test_scheduler_largest_first(mock_exporter):
+    """ Jobs start largest-first and every job is exported once """
+    vms = [
+        _fake_vm("small", "esxi1", [10]),
+        _fake_vm("large", "esxi2", [1000]),
+        _fake_vm("medium", "esxi1", [100, 100]),
+    ]
+    retrieve = _fake_retrieve(vms)
+    with patch("voithos.lib.vmware.scheduler.retrieve_properties", retrieve):
+        scheduler = ExportScheduler(
+            MagicMock(), [vm for vm, _ in vms], "/tmp/exports", max_leases=1
+        )
+    # One call for every VM's properties, one for their hosts' names
+    assert retrieve.call_count == 2
+    assert [job["uuid"] for job in scheduler.pending] == ["large", "medium", "small"]
+    assert [job["host"] for job in scheduler.pending] == ["esxi2", "esxi1", "esxi1"]
+    with patch("voithos.lib.vmware.scheduler.os.makedirs"):
+        jobs = scheduler.run()
+    assert all(job["status"] == "done" for job in jobs)
+    started = [call[0][1]._moId for call in mock_exporter.call_args_list]
+    assert started == ["vm-large", "vm-medium", "vm-small"]
+
+
+def test_scheduler_host_connection_cap():
+    """ A host at its connection cap is skipped in favour of the next largest job elsewhere """
+    vms = [
+        _fake_vm("big", "esxi1", [1000, 1000]),
+        _fake_vm("next", "esxi1", [900]),
+        _fake_vm("other", "esxi2", [10]),
+    ]
+    with patch("voithos.lib.vmware.scheduler.retrieve_properties", _fake_retrieve(vms)):
+        scheduler = ExportScheduler(
+            MagicMock(), [vm for vm, _ in vms], "/tmp/exports", host_connections=2
+        )
+    assert scheduler._next_job()["uuid"] == "big"
+    assert scheduler._next_job()["uuid"] == "other"
+
+
+def test_scheduler_lowers_connections_to_fit_host():
+    """ A VM that would need more than host_connections exports with fewer per disk """
+    vms = [_fake_vm("wide", "esxi1", [10, 10, 10]), _fake_vm("narrow", "esxi1", [10])]
+    with patch("voithos.lib.vmware.scheduler.retrieve_properties", _fake_retrieve(vms)):
+        scheduler = ExportScheduler(
+            MagicMock(), [vm for vm, _ in vms], "/tmp/exports", host_connections=8, connections=4
+        )
+    wide, narrow = scheduler.jobs
+    assert wide["connections"] == 2 and wide["slots"] == 6
+    assert narrow["connections"] == 4 and narrow["slots"] == 4
@@ -0,0 +1,42 @@
+""" Unit tests for reusing vCenter sessions between commands """
+
+import os
+import ssl
+import stat
+from unittest.mock import MagicMock, patch
+
+from voithos.lib.vmware.mgr import VMWareMgr
+from voithos.lib.vmware.session import SessionCache
+
+
+def test_session_cache(tmp_path):
+    """ Values merge per key and the file is private to its owner """
+    cache = SessionCache(path=str(tmp_path / "sessions.json"))
+    assert cache.get("user@vcenter") == {}
+    cache.set("user@vcenter", ssl="tlsv1")
+    cache.set("user@vcenter", cookie="vmware_soap_session=abc")
+    assert cache.get("user@vcenter") == {"ssl": "tlsv1", "cookie": "vmware_soap_session=abc"}
+    assert stat.S_IMODE(os.stat(cache.path).st_mode) == 0o600
+
+
+@patch("voithos.lib.vmware.mgr.vim.ServiceInstance")
+@patch("voithos.lib.vmware.mgr.connect")
+def test_mgr_session_reuse(mock_connect, mock_service_instance, tmp_path):
+    """ The SSL strategy that worked is remembered, and the next command reuses the session """
+    cache_path = str(tmp_path / "sessions.json")
+
+    def _smart_connect(host, user, pwd, sslContext):
+        if sslContext is None:
+            raise ssl.SSLError("certificate verify failed")
+        return MagicMock(_stub=MagicMock(cookie="vmware_soap_session=abc"))
+
+    mock_connect.SmartConnect.side_effect = _smart_connect
+    with patch("voithos.lib.vmware.mgr.SessionCache", lambda: SessionCache(path=cache_path)):
+        VMWareMgr(username="user", password="pass", ip_addr="vcenter", cache_ttl=0)
+        assert mock_connect.SmartConnect.call_count == 2
+        assert SessionCache(cache_path).get("user@vcenter")["ssl"] == "tlsv1"
+        mgr = VMWareMgr(username="user", password="pass", ip_addr="vcenter", cache_ttl=0)
+    assert mock_connect.SmartConnect.call_count == 2
+    assert mock_connect.SmartStubAdapter.return_value.cookie == "vmware_soap_session=abc"
+    assert mgr.conn == mock_service_instance.return_value
+    assert not mock_connect.Disconnect.called
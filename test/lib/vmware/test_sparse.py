@@ -0,0 +1,42 @@
+""" Unit tests for sparse writing of exported disks """
+
+import io
+import os
+from unittest.mock import MagicMock
+
+import voithos.lib.vmware.download as download
+from voithos.lib.vmware.sparse import SparseWriter
+
+
+def test_sparse_writer(tmp_path):
+    """ Zero blocks are skipped in holes but always written over existing data """
+    block = 4096
+    data = b"a" * block + bytes(block * 3) + b"b" * 10
+    file_path = tmp_path / "disk.raw"
+    writer = SparseWriter(block_size=block)
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, len(data))
+        writer.pwrite(fd, data, 0)
+        assert (writer.logical_bytes, writer.physical_bytes) == (len(data), block + 10)
+        assert file_path.read_bytes() == data
+        writer.dense().pwrite(fd, bytes(block), 0)
+        assert writer.physical_bytes == 2 * block + 10
+    finally:
+        os.close(fd)
+    assert file_path.read_bytes()[:block] == bytes(block)
+
+
+def test_stream_download_sparse(tmp_path):
+    """ A streamed download leaves zero buffers as holes and still has the right contents """
+    payload = b"x" * 100 + bytes(download.BUFFER_SIZE * 2) + b"y" * 100
+    resp = MagicMock(status_code=200, raw=io.BytesIO(payload))
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    file_path = tmp_path / "disk.vmdk"
+    writer = SparseWriter()
+    written = download.stream_download(session, "https://esxi/disk", str(file_path), writer=writer)
+    assert written == len(payload)
+    assert file_path.read_bytes() == payload
+    assert writer.logical_bytes == len(payload)
+    assert writer.physical_bytes < 2 * SparseWriter().block_size + 200
@@ -0,0 +1,64 @@
+""" Tests for the destinations of converted disk data """
+from unittest.mock import MagicMock
+
+import pytest
+
+import voithos.lib.vmware.targets as targets
+from voithos.lib.vmware.sparse import SparseWriter
+
+
+class FakeSession:
+    """ Records Glance and Cinder requests, consuming upload bodies like requests does """
+
+    def __init__(self, fail_upload=False):
+        self.uploaded = b""
+        self.deleted = []
+        self.volumes = []
+        self.fail_upload = fail_upload
+
+    def post(self, url, endpoint_filter, json):
+        if url == "/v2/images":
+            return MagicMock(json=lambda: {"id": "image-1"})
+        self.volumes.append(json["volume"])
+        return MagicMock(json=lambda: {"volume": {"id": "volume-1"}})
+
+    def put(self, url, endpoint_filter, headers, data):
+        for chunk in data:
+            if self.fail_upload:
+                raise IOError("connection reset")
+            self.uploaded += bytes(chunk)
+
+    def get(self, url, endpoint_filter):
+        return MagicMock(json=lambda: {"volume": {"status": "available"}})
+
+    def delete(self, url, endpoint_filter):
+        self.deleted.append(url)
+
+
+def test_glance_target_uploads_zero_filled_stream(monkeypatch):
+    """ Writes are streamed in order with gaps and the tail sent as zeros """
+    session = FakeSession()
+    monkeypatch.setattr(targets, "get_keystone_session", lambda: session)
+    writer = SparseWriter()
+    target = targets.open_target("cinder:web01", 16, writer=writer)
+    target.write_at(2, b"ab")
+    target.write_at(8, b"cd")
+    with pytest.raises(IOError):
+        target.write_at(0, b"x")
+    target.close()
+    assert session.uploaded == b"\0\0ab\0\0\0\0cd" + bytes(6)
+    assert writer.logical_bytes == 16
+    assert session.volumes == [{"name": "web01", "size": 1, "imageRef": "image-1"}]
+    assert not session.deleted
+
+
+def test_glance_target_failed_upload_deletes_image(monkeypatch):
+    """ An upload that fails mid-stream leaves no image behind """
+    session = FakeSession(fail_upload=True)
+    monkeypatch.setattr(targets, "get_keystone_session", lambda: session)
+    target = targets.open_target("glance:web01", 4, writer=SparseWriter())
+    target.write_at(0, b"ab")
+    with pytest.raises(IOError):
+        target.close()
+    assert session.deleted == ["/v2/images/image-1"]
+    assert not session.volumes
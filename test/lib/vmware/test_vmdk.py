@@ -0,0 +1,84 @@
+""" Unit tests for the native VMDK parser """
+
+import io
+import struct
+import zlib
+
+from voithos.lib.vmware import vmdk
+from voithos.lib.vmware.targets import RawTarget
+
+GRAIN_SECTORS = 128  # 64 KB grains, the VMware default
+
+
+def _pad(data):
+    """ Pad data to a whole number of sectors """
+    return data + bytes(-len(data) % vmdk.SECTOR_SIZE)
+
+
+def _stream_optimized(capacity, grains):
+    """ Build a minimal streamOptimized VMDK holding {lba: data} grains """
+    overhead_sectors = 1
+    header = struct.pack(
+        vmdk.HEADER_FORMAT,
+        vmdk.VMDK_MAGIC,
+        3,
+        0x30001,
+        capacity // vmdk.SECTOR_SIZE,
+        GRAIN_SECTORS,
+        0,
+        0,
+        512,
+        0,
+        0xFFFFFFFFFFFFFFFF,
+        overhead_sectors,
+        0,
+        b"\n \r\n",
+        1,
+    )
+    body = _pad(header)
+    for lba, data in sorted(grains.items()):
+        compressed = zlib.compress(data)
+        body += _pad(struct.pack(vmdk.MARKER_FORMAT, lba, len(compressed)) + compressed)
+    # a grain table marker followed by one sector of table, then end-of-stream
+    body += _pad(struct.pack("<QII", 1, 0, vmdk.MARKER_GT)) + bytes(vmdk.SECTOR_SIZE)
+    body += _pad(struct.pack("<QII", 0, 0, vmdk.MARKER_EOS))
+    return body
+
+
+def test_parse_header():
+    """ parse_header reads the capacity in bytes """
+    data = _stream_optimized(1024 * 1024, {})
+    assert vmdk.parse_header(data)["capacity_bytes"] == 1024 * 1024
+
+
+def test_stream_optimized_to_raw(tmp_path):
+    """ Grains decode to their offsets, everything else reads back as zeros """
+    grain_bytes = GRAIN_SECTORS * vmdk.SECTOR_SIZE
+    capacity = grain_bytes * 4
+    first = bytes(range(256)) * (grain_bytes // 256)
+    third = b"\xab" * grain_bytes
+    stream = _stream_optimized(capacity, {0: first, 2 * GRAIN_SECTORS: third})
+    consumed = []
+    reader = vmdk.StreamOptimizedReader(io.BytesIO(stream), callback=consumed.append)
+    raw_path = tmp_path / "disk.raw"
+    target = RawTarget(str(raw_path), reader.capacity)
+    for offset, data in reader.iter_grains():
+        target.write_at(offset, data)
+    target.close()
+    assert sum(consumed) == len(stream)
+    expected = first + bytes(grain_bytes) + third + bytes(grain_bytes)
+    assert raw_path.read_bytes() == expected
+
+
+def test_read_capacity(tmp_path):
+    """ Capacity comes from sparse headers and text descriptors alike """
+    sparse = tmp_path / "sparse.vmdk"
+    sparse.write_bytes(_stream_optimized(1024 * 1024, {}))
+    assert vmdk.read_capacity(str(sparse)) == 1024 * 1024
+    descriptor = tmp_path / "disk.vmdk"
+    descriptor.write_text(
+        "# Disk DescriptorFile\nversion=1\n"
+        'RW 2048 VMFS "disk-flat.vmdk"\nRW 1024 VMFS "disk-flat2.vmdk"\n'
+        'ddb.adapterType = "lsilogic"\n'
+    )
+    assert vmdk.read_capacity(str(descriptor)) == 3072 * vmdk.SECTOR_SIZE
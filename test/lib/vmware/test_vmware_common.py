@@ -0,0 +1,36 @@
+""" Unit tests for the shared VMware helpers """
+
+from unittest.mock import MagicMock
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.common import retrieve_properties
+
+
+def _page(objects, token=None):
+    """ Return a mock RetrieveResult page of {name: props} objects """
+    page = MagicMock()
+    page.token = token
+    page.objects = []
+    for name, props in objects.items():
+        obj_content = MagicMock()
+        obj_content.obj = name
+        obj_content.propSet = [MagicMock(val=val) for val in props.values()]
+        for prop, (path, _) in zip(obj_content.propSet, props.items()):
+            prop.name = path
+        page.objects.append(obj_content)
+    return page
+
+
+def test_retrieve_properties_pages():
+    """ Every page of a paged PropertyCollector result is read, then the view destroyed """
+    conn = MagicMock()
+    view = MagicMock(spec=vim.view.ContainerView)
+    conn.content.viewManager.CreateContainerView.return_value = view
+    collector = conn.content.propertyCollector
+    collector.RetrievePropertiesEx.return_value = _page({"vm-1": {"name": "web"}}, token="t1")
+    collector.ContinueRetrievePropertiesEx.return_value = _page({"vm-2": {"name": "db"}})
+    props = retrieve_properties(conn, vim.VirtualMachine, ["name"])
+    assert props == {"vm-1": {"name": "web"}, "vm-2": {"name": "db"}}
+    collector.ContinueRetrievePropertiesEx.assert_called_once_with("t1")
+    assert view.Destroy.called
@@ -2,6 +2,20 @@
 import click
 import voithos.cli.migrate.rhel as rhel
 import voithos.cli.migrate.ubuntu as ubuntu
+from voithos.lib.migrate.convert import load_plan, run_plan, validate_plan
+
+
+@click.option("--check", is_flag=True, help="Only validate the plan, change nothing")
+@click.argument("plan_path")
+@click.command()
+def convert(plan_path, check):
+    """ Run every step of a YAML/JSON conversion plan in one mount session """
+    plan = load_plan(plan_path)
+    if check:
+        validate_plan(plan)
+        print(f"{plan_path} is valid")
+        return
+    run_plan(plan)
 
 
 def get_migrate_group():
@@ -13,4 +27,5 @@ def get_migrate_group():
 
     migrate.add_command(rhel.get_rhel_group())
     migrate.add_command(ubuntu.get_ubuntu_group())
+    migrate.add_command(convert)
     return migrate
@@ -59,11 +59,17 @@ def uninstall_package(package):
     RhelWorker().uninstall(package, like=True)
 
 
+@click.option(
+    "--workers",
+    "-w",
+    default="4",
+    help="Partitions on different disks to repair at once (default 4, 1 repairs in order)",
+)
 @click.argument("devices", nargs=-1)
 @click.command(name="repair-partitions")
-def repair_partitions(devices):
+def repair_partitions(devices, workers):
     """ Repair the partitions on this device """
-    RhelWorker(devices).repair_partitions()
+    RhelWorker(devices).repair_partitions(workers=int(workers))
 
 
 @click.group()
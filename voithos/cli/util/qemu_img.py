@@ -12,17 +12,22 @@ FORMATS = ["qcow2", "qed", "raw", "vdi", "vpc", "vmdk"]
 
 @click.option("--input-format", "-f", "input_format", help=f"Allowed={FORMATS}", required=True)
 @click.option("--output-format", "-O", "output_format", help=f"Allowed={FORMATS}", required=True)
+@click.option(
+    "--verify/--no-verify",
+    default=False,
+    help="Check the input against the manifest written when it was exported before converting",
+)
 @click.argument("output_path")
 @click.argument("input_path")
 @click.command(name="convert")
-def convert(input_format, output_format, input_path, output_path):
+def convert(input_format, output_format, input_path, output_path, verify):
     """ Run: qemu-img -f <input-format> -O <output-format> <input-path> <output-path> """
     print(f"qemu-img -f {input_format} -O {output_format} {input_path} {output_path}")
     if input_format not in FORMATS or output_format not in FORMATS:
         error("ERROR - Invalid format provided. Valid formats: {FORMATS}", exit=True)
     if not Path(input_path).is_file():
         error(f"ERROR - File not found: {input_path}", exit=True)
-    qemu_img.convert(input_format, output_format, input_path, output_path)
+    qemu_img.convert(input_format, output_format, input_path, output_path, verify=verify)
 
 @click.argument("vol_path")
 @click.command(name="info")
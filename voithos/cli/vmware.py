@@ -1,69 +1,82 @@
 """ Commands for VMWare """
 
+import csv
+import sys
+
 import click
 import json
 from pprint import pprint
 from voithos.lib.system import error
 import voithos.lib.vmware.reports as reports
-from voithos.lib.vmware.mgr import VMWareMgr
+from voithos.lib.vmware.mgr import VMWareMgr, get_ip_addrs
 from voithos.lib.vmware.exporter import VMWareExporter, VMWareOnlineVMCantMigrate
+from voithos.lib.vmware.planner import MigrationPlanner
+from voithos.lib.vmware.progress import OUTPUT_FORMATS
+from voithos.lib.vmware.scheduler import ExportScheduler
 
 
-def _escape_csv(value):
-    """ Format a CSV value to be safe to use in a CSV (string, escape commas, quotes) """
-    str_val = str(value)
-    str_val = str_val.replace('"', '""')
-    str_val = str_val.replace(",", '","')
-    return str_val
+# Formats that print each VM as soon as its report is built
+STREAMING_OUTPUTS = ["jsonl", "csv"]
+CSV_COLUMNS = [
+    "uuid",
+    "name",
+    "os",
+    "cores",
+    "ram_mb",
+    "num_disks",
+    "total_storage_gb",
+    "used_storage_gb",
+    "num_nics",
+    "net_list",
+    "shared_storage",
+    "vcenter",
+]
 
 
-def _print_csv(vms):
-    """ Print the CSV format output of a list of VMs """
-    columns = [
-        "uuid",
-        "name",
-        "os",
-        "cores",
-        "ram_mb",
-        "num_disks",
-        "total_storage_gb",
-        "used_storage_gb",
-        "num_nics",
-        "net_list",
-        "shared_storage",
+def _get_csv_row(vm):
+    """ Return the CSV_COLUMNS values of a VM report """
+    capacity_gb = sum(disk["capacity_gb"] for disk in vm["storage"]["disks"])
+    used_gb = round(vm["storage"]["partitions"]["total_used_gb"], 2)
+    net_list = " ||| ".join(network["vswitch_name"] for network in vm["network"]["networks"])
+    shared_storage = "yes" if any(disk["shared"] for disk in vm["storage"]["disks"]) else "no"
+    return [
+        vm["uuid"],
+        vm["name"],
+        vm["guest_os"],
+        vm["num_cpu"],
+        vm["ram"]["total_mb"],
+        vm["storage"]["num_disks"],
+        capacity_gb,
+        used_gb,
+        vm["network"]["num_interfaces"],
+        net_list,
+        shared_storage,
+        vm["vcenter"],
     ]
-    columns_str = ",".join(columns)
-    print(columns_str)
+
+
+def _print_csv(vms):
+    """ Print the CSV format output of VMs, one row as soon as each is available """
+    writer = csv.writer(sys.stdout)
+    writer.writerow(CSV_COLUMNS)
     for vm in vms:
-        line = []
-        line.append(_escape_csv(vm["uuid"]))
-        line.append(_escape_csv(vm["name"]))
-        line.append(_escape_csv(vm["guest_os"]))
-        line.append(_escape_csv(vm["num_cpu"]))
-        line.append(_escape_csv(vm["ram"]["total_mb"]))
-        line.append(_escape_csv(vm["storage"]["num_disks"]))
-        capacity_gb = sum(disk["capacity_gb"] for disk in vm["storage"]["disks"])
-        line.append(_escape_csv(capacity_gb))
-        used_gb = round(vm["storage"]["partitions"]["total_used_gb"], 2)
-        line.append(_escape_csv(used_gb))
-        line.append(_escape_csv(vm["network"]["num_interfaces"]))
-        net_list = []
-        for network in vm["network"]["networks"]:
-            net_list.append(network["vswitch_name"])
-        net_list_str = " ||| ".join(net_list)
-        line.append(net_list_str)
-        shared_storage = "no"
-        for disk in vm["storage"]["disks"]:
-            if disk["shared"]:
-                shared_storage = "yes"
-        line.append(shared_storage)
-        print(",".join(line))
+        writer.writerow(_get_csv_row(vm))
+        sys.stdout.flush()
+
+
+def _print_jsonl(vms):
+    """ Print one JSON object per line for each VM, as soon as each is available """
+    for vm in vms:
+        sys.stdout.write(json.dumps(vm) + "\n")
+        sys.stdout.flush()
 
 
 @click.option(
     "--name", "-n", multiple=True, help="Repetable - names of VMs to display", required=True
 )
-@click.option("--format", "-f", "output", default="pprint", help="Output format: pprint,json,csv")
+@click.option(
+    "--format", "-f", "output", default="pprint", help="Output format: pprint,json,jsonl,csv"
+)
 @click.option(
     "--username",
     "-u",
@@ -79,29 +92,41 @@ def _print_csv(vms):
 @click.option(
     "--ip-addr",
     "-i",
-    "ip_addr",
-    default=None,
-    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+    "ip_addrs",
+    multiple=True,
+    help="(optional) Repeatable - overrides environment variable VMWARE_IP_ADDR",
 )
 @click.command(name="show-vm")
-def show_vm(name, output, username, password, ip_addr):
+def show_vm(name, output, username, password, ip_addrs):
     """ Show data about provided VMs """
-    allowed_outputs = ["pprint", "json", "csv"]
+    allowed_outputs = ["pprint", "json", "jsonl", "csv"]
     if output not in allowed_outputs:
         error(f"Invalid output format chosen. Supported outputs: {allowed_outputs}", exit=True)
-    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
-    vms = mgr.find_vms_by_name(name)
-    vm_reports = []
-    for vm in vms:
-        vm_report = reports.get_vm_data(vm)
-        vm_reports.append(vm_report)
-    if output == "pprint":
-        for vm in vm_reports:
-            pprint(vm)
-    elif output == "json":
-        print(json.dumps(vm_reports))
-    elif output == "csv":
-        _print_csv(vm_reports)
+    ip_addrs = get_ip_addrs(ip_addrs)
+    if output in STREAMING_OUTPUTS:
+        errors = {}
+        vm_reports = reports.iter_estate_data(
+            name, ip_addrs, errors, username=username, password=password
+        )
+        if output == "csv":
+            _print_csv(vm_reports)
+        else:
+            _print_jsonl(vm_reports)
+    else:
+        vm_reports, errors = reports.get_estate_data(
+            name, ip_addrs, username=username, password=password
+        )
+        if output == "pprint":
+            for vm in vm_reports:
+                pprint(vm)
+        elif output == "json":
+            print(json.dumps(vm_reports))
+    if errors:
+        for ip_addr, exc in errors.items():
+            # error() has already explained a SystemExit
+            detail = "" if isinstance(exc, SystemExit) else f": {exc}"
+            error(f"ERROR: Failed to read VMs from {ip_addr}{detail}")
+        error(f"ERROR: {len(errors)} vCenters could not be read", exit=True)
 
 
 @click.argument("vm_uuid")
@@ -128,18 +153,245 @@ def show_vm(name, output, username, password, ip_addr):
 @click.option(
     "--interval", default="15", help="Optional CLI Print interval override - 0 disables updates"
 )
+@click.option(
+    "--progress-format",
+    default="human",
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Optional progress output: human, or json (one object per line)",
+)
+@click.option(
+    "--connections",
+    "-c",
+    default="1",
+    help="Optional parallel HTTP connections per disk - needs Range support from ESXi",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Continue from the checkpoint journals of a previous attempt (default resume)",
+)
+@click.option(
+    "--target",
+    "-t",
+    "targets",
+    multiple=True,
+    help="Repeatable - convert each disk to raw while downloading, in disk order, into a file, "
+    "block device, rbd:<pool>/<image>, glance:<image> or cinder:<volume> instead of saving VMDKs",
+)
 @click.command(name="download-vm")
-def download_vm(vm_uuid, dest_dir, username, password, ip_addr, interval):
+def download_vm(
+    vm_uuid,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    interval,
+    progress_format,
+    connections,
+    resume,
+    targets,
+):
     """ Download a VM with a given UUID """
     mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
     vm = mgr.find_vm_by_uuid(vm_uuid)
     if vm is None:
         error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
     try:
-        exporter = VMWareExporter(mgr, vm, base_dir=dest_dir, interval=int(interval))
+        exporter = VMWareExporter(
+            mgr,
+            vm,
+            base_dir=dest_dir,
+            interval=int(interval),
+            connections=int(connections),
+            resume=resume,
+            progress_format=progress_format,
+        )
     except VMWareOnlineVMCantMigrate:
         error("ERROR: This VM is not offline", exit=True)
-    exporter.download()
+    exporter.download(targets=targets)
+
+
+@click.option("--uuid", "uuids", multiple=True, help="Repeatable - UUIDs of VMs to download")
+@click.option("--name", "-n", "names", multiple=True, help="Repeatable - names of VMs to download")
+@click.option("--output-dir", "-o", "dest_dir", default=".", help="Optional destination directory")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+)
+@click.option("--max-leases", default="4", help="Optional max VMs exporting at once (default 4)")
+@click.option(
+    "--host-connections",
+    default="8",
+    help="Optional max HTTP connections to any one ESXi host (default 8)",
+)
+@click.option(
+    "--connections",
+    "-c",
+    default="1",
+    help="Optional parallel HTTP connections per disk - needs Range support from ESXi",
+)
+@click.option(
+    "--bandwidth", default="0", help="Optional total bandwidth cap in MB/s - 0 is unlimited"
+)
+@click.option(
+    "--interval", default="0", help="Optional per-VM progress interval - 0 (default) disables it"
+)
+@click.option(
+    "--progress-format",
+    default="human",
+    type=click.Choice(OUTPUT_FORMATS),
+    help="Optional progress output: human, or json (one object per line)",
+)
+@click.command(name="download-vms")
+def download_vms(
+    uuids,
+    names,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    max_leases,
+    host_connections,
+    connections,
+    bandwidth,
+    interval,
+    progress_format,
+):
+    """ Download many VMs concurrently, each into <output-dir>/<uuid> """
+    if not uuids and not names:
+        error("ERROR: At least one --uuid or --name is required", exit=True)
+    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
+    vms = list(mgr.find_vms_by_name(names)) if names else []
+    for vm_uuid in uuids:
+        vm = mgr.find_vm_by_uuid(vm_uuid)
+        if vm is None:
+            error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+        vms.append(vm)
+    # A VM matched by both a name and a UUID is only exported once
+    vms = list(dict.fromkeys(vms))
+    scheduler = ExportScheduler(
+        mgr,
+        vms,
+        dest_dir,
+        max_leases=int(max_leases),
+        host_connections=int(host_connections),
+        connections=int(connections),
+        bandwidth_mbs=float(bandwidth),
+        interval=int(interval),
+        progress_format=progress_format,
+    )
+    jobs = scheduler.run()
+    print("")
+    for job in jobs:
+        print(f"{job['uuid']}  {job['status']:7}  {job['seconds']:>6}s  {job['name']}")
+        if job["error"] is not None:
+            print(f"    {job['error']}")
+    failed = [job for job in jobs if job["status"] != "done"]
+    if failed:
+        error(f"ERROR: {len(failed)}/{len(jobs)} exports failed", exit=True)
+
+
+def _print_plan(plan):
+    """ Print a human readable migration plan """
+    print(
+        f"{plan['num_vms']} VMs, {plan['transfer_gb']} GB in {plan['num_waves']} waves of up to "
+        f"{plan['window_hours']}h - {plan['hours']}h of transfers at {plan['stream_mbs']} MB/s "
+        "per stream when all streams are busy"
+    )
+    for wave in plan["waves"]:
+        warning = "  (EXCEEDS WINDOW)" if wave["exceeds_window"] else ""
+        print("")
+        print(
+            f"Wave {wave['wave']}: {wave['num_vms']} VMs, {wave['transfer_gb']} GB, "
+            f"{wave['hours']}h at {wave['stream_mbs']} MB/s per stream{warning}"
+        )
+        for vm in wave["vms"]:
+            print(f"  {vm['uuid']}  {vm['transfer_gb']:>10} GB  {vm['hours']:>7}h  {vm['name']}")
+
+
+@click.option(
+    "--name", "-n", multiple=True, help="Repeatable - names of VMs to plan for", required=True
+)
+@click.option(
+    "--throughput",
+    "-t",
+    required=True,
+    help="Measured link throughput to the migration target, in MB/s",
+)
+@click.option("--streams", "-s", default="4", help="VMs exported at the same time, per wave")
+@click.option(
+    "--stream-throughput",
+    default="0",
+    help="Speed limit of a single VM export in MB/s, ex: NFC per-lease speed. 0 = no limit",
+)
+@click.option("--window-hours", "-w", default="8", help="Length of a maintenance window")
+@click.option("--format", "-f", "output", default="text", help="Output format: text,json")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addrs",
+    multiple=True,
+    help="(optional) Repeatable - overrides environment variable VMWARE_IP_ADDR",
+)
+@click.command(name="plan-migration")
+def plan_migration(
+    name,
+    throughput,
+    streams,
+    stream_throughput,
+    window_hours,
+    output,
+    username,
+    password,
+    ip_addrs,
+):
+    """ Estimate transfer times and pack VMs into maintenance window waves """
+    allowed_outputs = ["text", "json"]
+    if output not in allowed_outputs:
+        error(f"Invalid output format chosen. Supported outputs: {allowed_outputs}", exit=True)
+    vm_reports, errors = reports.get_estate_data(
+        name, get_ip_addrs(ip_addrs), username=username, password=password
+    )
+    if errors:
+        error(f"ERROR: Failed to read VMs from: {', '.join(errors)}", exit=True)
+    planner = MigrationPlanner(
+        float(throughput),
+        streams=int(streams),
+        window_hours=float(window_hours),
+        stream_mbs=float(stream_throughput),
+    )
+    plan = planner.plan(vm_reports)
+    if output == "json":
+        print(json.dumps(plan))
+    else:
+        _print_plan(plan)
 
 
 def get_vmware_group():
@@ -151,4 +403,6 @@ def get_vmware_group():
 
     vmware_group.add_command(show_vm)
     vmware_group.add_command(download_vm)
+    vmware_group.add_command(download_vms)
+    vmware_group.add_command(plan_migration)
     return vmware_group
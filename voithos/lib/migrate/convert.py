@@ -0,0 +1,137 @@
+""" Run a whole offline guest conversion from one plan, with one worker and one mount session """
+import yaml
+
+from voithos.lib.migrate.linux_worker import REPAIR_WORKERS
+from voithos.lib.migrate.rhel import RhelWorker
+from voithos.lib.migrate.ubuntu import UbuntuWorker
+from voithos.lib.system import error, debug
+
+
+WORKERS = {"rhel": RhelWorker, "ubuntu": UbuntuWorker}
+# Steps that run on the mounted guest, and the distros that support them
+MOUNTED_STEPS = {
+    "add-virtio-drivers": ["rhel"],
+    "uninstall": ["rhel", "ubuntu"],
+    "set-interface": ["rhel", "ubuntu"],
+}
+# Steps that need the guest's volumes unmounted, they run before the mount
+UNMOUNTED_STEPS = {"repair-partitions": ["rhel", "ubuntu"]}
+# Shorthand uninstall targets and the package names they uninstall, like the CLI commands
+UNINSTALL_PACKAGES = {"vmware-tools": "vm-tools", "cloud-init": "cloud-init"}
+INTERFACE_KEYS = ["name", "mac", "dhcp", "ip_addr", "prefix", "gateway", "dns", "domain"]
+
+
+def load_plan(plan_path):
+    """ Return the conversion plan in the YAML or JSON file at plan_path """
+    try:
+        with open(plan_path) as plan_file:
+            plan = yaml.safe_load(plan_file)
+    except (OSError, yaml.YAMLError) as exc:
+        error(f"ERROR: Failed to read conversion plan {plan_path}: {exc}", exit=True)
+    if not isinstance(plan, dict):
+        error(f"ERROR: Conversion plan {plan_path} must be a mapping", exit=True)
+    return plan
+
+
+def _parse_step(step):
+    """ Return (name, options) of a plan step: either "<name>" or {"<name>": <options>} """
+    if isinstance(step, str):
+        return step, {}
+    if isinstance(step, dict) and len(step) == 1:
+        name, options = next(iter(step.items()))
+        return name, {} if options is None else options
+    error(f"ERROR: Invalid conversion step: {step}", exit=True)
+
+
+def _validate_interface(options):
+    """ Exit with an error if set-interface options are invalid, as the CLI would """
+    if not isinstance(options, dict):
+        error(f"ERROR: set-interface needs a mapping of options: {options}", exit=True)
+    unknown = [key for key in options if key not in INTERFACE_KEYS]
+    if unknown:
+        error(f"ERROR: Unknown set-interface options: {unknown}", exit=True)
+    if not options.get("name") or not options.get("mac"):
+        error("ERROR: set-interface requires name and mac", exit=True)
+    static = [options.get(key) for key in ("ip_addr", "prefix", "gateway")]
+    if options.get("dhcp", True):
+        if any(value is not None for value in static):
+            error("ERROR: set-interface ip_addr, prefix, gateway require dhcp: false", exit=True)
+    elif options.get("ip_addr") is None or options.get("prefix") is None:
+        error("ERROR: set-interface ip_addr and prefix are required with dhcp: false", exit=True)
+
+
+def validate_plan(plan):
+    """Exit with an error unless plan can run, before anything is changed
+    Return the list of (step name, options) in the order they run
+    """
+    distro = plan.get("os")
+    if distro not in WORKERS:
+        error(f"ERROR: Conversion plan os must be one of {list(WORKERS)}, not {distro}", exit=True)
+    if not plan.get("devices"):
+        error("ERROR: Conversion plan has no devices", exit=True)
+    steps = [_parse_step(step) for step in plan.get("steps") or []]
+    for index, (name, options) in enumerate(steps):
+        supported = {**UNMOUNTED_STEPS, **MOUNTED_STEPS}.get(name)
+        if supported is None:
+            error(f"ERROR: Unknown conversion step: {name}", exit=True)
+        if distro not in supported:
+            error(f"ERROR: {name} is not supported on {distro}", exit=True)
+        if name in UNMOUNTED_STEPS and any(prior in MOUNTED_STEPS for prior, _ in steps[:index]):
+            error(f"ERROR: {name} must come before the steps run on mounted volumes", exit=True)
+        if name == "uninstall" and not isinstance(options, str):
+            error(f"ERROR: uninstall takes a package name, not {options}", exit=True)
+        if name == "set-interface":
+            _validate_interface(options)
+        if name in ("add-virtio-drivers", "repair-partitions") and not isinstance(options, dict):
+            error(f"ERROR: {name} takes a mapping of options, not {options}", exit=True)
+    return steps
+
+
+def run_step(worker, name, options):
+    """ Run one validated step with worker """
+    print(f"=== {name} ===")
+    if name == "repair-partitions":
+        worker.repair_partitions(workers=int(options.get("workers", REPAIR_WORKERS)))
+    elif name == "add-virtio-drivers":
+        worker.add_virtio_drivers(force=bool(options.get("force", False)))
+    elif name == "uninstall":
+        worker.uninstall(UNINSTALL_PACKAGES.get(options, options), like=True)
+    elif name == "set-interface":
+        worker.set_udev_interface_mapping(interface_name=options["name"], mac_addr=options["mac"])
+        worker.set_interface(
+            interface_name=options["name"],
+            is_dhcp=options.get("dhcp", True),
+            mac_addr=options["mac"],
+            ip_addr=options.get("ip_addr"),
+            prefix=options.get("prefix"),
+            gateway=options.get("gateway"),
+            dns=options.get("dns") or (),
+            domain=options.get("domain"),
+        )
+
+
+def run_plan(plan):
+    """Convert a guest as plan says, with one worker that discovers its devices once
+
+    Steps that need the volumes unmounted run first, then the volumes are mounted once for all
+    the other steps and unmounted when they finish - even if one fails
+    """
+    steps = validate_plan(plan)
+    worker = WORKERS[plan["os"]](plan["devices"])
+    debug(f"Conversion plan steps: {[name for name, _ in steps]}")
+    for name, options in steps:
+        if name in UNMOUNTED_STEPS:
+            run_step(worker, name, options)
+    mounted_steps = [(name, options) for name, options in steps if name in MOUNTED_STEPS]
+    if not mounted_steps:
+        return
+    # Volumes that were already mounted before the plan ran are left mounted
+    was_mounted = worker.was_root_mounted
+    try:
+        # Inside the try: a mount that fails part way still has its volumes unmounted
+        worker.mount_volumes(print_progress=True)
+        for name, options in mounted_steps:
+            run_step(worker, name, options)
+    finally:
+        if not was_mounted:
+            worker.unmount_volumes(print_progress=True)
@@ -0,0 +1,189 @@
+""" Discover the block devices of migrated guests in one structured pass """
+import json
+import os
+import subprocess
+
+from voithos.lib.system import error, run, debug
+
+
+# lsblk columns read for each device - see BlockDevice
+LSBLK_COLUMNS = "NAME,TYPE,FSTYPE,UUID,LABEL,PTTYPE,PKNAME,SIZE"
+LVS_FIELDS = "lv_name,vg_name,lv_path,lv_dm_path,devices"
+LVM_PV_FSTYPE = "LVM2_member"
+EXT_FSTYPES = ["ext2", "ext3", "ext4"]
+PROBE_TIMEOUT = 60  # seconds a debugfs or xfs_db lookup may take
+
+
+class BlockDevice:
+    """A disk, partition or LVM logical volume
+
+    path is the device path, type the lsblk type (disk, part, lvm...), fstype and uuid what blkid
+    reports. LVs also have lv_path (/dev/<vg>/<lv>), lv_name, vg_name and their PVs in pvs.
+    """
+
+    def __init__(self, data):
+        """ Read the lsblk JSON of one device """
+        self.path = data["name"]
+        self.type = data.get("type")
+        self.fstype = data.get("fstype")
+        self.uuid = data.get("uuid")
+        self.label = data.get("label")
+        self.pttype = data.get("pttype")
+        self.parent = data.get("pkname")
+        self.size = int(data["size"]) if data.get("size") is not None else None
+        self.lv_path = None
+        self.lv_name = None
+        self.vg_name = None
+        self.pvs = []
+
+    @property
+    def is_pv(self):
+        """ Return True when this device is an LVM physical volume """
+        return self.fstype == LVM_PV_FSTYPE
+
+    def __repr__(self):
+        return f"BlockDevice({self.path}, type={self.type}, fstype={self.fstype})"
+
+
+def parse_lsblk(lsblk_json):
+    """Return {path: BlockDevice} of every device in the lsblk --json tree
+
+    An LV on several PVs appears under each of them, it is listed once with all its PVs
+    """
+    devices = {}
+
+    def add(data, parent):
+        """ Add data and its children """
+        path = data["name"]
+        if path not in devices:
+            device = BlockDevice(data)
+            if device.parent is None and parent is not None:
+                device.parent = parent.path
+            devices[path] = device
+        device = devices[path]
+        if parent is not None and parent.is_pv and parent.path not in device.pvs:
+            device.pvs.append(parent.path)
+        for child in data.get("children", []):
+            add(child, device)
+
+    for data in json.loads(lsblk_json).get("blockdevices", []):
+        add(data, None)
+    return devices
+
+
+def parse_lvs(lvs_json):
+    """ Return the LV rows of lvs --reportformat json output, keyed by device mapper path """
+    lvs = {}
+    for report in json.loads(lvs_json).get("report", []):
+        for row in report.get("lv", []):
+            lvs[row["lv_dm_path"]] = row
+    return lvs
+
+
+class DeviceGraph:
+    """The disks of a guest and everything on them, discovered with one lsblk and one lvs call
+
+    Query it instead of running fdisk, blkid, pvs, pvdisplay or lvdisplay per device
+    """
+
+    def __init__(self, disks):
+        """ Discover disks, a list of device paths """
+        self.disks = list(disks)
+        debug(f"Discovering block devices on {self.disks}")
+        lsblk = run(f"lsblk --json --bytes --paths --output {LSBLK_COLUMNS} {' '.join(disks)}")
+        self.devices = parse_lsblk("\n".join(lsblk))
+        if any(device.is_pv for device in self.devices.values()):
+            self._add_lvm_names()
+        for device in self.devices.values():
+            debug(f"{device.path}: {device.type} {device.fstype} {device.uuid} {device.pvs}")
+
+    def _add_lvm_names(self):
+        """ Fill in the LVM names of each LV, which lsblk doesn't report """
+        lvs = run(f"lvs --reportformat json -o {LVS_FIELDS}")
+        for dm_path, row in parse_lvs("\n".join(lvs)).items():
+            device = self.devices.get(dm_path)
+            if device is None:
+                continue
+            device.lv_path = row["lv_path"]
+            device.lv_name = row["lv_name"]
+            device.vg_name = row["vg_name"]
+
+    def get(self, path):
+        """ Return the BlockDevice at path """
+        if path not in self.devices:
+            error(f"ERROR: {path} is not a device on {self.disks}", exit=True)
+        return self.devices[path]
+
+    @property
+    def partitions(self):
+        """ Return the paths of the partitions on the disks, in disk order """
+        return [dev.path for dev in self.devices.values() if dev.type == "part"]
+
+    @property
+    def pvs(self):
+        """ Return the paths of the partitions that are LVM physical volumes """
+        return [path for path in self.partitions if self.devices[path].is_pv]
+
+    @property
+    def lvs(self):
+        """ Return the LVM logical volumes on the disks """
+        return [dev for dev in self.devices.values() if dev.pvs]
+
+    def get_disk(self, path):
+        """ Return the disk a partition is on """
+        device = self.get(path)
+        while device.parent is not None and device.type != "disk":
+            device = self.get(device.parent)
+        return device
+
+
+def _run_probe(cmd):
+    """ Return (return code, combined output) of cmd, a list - None if it couldn't run """
+    debug(f"run:  {' '.join(cmd)}")
+    try:
+        completed_process = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=PROBE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as exc:
+        debug(f"{cmd[0]} failed: {exc}")
+        return None
+    return completed_process.returncode, completed_process.stdout.decode("utf-8", "replace")
+
+
+def _parse_xfs_db_ls(output):
+    """ Return the names in xfs_db ls lines, like: 12  1677  regular  0x4a6b  5 fstab (good) """
+    names = []
+    for line in output.splitlines():
+        split = line.split()
+        if len(split) >= 7 and split[-1].startswith("("):
+            names.append(" ".join(split[5:-1]))
+    return names
+
+
+def has_file(device, fstype, path):
+    """Return whether the filesystem on device holds a file at path, read without mounting it
+
+    ext filesystems are read with debugfs and XFS with xfs_db, both read-only.
+    Returns None when that can't tell: other filesystems, missing tools or unreadable metadata.
+    """
+    if fstype in EXT_FSTYPES:
+        result = _run_probe(["debugfs", "-R", f"stat {path}", device])
+        if result is None or result[0] != 0:
+            return None
+        if "Inode:" in result[1]:
+            return True
+        if "File not found" in result[1]:
+            return False
+        return None
+    if fstype == "xfs":
+        directory, name = os.path.split(path)
+        result = _run_probe(["xfs_db", "-r", "-c", f"ls {directory}", device])
+        if result is None or result[0] != 0:
+            return None
+        names = _parse_xfs_db_ls(result[1])
+        if names:
+            return name in names
+        if "no such file" in result[1].lower():
+            return False
+        return None
+    return None
@@ -1,10 +1,14 @@
 """ Common base class for linux workers """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from time import monotonic
+from voithos.lib.migrate.devices import DeviceGraph, EXT_FSTYPES, has_file
 from voithos.lib.system import (
+    FailedMount,
     error,
     run,
-    grep,
+    run_capture,
     assert_block_device_exists,
     mount,
     unmount,
@@ -16,6 +20,14 @@ from voithos.lib.system import (
 )
 
 
+REPAIR_WORKERS = 4  # filesystem repairs run at once, each on different disks
+FSCK_MAX_OK_CODE = 3  # fsck exit codes up to 3 mean errors were corrected or none found
+# Filesystem labels and LV names that usually mark a root volume
+ROOT_LABELS = ["/", "root", "rootfs", "cloudimg-rootfs", "img-rootfs"]
+ROOT_LV_NAMES = ["root", "lv_root"]
+ROOT_FSTYPES = EXT_FSTYPES + ["xfs", "btrfs"]
+
+
 class LinuxWorker:
     """ Base class for linux worker classes """
 
@@ -28,6 +40,7 @@ class LinuxWorker:
         # - property value placeholders -
         # This pattern should help to prevent repeated system queries and improve debug clarity
         self._was_root_mounted = None  # Bool
+        self._device_graph = None
         self._fdisk_partitions = []
         self._lvm_pvs = []
         self._lvm_lvs = {}
@@ -64,7 +77,7 @@ class LinuxWorker:
 
     @property
     def was_root_mounted(self):
-        """ Check if root was mounted when this started """
+        """ Check if root was mounted when this started, or since mount_volumes() mounted it """
         if self._was_root_mounted is not None:
             return self._was_root_mounted
         is_root_mounted = is_mounted(self.ROOT_MOUNT)
@@ -98,42 +111,36 @@ class LinuxWorker:
         self.debug_action(end=True)
         return self._data_volumes
 
+    @property
+    def device_graph(self):
+        """Return the DeviceGraph of the devices - every block device when devices is None
+        All the partition, LVM and filesystem properties below are served from it
+        """
+        if self._device_graph is not None:
+            return self._device_graph
+        self.debug_action(action="DISCOVER BLOCK DEVICES")
+        self._device_graph = DeviceGraph(self.devices or [])
+        self.debug_action(end=True)
+        return self._device_graph
+
     @property
     def fdisk_partitions(self):
         """ return list of partitions on devices """
         if self._fdisk_partitions:
             return self._fdisk_partitions
-        self.debug_action(action="FIND FDISK PARTITIONS")
-        partitions = []
         if not self.devices:
             error("ERROR: Cannot list partitions when devices are not specified", exit=True)
-        for device in self.devices:
-            fdisk = run(f"fdisk -l {device}")
-            partition_lines = (line for line in fdisk if line.startswith(device))
-            for partition_line in partition_lines:
-                partitions.append(partition_line.split(" ")[0])
-        self._fdisk_partitions = partitions
-        debug(f"fdisk_partitions: {partitions}")
-        self.debug_action(end=True)
-        return partitions
+        self._fdisk_partitions = self.device_graph.partitions
+        debug(f"fdisk_partitions: {self._fdisk_partitions}")
+        return self._fdisk_partitions
 
     @property
     def lvm_pvs(self):
         """ Return a list of physical volumes (partitions) from LVM that match given devices """
         if self._lvm_pvs:
             return self._lvm_pvs
-        self.debug_action(action="FIND LVM PV's")
-        pvs = []
-        pvs_lines = run("pvs")
-        for line in pvs_lines:
-            partition = line.strip().split(" ")[0]
-            if "/dev/" not in partition:
-                continue
-            if partition in self.fdisk_partitions:
-                pvs.append(partition)
-                self._lvm_pvs = pvs
-        self.debug_action(end=True)
-        return pvs
+        self._lvm_pvs = [pv for pv in self.device_graph.pvs if pv in self.fdisk_partitions]
+        return self._lvm_pvs
 
     @property
     def lvm_lvs(self):
@@ -142,59 +149,25 @@ class LinuxWorker:
         """
         if self._lvm_lvs:
             return self._lvm_lvs
-        self.debug_action(action="FIND LVM LV's")
-        lvs = {}
-        for lvm_pv in self.lvm_pvs:
-            pv_lv_lines = grep(f"pvdisplay -m {lvm_pv}", "Logical volume")
-            # pv_lv_lines looks like this: ['    Logical volume\t/dev/vg_rhel610/lv_root']
-            for pv_lv in pv_lv_lines:
-                # example's name is /dev/vg_rhel610/lv_root
-                name = pv_lv.strip().split("\t")[1]
-                dm_path = run(f"lvdisplay -C -o lv_dm_path {name}")[1].strip()
-                if dm_path not in lvs:
-                    # First time encountering this LV
-                    lvs[dm_path] = {"name": name, "devices": [lvm_pv]}
-                else:
-                    # This LV was in a prior device, just add this device to it
-                    lvs[dm_path]["devices"].append(lvm_pv)
+        lvs = {lv.path: {"name": lv.lv_path, "devices": lv.pvs} for lv in self.device_graph.lvs}
         self._lvm_lvs = lvs
         debug(f"lvs: {list(lvs)}")
-        self.debug_action(end=True)
         return lvs
 
     @property
     def blkid(self):
-        """Return the blkid output of each device in devices
+        """Return the blkid values of each device in devices, and everything on them
         {"<device>": {"UUID": "<UUID">", "TYPE": "<TYPE>"}
 
-        blkid is used to get the filesystem and UUID of a block device
+        These are the filesystem and UUID of each block device
         """
         if self._blkid:
             return self._blkid
-        self.debug_action(action="GET BLKID DATA")
-        _blkid = {}
-        blkid_lines = run("blkid")
-
-        def blkid_val(line, prop):
-            """ Return the blkid property value if present else none """
-            word = next((elem for elem in line.split(" ") if f"{prop}=" in elem), None)
-            if word:
-                return word.split("=")[1].replace('"', "")
-            return None
-
-        for line in blkid_lines:
-            split = line.split(" ")
-            if not split[0]:
-                continue
-            path = split[0].replace(":", "")
-            uuid = blkid_val(line, "UUID")
-            type_ = blkid_val(line, "TYPE")
-            _blkid[path] = {"UUID": uuid, "TYPE": type_}
-        self._blkid = _blkid
-        for device in _blkid:
-            debug(f"{device}: {_blkid[device]}")
-        self.debug_action(end=True)
-        return _blkid
+        self._blkid = {
+            path: {"UUID": device.uuid, "TYPE": device.fstype}
+            for path, device in self.device_graph.devices.items()
+        }
+        return self._blkid
 
     @property
     def root_volume(self):
@@ -217,18 +190,20 @@ class LinuxWorker:
         if self.devices is None:
             error(f"ERROR: Failed to find root partition - no devices specified", exit=True)
         _root_volume = None
-        # root volume wasn't mounted, mount each data volume until you find /etc/fstab
-        for vol_path in self.data_volumes:
-            debug(f"Checking for /etc/fstab in {vol_path}")
-            try:
-                mount(vol_path, self.ROOT_MOUNT)
-                if get_file_contents(fstab_path):
-                    self._root_volume = vol_path
-                    unmount(self.ROOT_MOUNT)
-                    _root_volume = vol_path
-                    break
-            finally:
-                unmount(self.ROOT_MOUNT)
+        # Read each candidate's filesystem for /etc/fstab, most likely first, without mounting
+        candidates = self.get_root_candidates()
+        unknown = []
+        for vol_path in candidates:
+            found = has_file(vol_path, self.blkid[vol_path]["TYPE"], "/etc/fstab")
+            debug(f"/etc/fstab in {vol_path}: {'unknown' if found is None else found}")
+            if found:
+                _root_volume = vol_path
+                break
+            if found is None:
+                unknown.append(vol_path)
+        # Last resort: read-only trial mounts of what couldn't be read directly
+        if _root_volume is None:
+            _root_volume = next((vol for vol in unknown if self._trial_mount_has_fstab(vol)), None)
         debug(f"> root volume =  {_root_volume}")
         self.debug_action(end=True)
         if _root_volume is None:
@@ -236,6 +211,48 @@ class LinuxWorker:
         self._root_volume = _root_volume
         return _root_volume
 
+    def get_root_candidates(self):
+        """Return the data volumes ordered by how likely each is the root volume
+        A root filesystem label counts most, then a root LV name, then a Linux filesystem type
+        """
+
+        def score(vol_path):
+            """ Return the root likelihood score of vol_path """
+            device = self.device_graph.get(vol_path)
+            lv_name = (device.lv_name or "").lower()
+            points = 0
+            if device.label in ROOT_LABELS:
+                points += 4
+            if lv_name in ROOT_LV_NAMES:
+                points += 3
+            elif "root" in lv_name:
+                points += 2
+            if device.fstype in ROOT_FSTYPES:
+                points += 1
+            return points
+
+        candidates = sorted(self.data_volumes, key=score, reverse=True)
+        debug(f"Root volume candidates: {candidates}")
+        return candidates
+
+    def _trial_mount_has_fstab(self, vol_path):
+        """ Mount vol_path read-only, without journal recovery, and check it for /etc/fstab """
+        fstype = self.blkid[vol_path]["TYPE"]
+        options = "ro"
+        if fstype == "xfs":
+            options = "ro,norecovery"
+        elif fstype in ("ext3", "ext4"):
+            options = "ro,noload"
+        debug(f"Trial mounting {vol_path} to check for /etc/fstab")
+        try:
+            mount(vol_path, self.ROOT_MOUNT, fail=False, options=options)
+            return bool(get_file_contents(f"{self.ROOT_MOUNT}/etc/fstab"))
+        except FailedMount as exc:
+            debug(str(exc))
+            return False
+        finally:
+            unmount(self.ROOT_MOUNT)
+
     def mount_root(self):
         """ Mount the root device if it isn't mounted """
         mount(self.root_volume, self.ROOT_MOUNT)
@@ -381,6 +398,7 @@ class LinuxWorker:
             if print_progress:
                 print(f"umount {mount_opts['mnt_to']}")
             unmount(mount_opts["mnt_to"], prompt=prompt, fail=prompt)
+        self._was_root_mounted = False
         self.debug_action(end=True)
 
     def mount_volumes(self, print_progress=False):
@@ -391,6 +409,9 @@ class LinuxWorker:
         ordered_mount_opts = self.get_ordered_mount_opts()  # unmounts root
         debug(f"Mounting root volume {self.root_volume} to {self.ROOT_MOUNT}")
         mount(self.root_volume, self.ROOT_MOUNT)
+        # Later steps of this worker operate on the mounted volumes, and leave them mounted.
+        # Set now so unmount_volumes() after a failed mount below doesn't unmount root first
+        self._was_root_mounted = True
         if print_progress:
             print(f"mount {self.root_volume} {self.ROOT_MOUNT}")
         # Mount the other volumes
@@ -435,34 +456,92 @@ class LinuxWorker:
         if self._boot_mode:
             return self._boot_mode
         self.debug_action(action="FIND BOOT MODE")
-        # Get the disk of the boot partition, ex /dev/vdb for /dev/vdb1
-        drive = "".join([char for char in self.boot_volume if not char.isdigit()])
-        # Read fdisk's Disklabel for the disk
-        fdisk = run(f"fdisk -l {drive}")
-        disk_type_line = next((line for line in fdisk if "Disklabel type" in line), None)
-        if disk_type_line is None:
+        # The partition table type of the boot partition's disk, ex /dev/vdb for /dev/vdb1
+        disk_type = self.device_graph.get_disk(self.boot_volume).pttype
+        if disk_type is None:
             error(f"Error: Failed to determine boot mode of {self.boot_volume}", exit=True)
-        disk_type = disk_type_line.split(" ")[-1]
         _boot_mode = "UEFI" if (disk_type == "gpt") else "BIOS"
         self._boot_mode = _boot_mode
         self.debug_action(end=True)
         return _boot_mode
 
-    def repair_partitions(self):
-        """ Repair a given partition using the appropriate tool"""
+    def get_repair_command(self, partition):
+        """ Return the command that repairs partition, None if its filesystem isn't supported """
+        filesystem = self.blkid[partition]["TYPE"]
+        if filesystem == "xfs":
+            return f"xfs_repair {partition}"
+        if "ext" in filesystem:
+            return f"fsck.{filesystem} -y {partition}"
+        return None
+
+    def get_repair_groups(self):
+        """Return the data volumes grouped so that no two groups share a physical disk
+        An LV is on the disks of all its PVs. Repairs in one group run one after the other.
+        """
+        groups = []  # [{"disks": {<disk path>}, "volumes": [<volume path>]}]
+        for volume in self.data_volumes:
+            parts = self.device_graph.get(volume).pvs or [volume]
+            disks = {self.device_graph.get_disk(part).path for part in parts}
+            group = {"disks": disks, "volumes": []}
+            for other in [other for other in groups if other["disks"] & disks]:
+                group["disks"] |= other["disks"]
+                group["volumes"] += other["volumes"]
+                groups.remove(other)
+            group["volumes"].append(volume)
+            groups.append(group)
+        return groups
+
+    def repair_volume(self, partition):
+        """ Repair a partition, return its result for the repair report """
+        filesystem = self.blkid[partition]["TYPE"]
+        result = {"volume": partition, "filesystem": filesystem, "returncode": None, "seconds": 0}
+        cmd = self.get_repair_command(partition)
+        if cmd is None:
+            print(f" ! Cannot repair {partition} - unsupported filesystem: {filesystem}")
+            result.update({"status": "skipped", "output": ""})
+            return result
+        print(f" > Repairing {filesystem} partition {partition}")
+        started = monotonic()
+        returncode, output = run_capture(cmd)
+        debug(f"{cmd} returned {returncode}:\n{output}")
+        if returncode == 0:
+            status = "clean"
+        elif filesystem != "xfs" and returncode <= FSCK_MAX_OK_CODE:
+            status = "repaired"
+        else:
+            status = "failed"
+        result.update(
+            {
+                "status": status,
+                "returncode": returncode,
+                "seconds": round(monotonic() - started, 1),
+                "output": output,
+            }
+        )
+        return result
+
+    def repair_partitions(self, workers=REPAIR_WORKERS):
+        """Repair the data volumes using the appropriate tool, then print a report of each
+
+        Volumes on different physical disks are repaired at the same time, up to workers at once.
+        Exits with an error after the report when any repair failed.
+        """
         if is_mounted(self.ROOT_MOUNT):
             error("ERROR: Cannot repair partitions when they are mounted", exit=True)
-        for partition in self.data_volumes:
-            filesystem = self.blkid[partition]["TYPE"]
-            if filesystem == "xfs":
-                print(f" > Repairing XFS partition {partition}")
-                run(f"xfs_repair {partition}")
-            elif "ext" in filesystem:
-                print(f" > Repairing {filesystem} partition {partition}")
-                repair_cmd = f"fsck.{filesystem} -y {partition}"
-                run(repair_cmd)
-            else:
-                print(f" ! Cannot repair {partition} - unsupported filesystem: {filesystem}")
+        groups = self.get_repair_groups()
+        debug(f"Repair groups: {[group['volumes'] for group in groups]}")
+
+        def repair_group(group):
+            """ Repair the volumes of a group in order """
+            return [self.repair_volume(volume) for volume in group["volumes"]]
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = [result for group in executor.map(repair_group, groups) for result in group]
+        print_repair_report(results)
+        failed = [result["volume"] for result in results if result["status"] == "failed"]
+        if failed:
+            error(f"ERROR: Failed to repair {', '.join(failed)}", exit=True)
+        return results
 
     def uninstall(self, package, like=False):
         """ Child classes must extend this method, it varies from distro to distro """
@@ -501,3 +580,19 @@ class LinuxWorker:
         set_file_contents(udev_path, udev_line, append=True)
         print("udev file contents:")
         print(get_file_contents(udev_path))
+
+
+def print_repair_report(results):
+    """ Print the status and timing of each repair, and the output of those that failed """
+    print("")
+    print(f"{'VOLUME':<40} {'FILESYSTEM':<10} {'STATUS':<9} {'EXIT':>4} {'SECONDS':>8}")
+    for result in results:
+        returncode = "" if result["returncode"] is None else result["returncode"]
+        print(
+            f"{result['volume']:<40} {str(result['filesystem']):<10} {result['status']:<9} "
+            f"{returncode:>4} {result['seconds']:>8}"
+        )
+    for result in results:
+        if result["status"] == "failed":
+            print(f"\n--- {result['volume']} output ---")
+            print(result["output"].rstrip())
@@ -251,8 +251,8 @@ def purge_gnocchi_resources():
         gnocchi_client.resource.batch_delete(query=query_str)
 
 
-def _get_gnocchiclient():
-    """Return a project scoped gnocchi client"""
+def get_keystone_session():
+    """ Return a project scoped keystoneauth1 session from the sourced OpenStack RC file """
     if not all(
         env in os.environ
         for env in (
@@ -273,6 +273,11 @@ def _get_gnocchiclient():
         user_domain_name=os.environ["OS_USER_DOMAIN_NAME"],
         project_domain_name=os.environ["OS_PROJECT_DOMAIN_NAME"],
     )
-    new_session = session.Session(auth=auth, verify=False)
+    return session.Session(auth=auth, verify=False)
+
+
+def _get_gnocchiclient():
+    """Return a project scoped gnocchi client"""
+    new_session = get_keystone_session()
     gnocchi_client = gnocchi.Client(session=new_session)
     return gnocchi_client
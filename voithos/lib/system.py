@@ -1,14 +1,19 @@
 """ Shared functions that operate outside of python on the local system """
 
 import pathlib
+import re
 import socket
 import subprocess
 import os
 import sys
 from contextlib import closing
+from threading import Lock
 from time import sleep
 
 
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+
 def is_debug_on():
     """ Return if debug mode is on or not """
     arg = "VOITHOS_DEBUG"
@@ -59,6 +64,17 @@ def grep(cmd, expression):
     return [line for line in lines if expression in line]
 
 
+def run_capture(cmd):
+    """Run a given shell command without exiting when it fails
+    Returns (return code, the combined stdout and stderr text)
+    """
+    debug(f"run:  {cmd}")
+    completed_process = subprocess.run(
+        cmd.split(" "), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    return completed_process.returncode, completed_process.stdout.decode("utf-8", "replace")
+
+
 def error(msg, exit=False, code=1):
     """ Write an error to stderr, and exit with error code 'code' if exit=True """
     sys.stderr.write(f"{msg}\n")
@@ -93,18 +109,78 @@ class FailedMount(Exception):
     """ A mount operation has failed """
 
 
+def _unescape_mountinfo(field):
+    """ Decode the octal escapes mountinfo uses for spaces, tabs, newlines and backslashes """
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    """Return the mounts in /proc/self/mountinfo text, in mount order, as a list of dicts:
+    {"device": <source>, "mpoint": <mountpoint>, "fstype": <type>, "root": <path in the source>}
+    """
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split(" ")
+        if "-" not in fields:
+            continue
+        # ID, parent ID, major:minor, root, mountpoint, options, [optional fields...] - type, source
+        separator = fields.index("-")
+        if separator < 6 or len(fields) < separator + 3:
+            continue
+        mounts.append(
+            {
+                "device": _unescape_mountinfo(fields[separator + 2]),
+                "mpoint": _unescape_mountinfo(fields[4]),
+                "fstype": fields[separator + 1],
+                "root": _unescape_mountinfo(fields[3]),
+            }
+        )
+    return mounts
+
+
+class MountTable:
+    """The mounts of this process, read from /proc/self/mountinfo and kept until invalidated
+
+    mount() and unmount() invalidate it, so lookups between them don't re-read the table
+    """
+
+    def __init__(self, path=MOUNTINFO_PATH):
+        """ Read path lazily, on the first lookup """
+        self.path = path
+        self._mounts = None
+        self.lock = Lock()
+
+    def invalidate(self):
+        """ Forget the table, the next lookup reads it again """
+        with self.lock:
+            self._mounts = None
+
+    @property
+    def mounts(self):
+        """ Return every mount, in mount order """
+        with self.lock:
+            if self._mounts is None:
+                self._mounts = parse_mountinfo(get_file_contents(self.path))
+            return self._mounts
+
+    def get_by_mountpoint(self, mpoint):
+        """ Return the mount visible at exactly mpoint - the last one mounted there - or None """
+        return next((mnt for mnt in reversed(self.mounts) if mnt["mpoint"] == mpoint), None)
+
+    def get_by_device(self, device):
+        """ Return the list of mounts of device """
+        return [mnt for mnt in self.mounts if mnt["device"] == device]
+
+
+MOUNT_TABLE = MountTable()
+
+
 def get_mount(mpoint):
     """ Return the device path of a mountpoint """
-    mount_lines = run("mount", silent=True)
-    mpoint_lines = [mpoint_line for mpoint_line in mount_lines if mpoint in mpoint_line]
-    if not mpoint_lines:
+    mnt = MOUNT_TABLE.get_by_mountpoint(_strip_double_slash(mpoint))
+    if mnt is None:
         return None
-    for line in mpoint_lines:
-        split = line.split(" ")
-        if len(split) < 3:
-            return None
-        if split[2] == mpoint:
-            return {"device": split[0], "mpoint": split[2]}
+    return {"device": mnt["device"], "mpoint": mnt["mpoint"]}
 
 
 def is_mounted(mpoint):
@@ -120,8 +196,8 @@ def _strip_double_slash(path):
     return path
 
 
-def mount(dev_path, mpoint, fail=True, bind=False, mkdir=True):
-    """Mount dev_path to mpoint.
+def mount(dev_path, mpoint, fail=True, bind=False, mkdir=True, options=None):
+    """Mount dev_path to mpoint, with the given -o options string when set
     If fail is true, throw a nice error. Else raise an exception
     """
     dev_path = _strip_double_slash(dev_path)
@@ -134,9 +210,11 @@ def mount(dev_path, mpoint, fail=True, bind=False, mkdir=True):
         debug(f"!!  not mounting {dev_path} to {mpoint} - {mpoint} is already mounted")
         return
     bind = "--bind" if bind else ""
-    cmd = f"mount {bind} {dev_path} {mpoint}"
+    options = f"-o {options}" if options else ""
+    cmd = f"mount {bind} {options} {dev_path} {mpoint}"
     debug(f"run:  {cmd}")
     ret = os.system(cmd)
+    MOUNT_TABLE.invalidate()
     if ret != 0:
         fail_msg = f"ERROR:  Failed to mount {dev_path} to {mpoint}"
         if fail:
@@ -166,6 +244,7 @@ def unmount(mpoint, prompt=False, fail=True):
         if attempt > 1:
             debug(f"Unmounting {mpoint} - try {attempt}/{retries}")
         run(f"umount {mpoint}")
+        MOUNT_TABLE.invalidate()
         if not is_mounted(mpoint):
             break
         sleep(attempt)
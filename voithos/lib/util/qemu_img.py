@@ -1,15 +1,26 @@
 """ qemu-img library: Manages conversions of vDisk types and mapping them to raw devices """
 from pathlib import Path
 
-from voithos.lib.system import shell, assert_path_exists
+from voithos.lib.system import error, shell, assert_path_exists
+from voithos.lib.vmware.manifest import ManifestError, verify_manifest
 
 
-def convert(input_format, output_format, input_path, output_path):
-    """ Execute qemu-img inside a container that mounts input_path and output_path to itself """
+def convert(input_format, output_format, input_path, output_path, verify=False):
+    """Execute qemu-img inside a container that mounts input_path and output_path to itself
+
+    When verify=True, input_path must first match the manifest written beside it when it was
+    exported - see voithos.lib.vmware.manifest
+    """
     # mount the input file to /work/<filename> inside the container
     path_in = Path(input_path)
     input_abspath = path_in.absolute().__str__()
     assert_path_exists(input_abspath)
+    if verify:
+        try:
+            verify_manifest(input_abspath)
+        except ManifestError as exc:
+            error(str(exc), exit=True)
+        print(f"{input_path} matches its manifest")
     internal_input_path = f"/input/{path_in.name}"
     in_mount = f"-v {input_abspath}:{internal_input_path}"
     # The mount for the output dir varies depending on if its a file or block device
@@ -0,0 +1,127 @@
+""" Persistent on-disk cache of the vCenter VM inventory """
+import os
+import sqlite3
+from contextlib import closing
+from time import time
+
+from voithos.lib.system import get_absolute_path
+from voithos.lib.vmware.common import debug
+
+
+INVENTORY_CACHE_PATH = "~/.cache/voithos/vmware-inventory.sqlite"
+INVENTORY_CACHE_TTL = 900  # seconds a cached inventory is used without asking vCenter
+# Cached columns and the VM properties they hold
+CACHED_PROPERTIES = {
+    "name": "name",
+    "uuid": "config.uuid",
+    "power_state": "runtime.powerState",
+}
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vms (
+    vcenter TEXT NOT NULL,
+    moid TEXT NOT NULL,
+    name TEXT,
+    uuid TEXT,
+    power_state TEXT,
+    PRIMARY KEY (vcenter, moid)
+);
+CREATE TABLE IF NOT EXISTS inventories (
+    vcenter TEXT PRIMARY KEY,
+    refreshed REAL NOT NULL,
+    collector TEXT,
+    version TEXT
+);
+"""
+
+
+def get_cache_ttl():
+    """ Return the inventory cache TTL - VMWARE_INVENTORY_TTL overrides it, 0 disables it """
+    return int(os.environ.get("VMWARE_INVENTORY_TTL", INVENTORY_CACHE_TTL))
+
+
+class InventoryCache:
+    """The VMs one user sees on one vCenter, keyed by managed object ID, stored in SQLite
+
+    vcenter is the user@address key of VMWareMgr.session_key, since vCenter permissions decide
+    which VMs each user can read. Along with the rows, the cache remembers the PropertyCollector
+    and version they were read at, so a stale cache can be brought up to date with only what
+    changed since.
+    """
+
+    def __init__(self, vcenter, path=INVENTORY_CACHE_PATH, ttl=INVENTORY_CACHE_TTL):
+        """ Open (creating if needed) the cache database at path """
+        self.vcenter = vcenter
+        self.ttl = ttl
+        self.path = get_absolute_path(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        """ Return a new connection to the cache database """
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_state(self):
+        """ Return (age in seconds, collector ID, version), or None for an empty cache """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "SELECT refreshed, collector, version FROM inventories WHERE vcenter = ?",
+                (self.vcenter,),
+            ).fetchone()
+        if row is None:
+            return None
+        return time() - row[0], row[1], row[2]
+
+    def load(self):
+        """ Return {moid: {property path: value}} of every cached VM """
+        columns = ", ".join(CACHED_PROPERTIES)
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                f"SELECT moid, {columns} FROM vms WHERE vcenter = ?", (self.vcenter,)
+            ).fetchall()
+        paths = list(CACHED_PROPERTIES.values())
+        return {row[0]: dict(zip(paths, row[1:])) for row in rows}
+
+    def update(self, changes, collector, version, replace=False):
+        """Store changes, {moid: {property path: value} or None when removed}
+
+        replace=True drops every cached VM first, for a full inventory read
+        """
+        columns = list(CACHED_PROPERTIES)
+        with closing(self._connect()) as db, db:
+            if replace:
+                db.execute("DELETE FROM vms WHERE vcenter = ?", (self.vcenter,))
+            for moid, props in changes.items():
+                if props is None:
+                    db.execute(
+                        "DELETE FROM vms WHERE vcenter = ? AND moid = ?", (self.vcenter, moid)
+                    )
+                    continue
+                db.execute(
+                    "INSERT OR IGNORE INTO vms (vcenter, moid) VALUES (?, ?)", (self.vcenter, moid)
+                )
+                for column in columns:
+                    if CACHED_PROPERTIES[column] in props:
+                        value = props[CACHED_PROPERTIES[column]]
+                        db.execute(
+                            f"UPDATE vms SET {column} = ? WHERE vcenter = ? AND moid = ?",
+                            (None if value is None else str(value), self.vcenter, moid),
+                        )
+            db.execute(
+                "INSERT OR REPLACE INTO inventories (vcenter, refreshed, collector, version) "
+                "VALUES (?, ?, ?, ?)",
+                (self.vcenter, time(), collector, version),
+            )
+        debug(f"Cached {len(changes)} VM changes for {self.vcenter}")
+
+    def remove(self, moids):
+        """Drop the VMs of moids, found deleted outside of a refresh
+
+        The collector version is kept, so the next incremental refresh still sees every change
+        """
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                "DELETE FROM vms WHERE vcenter = ? AND moid = ?",
+                [(self.vcenter, moid) for moid in moids],
+            )
+        debug(f"Removed {len(moids)} deleted VMs from the {self.vcenter} cache")
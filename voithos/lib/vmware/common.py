@@ -1,6 +1,11 @@
 """ Common funnctions for VMware lib """
 import os
 
+from pyVmomi import vim, vmodl
+
+
+PROPERTY_PAGE_SIZE = 1000  # objects per PropertyCollector round trip
+
 
 def debug(msg):
     """ Print a debug message when VMWARE_DEBUG = 'true' """
@@ -8,3 +13,115 @@ def debug(msg):
     if env_var not in os.environ or os.environ[env_var] != "true":
         return
     print(f"VMWARE_DEBUG: {msg}")
+
+
+def iter_properties(conn, obj_type, path_set, objs=None, missing=None):
+    """Yield (managed object, {property path: value}) for each obj_type object in vCenter
+
+    Only the properties in path_set are fetched, PROPERTY_PAGE_SIZE objects per round trip.
+    When objs is given only those objects are read, else a ContainerView of the whole
+    inventory is used. Properties vCenter can't return (ex: an orphaned VM's config) are absent.
+    Objects of objs that vCenter no longer has, ex: read from a stale cache, are skipped and
+    appended to the missing list when given.
+    """
+    content = conn.content
+    collector = content.propertyCollector
+    query = vmodl.query.PropertyCollector
+    view = None
+    if objs is None:
+        view = content.viewManager.CreateContainerView(content.rootFolder, [obj_type], True)
+        traversal = query.TraversalSpec(
+            name="traverseView", path="view", skip=False, type=vim.view.ContainerView
+        )
+        obj_specs = [query.ObjectSpec(obj=view, skip=True, selectSet=[traversal])]
+    else:
+        objs = list(objs)
+        obj_specs = [query.ObjectSpec(obj=obj, skip=False) for obj in objs]
+    options = query.RetrieveOptions(maxObjects=PROPERTY_PAGE_SIZE)
+    try:
+        while True:
+            if not obj_specs:
+                return
+            filter_spec = query.FilterSpec(
+                objectSet=obj_specs, propSet=[query.PropertySpec(type=obj_type, pathSet=path_set)]
+            )
+            try:
+                result = collector.RetrievePropertiesEx([filter_spec], options)
+                break
+            except vmodl.fault.ManagedObjectNotFound as fault:
+                # One bad object fails the whole request - drop it and ask again
+                if view is not None or fault.obj not in objs:
+                    raise
+                debug(f"{fault.obj} no longer exists, skipping it")
+                objs.remove(fault.obj)
+                obj_specs = [spec for spec in obj_specs if spec.obj != fault.obj]
+                if missing is not None:
+                    missing.append(fault.obj)
+        while result is not None:
+            debug(f"PropertyCollector returned {len(result.objects)} {obj_type.__name__} objects")
+            for obj_content in result.objects:
+                yield obj_content.obj, {prop.name: prop.val for prop in obj_content.propSet}
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        if view is not None:
+            view.Destroy()
+
+
+def retrieve_properties(conn, obj_type, path_set, objs=None, missing=None):
+    """ Return {managed object: {property path: value}} - see iter_properties """
+    return dict(iter_properties(conn, obj_type, path_set, objs=objs, missing=missing))
+
+
+def create_inventory_collector(conn, obj_type, path_set):
+    """Return a new PropertyCollector with a filter on path_set of every obj_type object
+
+    The collector belongs to the vCenter session and reports changes through collect_updates
+    for as long as that session lives.
+    """
+    content = conn.content
+    query = vmodl.query.PropertyCollector
+    collector = content.propertyCollector.CreatePropertyCollector()
+    # The view is left alive, the filter traverses it on every update
+    view = content.viewManager.CreateContainerView(content.rootFolder, [obj_type], True)
+    traversal = query.TraversalSpec(
+        name="traverseView", path="view", skip=False, type=vim.view.ContainerView
+    )
+    filter_spec = query.FilterSpec(
+        objectSet=[query.ObjectSpec(obj=view, skip=True, selectSet=[traversal])],
+        propSet=[query.PropertySpec(type=obj_type, pathSet=path_set)],
+    )
+    collector.CreateFilter(filter_spec, partialUpdates=True)
+    return collector
+
+
+def collect_updates(collector, version=""):
+    """Return (new version, {managed object: changes}) for what changed since version
+
+    An empty version returns every object. changes is None for objects that left the
+    inventory, else {property path: value} holding only the properties that changed.
+    Never blocks - vCenter answers right away when nothing changed.
+    """
+    options = vmodl.query.PropertyCollector.WaitOptions(
+        maxWaitSeconds=0, maxObjectUpdates=PROPERTY_PAGE_SIZE
+    )
+    updates = {}
+    while True:
+        update_set = collector.WaitForUpdatesEx(version, options)
+        if update_set is None:
+            break
+        version = update_set.version
+        for filter_update in update_set.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                if obj_update.kind == "leave":
+                    updates[obj_update.obj] = None
+                    continue
+                props = updates.get(obj_update.obj) or {}
+                for change in obj_update.changeSet or []:
+                    props[change.name] = None if change.op == "remove" else change.val
+                updates[obj_update.obj] = props
+        if not update_set.truncated:
+            break
+    debug(f"PropertyCollector reported {len(updates)} changed objects")
+    return version, updates
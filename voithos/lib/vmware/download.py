@@ -0,0 +1,432 @@
+""" Stream VMDK files out of an NFC export lease over HTTP """
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event
+from time import sleep
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.targets import open_target
+from voithos.lib.vmware.vmdk import StreamOptimizedReader
+
+
+BLOCK_SIZE = 4096
+BUFFER_SIZE = 1024 * 1024 * 8  # 8 MB - always a multiple of BLOCK_SIZE
+RANGE_CHUNK_SIZE = 1024 * 1024 * 256  # 256 MB per Range request when downloading in parallel
+CHECKPOINT_SIZE = 1024 * 1024 * 256  # journal a streamed download every 256 MB
+MAX_RETRIES = 5
+TIMEOUT = (30, 300)  # (connect, read) seconds
+
+
+class VMWareDownloadFailed(Exception):
+    """ A disk could not be downloaded, even after retrying """
+
+
+def get_session(cookies, pool_size=4):
+    """Return a requests session for NFC transfers
+
+    The connection pool is sized so pool_size concurrent streams never wait on a connection
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # ESXi hosts serve NFC with self-signed certificates
+    session.verify = False
+    session.cookies.update(cookies)
+    return session
+
+
+def read_into(raw, view):
+    """ Fill view from a raw response, return the number of bytes read (less than len at EOF) """
+    filled = 0
+    while filled < len(view):
+        count = raw.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+def stream_download(
+    session,
+    url,
+    file_path,
+    callback=None,
+    retries=MAX_RETRIES,
+    journal=None,
+    digests=None,
+    writer=None,
+    resumed=None,
+):
+    """Stream url into file_path, return the number of bytes written
+
+    callback(num_bytes) is called after every buffer received lands on disk. resumed(num_bytes)
+    is called with the bytes a journal already has on disk, and if the server ignores a resume
+    request and the file restarts from zero, with the negative byte count thrown away.
+    resumed defaults to callback. With a journal, the file resumes after its completed prefix and a
+    checkpoint is recorded every CHECKPOINT_SIZE bytes. Every buffer written is also fed to
+    digests, a voithos.lib.vmware.manifest.ChunkDigests, when given. With a writer, a
+    voithos.lib.vmware.sparse.SparseWriter, all-zero blocks are left as holes.
+    """
+    view = memoryview(bytearray(BUFFER_SIZE))
+    written = journal.prefix_bytes if journal is not None else 0
+    if digests is not None:
+        # Resume at a chunk boundary, the digest of a partial chunk wasn't kept
+        written -= written % digests.chunk_size
+    checkpoint = written
+    attempt = 0
+    resumed = resumed if resumed is not None else callback
+    if written and resumed is not None:
+        resumed(written)
+    # unbuffered: each write is one full BUFFER_SIZE block straight from our own buffer
+    with open(file_path, "r+b" if written else "wb", buffering=0) as file_:
+        file_.seek(written)
+        if writer is not None:
+            # Everything after the resume point is rewritten, so it can be a hole
+            file_.truncate()
+        while True:
+            headers = {"Range": f"bytes={written}-"} if written else {}
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+                    resp.raise_for_status()
+                    if written and resp.status_code != 206:
+                        debug(f"{url} does not support Range, restarting {file_path}")
+                        file_.seek(0)
+                        file_.truncate()
+                        if resumed is not None:
+                            resumed(-written)
+                        if journal is not None:
+                            journal.reset()
+                        if digests is not None:
+                            digests.reset()
+                        written = checkpoint = 0
+                    if journal is not None:
+                        total = _get_total_size(resp, written)
+                        if total is not None:
+                            journal.size = total
+                    while True:
+                        count = read_into(resp.raw, view)
+                        if not count:
+                            break
+                        if writer is not None:
+                            writer.pwrite(file_.fileno(), view[:count], written)
+                            file_.seek(written + count)
+                        else:
+                            file_.write(view[:count])
+                        if digests is not None:
+                            digests.update(written, view[:count])
+                        written += count
+                        if callback is not None:
+                            callback(count)
+                        if journal is not None and written - checkpoint >= CHECKPOINT_SIZE:
+                            _checkpoint(file_, journal, checkpoint, written, digests)
+                            checkpoint = written
+                # A resumed file can be longer than the data that was actually sent
+                file_.truncate()
+                if digests is not None:
+                    digests.set_size(written)
+                if journal is not None and written > checkpoint:
+                    _checkpoint(file_, journal, checkpoint, written, digests)
+                return written
+            except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as exc:
+                attempt += 1
+                if attempt > retries:
+                    raise VMWareDownloadFailed(
+                        f"ERROR: Failed to download {url} after {retries} retries: {exc}"
+                    )
+                debug(f"Download of {url} interrupted at {written} bytes ({exc}), retry {attempt}")
+                sleep(attempt)
+
+
+def _checkpoint(file_, journal, start, end, digests=None):
+    """ Flush bytes start to end-1 to stable storage, then record them in the journal """
+    os.fsync(file_.fileno())
+    journal.add(start, end - 1, digests=digests.snapshot() if digests is not None else None)
+
+
+def _get_total_size(resp, offset):
+    """ Return the full size of a response's file that starts at offset, None if unknown """
+    if resp.status_code == 206:
+        total = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get("Content-Length", "")
+    return offset + int(length) if length.isdigit() else None
+
+
+def get_range_size(session, url):
+    """ Return the total size of url if the server honours Range requests, else None """
+    try:
+        headers = {"Range": "bytes=0-0"}
+        with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+            if resp.status_code != 206:
+                return None
+            # Content-Range looks like: bytes 0-0/1234567
+            total = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            return int(total) if total.isdigit() else None
+    except requests.RequestException:
+        return None
+
+
+def split_ranges(size, chunk_size=RANGE_CHUNK_SIZE):
+    """ Return a list of inclusive (start, end) byte ranges covering size bytes """
+    return [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+
+
+def download_range(
+    session,
+    url,
+    fd,
+    start,
+    end,
+    callback=None,
+    retries=MAX_RETRIES,
+    digests=None,
+    writer=None,
+    stop=None,
+):
+    """Fetch bytes start-end (inclusive) of url and pwrite them to the same offsets of fd
+
+    Every buffer written is also fed to digests when given. A writer (see stream_download)
+    writes the buffers instead of os.pwrite, skipping zeros only if the range is a hole in fd.
+    Once stop, a threading.Event, is set the range gives up between buffers and retries.
+    """
+    view = memoryview(bytearray(BUFFER_SIZE))
+    offset = start
+    attempt = 0
+    while offset <= end:
+        _check_stop(stop, url, start, end)
+        headers = {"Range": f"bytes={offset}-{end}"}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise VMWareDownloadFailed(f"ERROR: {url} stopped honouring Range requests")
+                while offset <= end:
+                    _check_stop(stop, url, start, end)
+                    count = read_into(resp.raw, view[: min(BUFFER_SIZE, end - offset + 1)])
+                    if not count:
+                        break
+                    if writer is not None:
+                        writer.pwrite(fd, view[:count], offset)
+                    else:
+                        os.pwrite(fd, view[:count], offset)
+                    if digests is not None:
+                        digests.update(offset, view[:count])
+                    offset += count
+                    if callback is not None:
+                        callback(count)
+            if offset <= end:
+                raise urllib3.exceptions.ProtocolError(f"short read, stopped at byte {offset}")
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as exc:
+            attempt += 1
+            if attempt > retries:
+                raise VMWareDownloadFailed(
+                    f"ERROR: Failed to download {url} bytes {start}-{end}: {exc}"
+                )
+            debug(f"Range {start}-{end} of {url} interrupted at {offset} ({exc}), retry {attempt}")
+            if stop is not None:
+                stop.wait(attempt)
+            else:
+                sleep(attempt)
+
+
+def _check_stop(stop, url, start, end):
+    """ Raise VMWareDownloadFailed if stop is set """
+    if stop is not None and stop.is_set():
+        raise VMWareDownloadFailed(f"ERROR: Download of {url} bytes {start}-{end} was cancelled")
+
+
+def ranged_download(
+    session,
+    url,
+    file_path,
+    size,
+    connections,
+    callback=None,
+    journal=None,
+    digests=None,
+    writer=None,
+    resumed=None,
+    retries=MAX_RETRIES,
+):
+    """Download url into file_path using up to connections parallel Range requests
+
+    The file is preallocated sparse to its final size, so each range lands at its own offset.
+    With a journal, only the ranges it does not list as complete are fetched, and their bytes
+    are reported to resumed(num_bytes), else callback, instead of as received.
+    With digests, ranges are aligned to its chunks so each range hashes whole chunks.
+    A writer only skips zero blocks in a new file - a resumed one may hold stale data.
+    Each range is retried up to retries times. The first range that fails for good cancels
+    the others, and its error is raised.
+    """
+    if journal is not None:
+        if journal.size is not None and journal.size != size:
+            # The journal describes a different file - start over
+            journal.reset(size=size)
+            if digests is not None:
+                digests.reset()
+        # A single-stream journal may not know the size, its completed prefix still holds
+        journal.size = size
+    resume = journal is not None and journal.completed_bytes > 0
+    chunk_size = RANGE_CHUNK_SIZE
+    if digests is not None:
+        digests.set_size(size)
+        chunk_size = digests.chunk_size
+    ranges = split_ranges(size, chunk_size)
+    if resume:
+        ranges = [(start, end) for start, end in ranges if not journal.is_done(start, end)]
+        debug(f"Resuming {file_path}: {len(ranges)} ranges left to download")
+        resumed = resumed if resumed is not None else callback
+        if resumed is not None:
+            resumed(journal.completed_bytes)
+    flags = os.O_WRONLY | os.O_CREAT | (0 if resume else os.O_TRUNC)
+    fd = os.open(file_path, flags, 0o644)
+    if writer is not None and resume:
+        writer = writer.dense()
+    stop = Event()
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            futures = [
+                pool.submit(
+                    _download_journaled_range,
+                    session,
+                    url,
+                    fd,
+                    rng,
+                    callback,
+                    journal,
+                    digests,
+                    writer,
+                    stop,
+                    retries,
+                )
+                for rng in ranges
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Don't hold the lease while queued ranges retry a download that already failed
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+    return size
+
+
+def _download_journaled_range(
+    session,
+    url,
+    fd,
+    rng,
+    callback,
+    journal,
+    digests=None,
+    writer=None,
+    stop=None,
+    retries=MAX_RETRIES,
+):
+    """ Download one range, then record it once it is on stable storage """
+    start, end = rng
+    download_range(
+        session,
+        url,
+        fd,
+        start,
+        end,
+        callback=callback,
+        retries=retries,
+        digests=digests,
+        writer=writer,
+        stop=stop,
+    )
+    if journal is not None:
+        os.fsync(fd)
+        journal.add(start, end, digests=digests.snapshot() if digests is not None else None)
+
+
+def download_disk(
+    session,
+    url,
+    file_path,
+    connections=1,
+    callback=None,
+    journal=None,
+    digests=None,
+    writer=None,
+    resumed=None,
+):
+    """Download url to file_path, over parallel Range requests when connections > 1
+
+    Falls back to a single stream when the NFC endpoint does not honour Range.
+    A journal that is already complete skips the download entirely.
+    callback(num_bytes) counts the bytes received, resumed(num_bytes) those a journal already
+    had on disk - see stream_download.
+    digests, a voithos.lib.vmware.manifest.ChunkDigests, is fed every byte written.
+    writer, a voithos.lib.vmware.sparse.SparseWriter, leaves zero blocks as holes.
+    """
+    if journal is not None and journal.complete:
+        debug(f"{file_path} was already downloaded, skipping")
+        size = journal.completed_bytes
+        resumed = resumed if resumed is not None else callback
+        if resumed is not None:
+            resumed(size)
+        return size
+    size = get_range_size(session, url) if connections > 1 else None
+    if size is not None:
+        debug(f"Downloading {url} over {connections} connections")
+        written = ranged_download(
+            session,
+            url,
+            file_path,
+            size,
+            connections,
+            callback=callback,
+            journal=journal,
+            digests=digests,
+            writer=writer,
+            resumed=resumed,
+        )
+    else:
+        if connections > 1:
+            debug(f"{url} does not support Range requests, using a single stream")
+        written = stream_download(
+            session,
+            url,
+            file_path,
+            callback=callback,
+            journal=journal,
+            digests=digests,
+            writer=writer,
+            resumed=resumed,
+        )
+    if journal is not None:
+        journal.finish()
+    return written
+
+
+def stream_convert(session, url, target_spec, callback=None, writer=None):
+    """Decode a streamOptimized VMDK into target_spec while it downloads, return its capacity
+
+    No VMDK is staged on disk. callback(num_bytes) counts the compressed bytes received.
+    The target writes through writer, a voithos.lib.vmware.sparse.SparseWriter, when given.
+    """
+    with session.get(url, stream=True, timeout=TIMEOUT) as resp:
+        resp.raise_for_status()
+        reader = StreamOptimizedReader(resp.raw, callback=callback)
+        target = open_target(target_spec, reader.capacity, writer=writer)
+        try:
+            for offset, data in reader.iter_grains():
+                target.write_at(offset, data)
+        except BaseException:
+            target.abort()
+            raise
+        target.close()
+    return reader.capacity
@@ -1,18 +1,25 @@
 """ Handle exporting a VMWare VM """
 import os
-import requests
-from datetime import datetime
-from time import sleep, time
+from time import sleep
 from threading import Thread
-from pathlib import Path
 
-from hurry.filesize import size
 from pyVmomi import vim
 
-from voithos.lib.system import run
-
-
-SLEEP_INTERVAL = 30  # seconds
+from voithos.lib.system import error
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.download import download_disk, get_session, stream_convert
+from voithos.lib.vmware.journal import DownloadJournal
+from voithos.lib.vmware.lease import LeaseHeartbeat
+from voithos.lib.vmware.manifest import (
+    DIGEST_CHUNK_SIZE,
+    ChunkDigests,
+    ManifestError,
+    hash_file,
+    write_manifest,
+)
+from voithos.lib.vmware.progress import ProgressTracker, bytes_to_gb
+from voithos.lib.vmware.sparse import SparseWriter
+from voithos.lib.vmware.vmdk import read_capacity
 
 
 class VMWareExportLeaseNotReady(Exception):
@@ -26,16 +33,28 @@ class VMWareOnlineVMCantMigrate(Exception):
 class VMWareExporter:
     """ Object used to wrangle VMWare exports """
 
-    def __init__(self, vmware_mgr, vm, base_dir=None, interval=15):
-        """ Construct the exporter around a VM """
+    def __init__(
+        self,
+        vmware_mgr,
+        vm,
+        base_dir=None,
+        interval=15,
+        connections=1,
+        resume=True,
+        limiter=None,
+        progress_format="human",
+    ):
+        """Construct the exporter around a VM
+
+        Progress is reported every interval seconds (0 disables it) in progress_format, see
+        voithos.lib.vmware.progress. limiter is an optional shared
+        voithos.lib.vmware.scheduler.BandwidthLimiter
+        """
         if vm.runtime.powerState != vim.VirtualMachine.PowerState.poweredOff:
             raise VMWareOnlineVMCantMigrate("ERROR: The VM is on. It must be offline")
         # progress tracking data
-        self.start_ts = int(time())
-        self.last_print = int(time())
         self.interval_seconds = interval
-        self.last_transfered_bytes = 0
-        self.transfered_bytes = 0
+        self.progress = ProgressTracker(vm.config.uuid, interval=interval, output=progress_format)
         # Download data
         self.vm = vm
         self.lease = None
@@ -43,7 +62,10 @@ class VMWareExporter:
         self.base_dir = base_dir if base_dir is not None else os.getcwd()
         self.vmware_mgr = vmware_mgr
         self.chunk_size = 1024 * 1024 * 20  # 20 MB
-        self.percent_transfered = 0
+        self.connections = connections
+        self.resume = resume
+        self.limiter = limiter
+        self.downloads = []
 
     @property
     def disks(self):
@@ -74,6 +96,35 @@ class VMWareExporter:
         """
         return [dev for dev in self.lease.info.deviceUrl if dev.targetId and dev.disk]
 
+    def get_lease_disk_map(self):
+        """Return {lease device key: hardware VirtualDisk} for every disk of the lease
+
+        Lease keys end with the disk's controller, bus and unit numbers, ex:
+        /vm-42/VirtualLsiLogicController0:1 - disks whose keys don't match are paired with the
+        remaining hardware disks in order
+        """
+        devices = self.vm.config.hardware.device
+        disks = [dev for dev in devices if isinstance(dev, vim.vm.device.VirtualDisk)]
+        controllers = {dev.key: dev for dev in devices}
+        by_location = {}
+        for disk in disks:
+            controller = controllers.get(disk.controllerKey)
+            if controller is not None:
+                location = f"{controller._wsdlName}{controller.busNumber}:{disk.unitNumber}"
+                by_location[location] = disk
+        disk_map = {}
+        for dev in self.lease_disks:
+            disk = by_location.get(dev.key.split("/")[-1])
+            if disk is not None:
+                disk_map[dev.key] = disk
+        matched = {id(disk) for disk in disk_map.values()}
+        unmatched = [disk for disk in disks if id(disk) not in matched]
+        for dev in self.lease_disks:
+            if dev.key not in disk_map and unmatched:
+                debug(f"Lease disk {dev.key} matched to a hardware disk by order")
+                disk_map[dev.key] = unmatched.pop(0)
+        return disk_map
+
     @property
     def cookies(self):
         """ Return cookies to initiate the HTTP-based VMDK transfer request """
@@ -96,121 +147,168 @@ class VMWareExporter:
             f"ERROR - NFC lease state {self.lease.state} after {max_retries} retries"
         )
 
-    def download(self):
-        """ Initiate the download process """
-        downloads = []
-        # Start a thread running WGET for each vmdk in parralel
-        gb_total = bytes_to_gb(self.size_in_bytes)
-        print(f"Download {gb_total} GB:")
-        for dev in self.lease_disks:
+    def download(self, targets=None):
+        """Initiate the download process
+
+        When targets is given, each lease disk (in order) is converted to raw while it streams
+        and written straight into its target - see voithos.lib.vmware.targets.open_target
+        """
+        if targets and len(targets) != len(self.lease_disks):
+            self.lease.HttpNfcLeaseAbort()
+            num_disks = len(self.lease_disks)
+            error(f"ERROR: {len(targets)} targets given for {num_disks} disks", exit=True)
+        # human readable output, unless it's been silenced or JSON was asked for
+        verbose = self.interval_seconds and self.progress.output == "human"
+        # Start a streaming download thread for each vmdk in parralel, sharing one session
+        if verbose:
+            print(f"Download {bytes_to_gb(self.size_in_bytes)} GB:")
+        session = get_session(self.cookies, pool_size=len(self.lease_disks) * self.connections)
+        disk_map = self.get_lease_disk_map()
+        for index, dev in enumerate(self.lease_disks):
             # Collect the download paths and filenames
             url = dev.url.replace("*/", f"{self.vmware_mgr.ip_addr}/")
-            file_path = os.path.join(self.base_dir, dev.targetId)
-            print(f"  {file_path} <-- {url}")
-            thread = Thread(target=download_thread, kwargs={"url": url, "file_path": file_path})
-            thread.start()
-            downloads.append(
-                {
-                    "url": url,
-                    "file_path": file_path,
-                    "thread": thread,
-                    "last_size": 0,
-                    "size": 0,
-                    "finished_size_thick": 0,
-                    "finished_size_thin": 0,
-                    "finshed_speed": 0,
-                    "done": False,
-                }
+            target = targets[index] if targets else None
+            file_path = target if target else os.path.join(self.base_dir, dev.targetId)
+            if verbose:
+                print(f"  {file_path} <-- {url}")
+            # Converted streams can't resume part-way, so only VMDK files are journaled
+            journal = None
+            if target is None:
+                journal = DownloadJournal(
+                    file_path,
+                    self.vm.config.uuid,
+                    dev.targetId,
+                    url,
+                    identity=get_disk_identity(self.vm, disk_map.get(dev.key), dev),
+                )
+                if not self.resume:
+                    journal.reset()
+                elif journal.completed_bytes and verbose:
+                    gb_done = bytes_to_gb(journal.completed_bytes)
+                    print(f"    Resuming from checkpoint: {gb_done} GB already downloaded")
+            download = {
+                "url": url,
+                "file_path": file_path,
+                "journal": journal,
+                "target": target,
+                "progress": self.progress.add_disk(file_path, total=dev.fileSize or None),
+                # The hardware disk's size, else read from the VMDK once downloaded
+                "thick_size": disk_map[dev.key].capacityInBytes if dev.key in disk_map else None,
+            }
+            download["thread"] = Thread(
+                target=download_thread,
+                kwargs={
+                    "session": session,
+                    "download": download,
+                    "tracker": self.progress,
+                    "connections": self.connections,
+                    "limiter": self.limiter,
+                },
             )
-        sleep(2)  # Give wget a second to get going
-        print(f"  Starting download ... Progress updates every {SLEEP_INTERVAL} seconds")
-        # Every x seconds, check the file sizes and provide a status update. Also update NFC lease
-        num_downloading_files = len(downloads)
-        elapsed_seconds = 0
-        while num_downloading_files >= 1:
-            # Count the alive threads, when the count is 0 this is the last iteration
-            num_downloading_files = len([dld for dld in downloads if dld["thread"].is_alive()])
-            if num_downloading_files == 0:
-                break  # no need to wait 30 seconds at the end
-            # wait 30 seconds (or whatever SLEEP_INTERVAL is) per check
-            print("")
-            sleep(SLEEP_INTERVAL)
-            elapsed_seconds += SLEEP_INTERVAL
-            print(f"Downloading files: {num_downloading_files}/{len(downloads)} remaining")
-            downloaded_bytes_thick = 0  # re-calc'd each 30 seconds
-            downloaded_bytes_thin = 0
-            for download in downloads:
-                if download["done"]:
-                    # This VMDK download's download completion tasks have been done
-                    # use its "thick size" instead
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    print_download_progress(download, download["finished_size_thick"])
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    continue
-                if not download["thread"].is_alive():
-                    # This download just finished, find its "finished size" and mark it done
-                    download["done"] = True
-                    download["finished_size_thick"] = get_vmdk_thick_size(download["file_path"])
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    download["finished_size_thin"] = Path(download["file_path"]).stat().st_size
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    download["finished_speed"] = round(
-                        downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2
-                    )
-                    print_download_progress(download, download["finished_size_thick"])
-                    continue
-                # {download} is still downloading, find its current progress by checking file size
-                file_size = Path(download["file_path"]).stat().st_size  # (thin size)
-                downloaded_bytes_thick += file_size  # We don't know the real thick size yet
-                downloaded_bytes_thin += file_size
-                download["last_size"] = download["size"]
-                download["size"] = file_size
-                print_download_progress(download, file_size)  # use thin size for progress now
-            self.percent_transfered = int(downloaded_bytes_thick / self.size_in_bytes * 100)
-            self.lease.HttpNfcLeaseProgress(self.percent_transfered)
-            gb_down_thick = bytes_to_gb(downloaded_bytes_thick)
-            print(f"\- Total Downloaded: \t{gb_down_thick} GB / {gb_total} GB - {self.percent_transfered}%")
-            thick_avg_speed_mbs = round(downloaded_bytes_thick / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thick): \t{thick_avg_speed_mbs} MB/s")
-            thin_avg_speed_mbs = round(downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thin): \t{thin_avg_speed_mbs} MB/s")
-        print("Finished download, closing NFC lease")
+            self.downloads.append(download)
+        if verbose:
+            print(f"  Starting download ... Progress updates every {self.interval_seconds} seconds")
+        for download in self.downloads:
+            download["thread"].start()
+        # The lease is renewed by its own thread, however slowly (or quietly) progress is shown
+        heartbeat = LeaseHeartbeat(self.lease, self.lease_percent)
+        heartbeat.start()
+        try:
+            # returns as soon as the last disk finishes
+            self.progress.wait()
+        finally:
+            heartbeat.stop()
+        failed = [dld for dld in self.downloads if dld["progress"].error is not None]
+        if failed:
+            self.lease.HttpNfcLeaseAbort()
+            for download in failed:
+                error(f"  {download['file_path']} - {download['progress'].error}")
+            error("ERROR: Download failed, NFC lease aborted", exit=True)
+        if verbose:
+            print("Finished download, closing NFC lease")
         self.lease.HttpNfcLeaseProgress(100)
         self.lease.HttpNfcLeaseComplete()
 
+    def lease_percent(self):
+        """Return the percentage of this VM's data downloaded so far, for the NFC lease
+
+        Each disk counts in proportion to its size, by the share of its transfer that's done
+        """
+        total = 0
+        done = 0
+        for dld in self.downloads:
+            disk = dld["progress"]
+            size = dld["thick_size"] or disk.total or disk.bytes
+            total += size
+            if disk.done:
+                done += size
+            elif disk.total:
+                done += size * min(disk.bytes / disk.total, 1)
+        if not total:
+            return 0
+        return int(done / total * 100)
+
+
+def get_disk_identity(vm, disk, lease_disk):
+    """Return what identifies the contents of one exported disk, for DownloadJournal
+
+    The backing's contentId changes whenever the disk is written, its changeId too when changed
+    block tracking is on. The VM's changeVersion and the sizes catch a reconfigured VM.
+    """
+    backing = disk.backing if disk is not None else None
+    return {
+        "change_version": vm.config.changeVersion,
+        "content_id": getattr(backing, "contentId", None),
+        "change_id": getattr(backing, "changeId", None),
+        "capacity": disk.capacityInBytes if disk is not None else None,
+        "file_size": lease_disk.fileSize,
+    }
 
-def print_download_progress(download, progress):
-    """ Print the progress of a download """
-    # last interval speed
-    # total speed
-    # path
-    if download["done"]:
-        done = "(DONE)"
-        speed = f"\t[AVG SPEED: {download['finished_speed']} MB/s]"
-    else:
-        done = ""
-        diff = download["size"] - download["last_size"]
-        current_speed = round(diff / 1024 / 1024 / SLEEP_INTERVAL, 2)
-        speed = f"\t[CUR SPEED: {current_speed} MB/s]"
-    size_gb = bytes_to_gb(progress)
-    print(f"  {download['file_path']} - {size_gb} GB {speed} {done}")
-
-
-def download_thread(url, file_path):
-    """ Start a thread to download the file """
-    run(f"wget --quiet --no-check-certificate {url} -O {file_path}")
-
-
-def get_vmdk_thick_size(file_path):
-    """ Return the 'thick' size of a VMDK file in bytes as an integer - requires qemu-utils """
-    qemu_img_lines = run(f"qemu-img info {file_path}")
-    vsize_line = next(line for line in qemu_img_lines if "virtual size" in line)
-    size_bytes = int(vsize_line.split(" ")[-2].replace("(", ""))
-    return size_bytes
-
-
-def bytes_to_gb(qty_bytes):
-    """ Return a GB value of bytes, rounded to 2 decimals """
-    bytes_in_gb = 1024 * 1024 * 1024
-    qty_gb = qty_bytes / bytes_in_gb
-    return round(qty_gb, 2)
+
+def download_thread(session, download, tracker, connections=1, limiter=None):
+    """ Download one disk, reporting every byte written to its progress tracker """
+    disk = download["progress"]
+    count_bytes = tracker.callback(disk)
+    # Zero blocks are left as holes in the output
+    writer = SparseWriter()
+
+    def _callback(num_bytes):
+        # Only bytes received from the network count against the bandwidth budget
+        count_bytes(num_bytes)
+        if limiter is not None and num_bytes > 0:
+            limiter.consume(num_bytes)
+
+    try:
+        if download["target"] is not None:
+            download["thick_size"] = stream_convert(
+                session, download["url"], download["target"], callback=_callback, writer=writer
+            )
+            size = disk.bytes
+        else:
+            journal = download["journal"]
+            digests = ChunkDigests(DIGEST_CHUNK_SIZE, journal.digests if journal else None)
+            size = download_disk(
+                session,
+                download["url"],
+                download["file_path"],
+                connections=connections,
+                callback=_callback,
+                journal=journal,
+                digests=digests,
+                writer=writer,
+                resumed=count_bytes,
+            )
+            try:
+                chunks = digests.finish(size)
+            except ManifestError:
+                # Only a download journaled before digests were kept gets here
+                chunks = hash_file(download["file_path"], DIGEST_CHUNK_SIZE)
+            write_manifest(download["file_path"], size, DIGEST_CHUNK_SIZE, chunks)
+            if download["thick_size"] is None:
+                download["thick_size"] = read_capacity(download["file_path"])
+    except (Exception, SystemExit) as exc:  # pylint: disable=broad-except
+        # Always finish the disk, even on sys.exit from run(), or the tracker waits forever
+        tracker.finish(disk, error=exc)
+        return
+    # Now that it's finished, the transfer's real total is known
+    tracker.finish(disk, total=size, writer=writer if writer.logical_bytes else None)
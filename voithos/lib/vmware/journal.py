@@ -0,0 +1,120 @@
+""" Checkpoint journals that let interrupted VMware exports resume where they stopped """
+import json
+import os
+from pathlib import Path
+from threading import Lock
+
+from voithos.lib.vmware.common import debug
+
+
+class DownloadJournal:
+    """Track the completed byte ranges of one exported disk in a file beside it
+
+    The journal is only trusted when it was written for the same VM UUID and lease disk
+    targetId, the disk's identity is unchanged and the partial disk file it describes still
+    exists. identity is a JSON-able value that changes with the disk's contents, see
+    voithos.lib.vmware.exporter.get_disk_identity.
+    """
+
+    def __init__(self, file_path, vm_uuid, target_id, url, identity=None):
+        """ Load the journal for file_path, or start an empty one """
+        self.file_path = file_path
+        self.path = f"{file_path}.journal"
+        self.vm_uuid = vm_uuid
+        self.target_id = target_id
+        self.url = url
+        self.identity = identity
+        self.size = None
+        self.complete = False
+        self.completed = []  # sorted, merged, inclusive [start, end] byte ranges
+        self.digests = {}  # chunk index -> digest of the chunks completed so far
+        self.lock = Lock()  # ranged downloads record ranges from several threads
+        self.load()
+
+    def load(self):
+        """ Read a matching journal from disk, discarding any that can't be trusted """
+        if not Path(self.path).is_file() or not Path(self.file_path).is_file():
+            return
+        try:
+            with open(self.path) as journal_file:
+                data = json.load(journal_file)
+        except ValueError:
+            debug(f"Ignoring unreadable journal {self.path}")
+            return
+        if data.get("vm_uuid") != self.vm_uuid or data.get("target_id") != self.target_id:
+            debug(f"Ignoring journal {self.path} - it belongs to a different disk")
+            return
+        if data.get("identity") != self.identity:
+            debug(f"Ignoring journal {self.path} - the disk changed since it was written")
+            return
+        self.size = data.get("size")
+        self.complete = data.get("complete", False)
+        self.completed = [list(rng) for rng in data.get("completed", [])]
+        self.digests = data.get("digests", {})
+        debug(f"Loaded journal {self.path}: {self.completed_bytes} bytes already downloaded")
+
+    def save(self):
+        """ Atomically write the journal, the lease URL is kept for troubleshooting only """
+        data = {
+            "vm_uuid": self.vm_uuid,
+            "target_id": self.target_id,
+            "identity": self.identity,
+            "url": self.url,
+            "size": self.size,
+            "complete": self.complete,
+            "completed": self.completed,
+            "digests": self.digests,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as journal_file:
+            json.dump(data, journal_file)
+        os.replace(tmp_path, self.path)
+
+    def reset(self, size=None):
+        """ Forget all progress, used when a download has to start over """
+        with self.lock:
+            self.size = size
+            self.complete = False
+            self.completed = []
+            self.digests = {}
+            self.save()
+
+    def add(self, start, end, digests=None):
+        """Record that bytes start-end (inclusive) are safely on disk
+
+        digests holds the chunk digests known so far, see voithos.lib.vmware.manifest
+        """
+        with self.lock:
+            if digests is not None:
+                self.digests = {str(index): digest for index, digest in digests.items()}
+            ranges = sorted(self.completed + [[start, end]])
+            merged = [ranges[0]]
+            for rng in ranges[1:]:
+                if rng[0] <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], rng[1])
+                else:
+                    merged.append(rng)
+            self.completed = merged
+            self.save()
+
+    def finish(self):
+        """ Mark the disk as fully downloaded """
+        with self.lock:
+            self.complete = True
+            self.save()
+
+    def is_done(self, start, end):
+        """ Return True when bytes start-end are entirely inside one completed range """
+        return any(rng[0] <= start and end <= rng[1] for rng in self.completed)
+
+    @property
+    def completed_bytes(self):
+        """ Return how many bytes have been downloaded so far """
+        return sum(end - start + 1 for start, end in self.completed)
+
+    @property
+    def prefix_bytes(self):
+        """ Return how many contiguous bytes are done from offset 0 - where a stream resumes """
+        if self.completed and self.completed[0][0] == 0:
+            return self.completed[0][1] + 1
+        return 0
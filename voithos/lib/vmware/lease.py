@@ -0,0 +1,40 @@
+""" Keep VMware NFC export leases alive """
+from threading import Event, Thread
+
+from voithos.lib.vmware.common import debug
+
+
+# vCenter times out an NFC lease after 5 minutes without progress updates
+LEASE_HEARTBEAT_INTERVAL = 30  # seconds
+
+
+class LeaseHeartbeat(Thread):
+    """Report progress on an NFC lease on a fixed cadence, independent of any output
+
+    get_percent is called on every beat and returns the percentage to report
+    """
+
+    def __init__(self, lease, get_percent, interval=LEASE_HEARTBEAT_INTERVAL):
+        """ Create the heartbeat, call start() to begin renewing the lease """
+        super().__init__(daemon=True)
+        self.lease = lease
+        self.get_percent = get_percent
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        """ Renew the lease every interval seconds until stopped """
+        while not self.stopped.wait(self.interval):
+            percent = max(0, min(99, int(self.get_percent())))
+            try:
+                self.lease.HttpNfcLeaseProgress(percent)
+                debug(f"NFC lease heartbeat: {percent}%")
+            except Exception as exc:  # pylint: disable=broad-except
+                # A missed beat is retried on the next one, the lease has minutes to spare
+                debug(f"NFC lease heartbeat failed: {exc}")
+
+    def stop(self):
+        """ Stop renewing the lease and wait for the thread to finish """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,156 @@
+""" Digests of exported disks, computed while they stream, and the manifests that record them """
+import hashlib
+import json
+import os
+from threading import Lock
+
+from voithos.lib.vmware.common import debug
+
+
+DIGEST_ALGORITHM = "blake2b"
+DIGEST_SIZE = 32  # bytes
+DIGEST_CHUNK_SIZE = 1024 * 1024 * 256  # 256 MB - equal to download.RANGE_CHUNK_SIZE
+MANIFEST_SUFFIX = ".manifest"
+READ_SIZE = 1024 * 1024 * 8
+
+
+class ManifestError(Exception):
+    """ A disk does not match its manifest, or its digests could not be computed """
+
+
+def _new_hash():
+    """ Return a new digest object """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+class ChunkDigests:
+    """Digests of each chunk_size chunk of a file, fed with its bytes as they are written
+
+    The bytes of any one chunk must arrive in order, but different chunks can be fed from
+    different threads - as ranged downloads do. Completed chunk digests are in self.digests,
+    keyed by chunk index, so they can be journaled and restored with a resumed download.
+    """
+
+    def __init__(self, chunk_size=DIGEST_CHUNK_SIZE, digests=None, size=None):
+        """ Start from the already-completed digests, for a file of size bytes when known """
+        self.chunk_size = chunk_size
+        self.size = size
+        self.digests = {int(index): digest for index, digest in (digests or {}).items()}
+        self.partial = {}  # chunk index -> [digest object, next expected offset]
+        self.lock = Lock()
+
+    def _chunk_end(self, index):
+        """ Return the offset after the last byte of chunk index """
+        end = (index + 1) * self.chunk_size
+        return end if self.size is None else min(end, self.size)
+
+    def update(self, offset, data):
+        """ Add data, written at byte offset, to the digests of the chunks it falls in """
+        view = memoryview(data)
+        while len(view):
+            index = offset // self.chunk_size
+            length = min(len(view), (index + 1) * self.chunk_size - offset)
+            with self.lock:
+                state = self.partial.pop(index, None)
+            if state is None:
+                if offset != index * self.chunk_size:
+                    raise ManifestError(f"ERROR: Chunk {index} was not written from its start")
+                state = [_new_hash(), offset]
+            elif state[1] != offset:
+                raise ManifestError(f"ERROR: Chunk {index} was written out of order at {offset}")
+            state[0].update(view[:length])
+            state[1] += length
+            with self.lock:
+                if state[1] == self._chunk_end(index):
+                    self.digests[index] = state[0].hexdigest()
+                else:
+                    self.partial[index] = state
+            offset += length
+            view = view[length:]
+
+    def snapshot(self):
+        """ Return a copy of the completed chunk digests, safe to save while chunks complete """
+        with self.lock:
+            return dict(self.digests)
+
+    def reset(self):
+        """ Forget everything, for a download that starts over """
+        with self.lock:
+            self.digests = {}
+            self.partial = {}
+
+    def set_size(self, size):
+        """ Set the file's final size, completing its last chunk if all its bytes were fed """
+        with self.lock:
+            self.size = size
+            for index, state in list(self.partial.items()):
+                if state[1] == self._chunk_end(index):
+                    self.digests[index] = state[0].hexdigest()
+                    del self.partial[index]
+
+    def finish(self, size):
+        """ Complete the final chunk of a size byte file, return the ordered list of digests """
+        self.set_size(size)
+        with self.lock:
+            num_chunks = -(-size // self.chunk_size)
+            missing = [index for index in range(num_chunks) if index not in self.digests]
+            if missing:
+                raise ManifestError(f"ERROR: No digest for chunks {missing}")
+            return [self.digests[index] for index in range(num_chunks)]
+
+
+def hash_file(file_path, chunk_size=DIGEST_CHUNK_SIZE):
+    """ Return the ordered chunk digests of file_path, reading it from start to end """
+    digests = ChunkDigests(chunk_size)
+    offset = 0
+    view = memoryview(bytearray(READ_SIZE))
+    with open(file_path, "rb", buffering=0) as file_:
+        while True:
+            count = file_.readinto(view)
+            if not count:
+                break
+            digests.update(offset, view[:count])
+            offset += count
+    return digests.finish(offset)
+
+
+def get_manifest_path(file_path):
+    """ Return the path of the manifest of file_path """
+    return f"{file_path}{MANIFEST_SUFFIX}"
+
+
+def write_manifest(file_path, size, chunk_size, digests):
+    """ Atomically write the manifest of file_path beside it """
+    data = {
+        "file": os.path.basename(file_path),
+        "size": size,
+        "algorithm": DIGEST_ALGORITHM,
+        "chunk_size": chunk_size,
+        "chunks": digests,
+    }
+    manifest_path = get_manifest_path(file_path)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(data, manifest_file)
+    os.replace(tmp_path, manifest_path)
+    debug(f"Wrote manifest {manifest_path}: {len(digests)} chunks")
+
+
+def verify_manifest(file_path):
+    """ Raise ManifestError unless file_path exists and matches its manifest """
+    manifest_path = get_manifest_path(file_path)
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as exc:
+        raise ManifestError(f"ERROR: Can't read manifest {manifest_path}: {exc}")
+    if manifest.get("algorithm") != DIGEST_ALGORITHM:
+        raise ManifestError(f"ERROR: Unsupported manifest algorithm {manifest.get('algorithm')}")
+    size = os.path.getsize(file_path)
+    if size != manifest["size"]:
+        raise ManifestError(f"ERROR: {file_path} is {size} bytes, expected {manifest['size']}")
+    digests = hash_file(file_path, manifest["chunk_size"])
+    bad = [index for index, digest in enumerate(digests) if digest != manifest["chunks"][index]]
+    if bad:
+        offsets = [index * manifest["chunk_size"] for index in bad]
+        raise ManifestError(f"ERROR: {file_path} is corrupt in the chunks at offsets {offsets}")
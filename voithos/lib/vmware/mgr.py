@@ -4,10 +4,32 @@ import os
 import ssl
 
 from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 from voithos.lib.system import error
-from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.cache import InventoryCache, get_cache_ttl
+from voithos.lib.vmware.common import (
+    collect_updates,
+    create_inventory_collector,
+    debug,
+    retrieve_properties,
+)
+from voithos.lib.vmware.session import (
+    SSL_STRATEGIES,
+    SessionCache,
+    get_ssl_context,
+    is_session_cache_enabled,
+)
+
+
+# The only VM properties voithos reads from the inventory, fetched in bulk
+VM_PROPERTIES = ["name", "config.uuid", "runtime.powerState"]
+NGRAM_SIZE = 3  # VM name substring index granularity
+
+
+def _ngrams(text):
+    """ Return the set of NGRAM_SIZE-character substrings of text """
+    return {text[i : i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
 
 
 def _environ(name, value=None):
@@ -24,6 +46,16 @@ def _environ(name, value=None):
     return os.environ[name]
 
 
+def get_ip_addrs(ip_addrs=None):
+    """Return the list of vCenter addresses to connect to
+
+    ip_addrs is used when given, else the comma-separated VMWARE_IP_ADDR env var
+    """
+    if ip_addrs:
+        return list(ip_addrs)
+    return [addr.strip() for addr in _environ("VMWARE_IP_ADDR").split(",") if addr.strip()]
+
+
 def _get_ssl_error():
     """ Different versions of Python (3.6 vs 3.8) throw different SSL exceptions """
     if hasattr(ssl, "SSLCertVerificationError"):
@@ -35,69 +67,208 @@ def _get_ssl_error():
 class VMWareMgr:
     """ Object used to manage VMWare interactions """
 
-    def __init__(self, username=None, password=None, ip_addr=None):
-        """ Constructor the exporter, loading creds from env vars if needed """
+    def __init__(self, username=None, password=None, ip_addr=None, cache_ttl=None):
+        """Constructor the exporter, loading creds from env vars if needed
+
+        The inventory is cached on disk for cache_ttl seconds (default: get_cache_ttl()),
+        0 always reads it from vCenter
+        """
         self.username = _environ("VMWARE_USERNAME", username)
         self.password = _environ("VMWARE_PASSWORD", password)
-        self.ip_addr = _environ("VMWARE_IP_ADDR", ip_addr)
+        ip_addrs = get_ip_addrs([ip_addr] if ip_addr else None)
+        if len(ip_addrs) != 1:
+            # VMWARE_IP_ADDR can list several vCenters, which only show-vm can query at once
+            error(
+                f"ERROR: This command needs exactly one vCenter, got {ip_addrs} - "
+                "pass one with --ip-addr",
+                exit=True,
+            )
+        self.ip_addr = ip_addrs[0]
+        self.cache_ttl = get_cache_ttl() if cache_ttl is None else cache_ttl
+        # Opened by load_vms(), commands that never read the inventory don't touch it
+        self.cache = None
+        # Sessions are left logged in for the next command unless the session cache is off
+        self.sessions = SessionCache() if is_session_cache_enabled() else None
         self.conn = None
         self.connect()
-        self.vms = []
-        self.load_vms()
+        # The inventory is only loaded once a command needs it - see the vms property
+        self._vms = None
+        self.vm_props = {}
+        self.vms_by_uuid = {}
+        self.vms_by_name = {}
+        self.name_ngrams = {}
 
     conn = None  # Required for __del__
+    sessions = None
 
     def __del__(self):
-        """ Clean up the conenction when the object is GC'd """
-        connect.Disconnect(self.conn)
+        """ Clean up the conenction when the object is GC'd, unless its session is cached """
+        if self.sessions is None:
+            connect.Disconnect(self.conn)
+
+    @property
+    def session_key(self):
+        """ Return the session cache key of this user on this vCenter """
+        return f"{self.username}@{self.ip_addr}"
 
     def connect(self):
-        """ Connect to the configured VMWare service & set self.conn """
+        """Connect to the configured VMWare service & set self.conn
+
+        A cached session is reused while vCenter still accepts it, else a new one is logged in
+        to, trying the SSL strategy that last worked on this host first
+        """
+        cached = self.sessions.get(self.session_key) if self.sessions is not None else {}
+        if cached.get("cookie") and self.resume_session(cached["cookie"], cached.get("ssl")):
+            return
+        ssl_strategy = self.login(preferred_ssl=cached.get("ssl"))
+        if self.sessions is not None:
+            self.sessions.set(self.session_key, cookie=self.conn._stub.cookie, ssl=ssl_strategy)
+
+    def resume_session(self, cookie, ssl_strategy):
+        """ Set self.conn to the session of cookie and return True, or False if it expired """
+        debug(f"Resuming cached session - SSL strategy {ssl_strategy}")
         try:
-            SSLVerificationError = _get_ssl_error()
-            try:
-                debug("Connecting with SmartConnect - regular SSL")
-                self.conn = connect.SmartConnect(
-                    host=self.ip_addr, user=self.username, pwd=self.password
-                )
-            except SSLVerificationError:
+            stub = connect.SmartStubAdapter(
+                host=self.ip_addr, sslContext=get_ssl_context(ssl_strategy)
+            )
+            stub.cookie = cookie
+            service_instance = vim.ServiceInstance("ServiceInstance", stub)
+            if service_instance.content.sessionManager.currentSession is None:
+                debug("Cached session has expired")
+                return False
+        except (vmodl.MethodFault, OSError) as exc:
+            debug(f"Cached session can't be used: {exc}")
+            return False
+        self.conn = service_instance
+        debug("Connection successful - cached session")
+        return True
+
+    def login(self, preferred_ssl=None):
+        """ Log in to a new session with SmartConnect & set self.conn, return the SSL strategy """
+        SSLVerificationError = _get_ssl_error()
+        strategies = sorted(SSL_STRATEGIES, key=lambda strategy: strategy != preferred_ssl)
+        try:
+            for strategy in strategies:
                 try:
-                    ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-                    ctx.verify_mode = ssl.CERT_NONE
-                    debug("Connecting with SmartConnec - TLSv1 and verify off")
+                    debug(f"Connecting with SmartConnect - SSL strategy {strategy}")
                     self.conn = connect.SmartConnect(
-                        host=self.ip_addr, user=self.username, pwd=self.password, sslContext=ctx
-                    )
-                except (ssl.SSLEOFError, OSError):
-                    debug("Connecting with SmartConnectNoSSL")
-                    self.conn = connect.SmartConnectNoSSL(
-                        host=self.ip_addr, user=self.username, pwd=self.password
+                        host=self.ip_addr,
+                        user=self.username,
+                        pwd=self.password,
+                        sslContext=get_ssl_context(strategy),
                     )
+                    debug("Connection successful")
+                    return strategy
+                except (SSLVerificationError, ssl.SSLEOFError, OSError) as exc:
+                    debug(f"SSL strategy {strategy} failed: {exc}")
         except vim.fault.InvalidLogin:
             error(f"ERROR: Invalid login for VMware server {self.ip_addr}", exit=True)
-        debug("Connection successful")
+        error(f"ERROR: Failed to connect to VMware server {self.ip_addr}", exit=True)
+
+    @property
+    def vms(self):
+        """ Return every VM in the inventory, loading it on first use """
+        if self._vms is None:
+            self.load_vms()
+        return self._vms
+
+    @property
+    def inventory_loaded(self):
+        """ Return True once the full inventory has been loaded """
+        return self._vms is not None
 
-    def load_vms(self, entity=None):
-        """Return a list of each VM from all datacenters connected to self.conn
-        This function is recursive, since the VMs can be in a tree-like directory structure
+    def load_vms(self):
+        """Load each VM from all datacenters connected to self.conn
+
+        A ContainerView over the whole inventory is read by the PropertyCollector, so every
+        VM and the VM_PROPERTIES voithos uses arrive in a few paged round trips.
+        With the cache enabled, see load_cached_vms.
         """
-        if entity is None:
-            debug("Starting recursive VM search")
-            self.load_vms(entity=self.conn.content.rootFolder)
-            return
-        if isinstance(entity, vim.VirtualMachine):
-            debug(f"VM:         {entity}  -  {entity.name}")
-            self.vms.append(entity)
-            return
-        if isinstance(entity, vim.Folder):
-            debug(f"FOLDER:     {entity}  -  {entity.name}")
-        if isinstance(entity, vim.Datacenter):
-            debug(f"DATACENTER: {entity}  -  {entity.name}")
-        if hasattr(entity, "vmFolder"):
-            self.load_vms(entity.vmFolder)
-        if hasattr(entity, "childEntity"):
-            for child in entity.childEntity:
-                self.load_vms(child)
+        if self.cache is None and self.cache_ttl:
+            self.cache = InventoryCache(self.session_key, ttl=self.cache_ttl)
+        if self.cache is not None:
+            self.load_cached_vms()
+        else:
+            debug("Starting bulk VM inventory fetch")
+            self.vm_props = retrieve_properties(self.conn, vim.VirtualMachine, VM_PROPERTIES)
+        self._vms = list(self.vm_props)
+        self.index_vms()
+        debug(f"Loaded {len(self._vms)} VMs")
+
+    def load_cached_vms(self):
+        """Set self.vm_props from the on-disk cache, refreshing it first when stale
+
+        A fresh cache is used without asking vCenter. A stale one is updated with only the
+        VMs that changed since the collector version it was read at, when that collector still
+        exists in this session. Otherwise the whole inventory is read into a new collector.
+        """
+        state = self.cache.get_state()
+        if state is None or state[0] >= self.cache.ttl:
+            self.refresh_cache(state)
+        else:
+            debug(f"Using cached inventory, {int(state[0])}s old")
+        self.vm_props = {
+            vim.VirtualMachine(moid, self.conn._stub): props
+            for moid, props in self.cache.load().items()
+        }
+
+    def refresh_cache(self, state=None):
+        """ Bring the inventory cache up to date, incrementally when possible """
+        if state is not None and state[1]:
+            collector = vmodl.query.PropertyCollector(state[1], self.conn._stub)
+            try:
+                version, updates = collect_updates(collector, state[2])
+                debug(f"Incremental inventory refresh: {len(updates)} VMs changed")
+                self._cache_updates(updates, state[1], version)
+                return
+            except vmodl.MethodFault as exc:
+                # The collector ended with the session it was created in
+                debug(f"Can't refresh the inventory incrementally: {exc.msg}")
+        debug("Starting full VM inventory fetch into a new PropertyCollector")
+        collector = create_inventory_collector(self.conn, vim.VirtualMachine, VM_PROPERTIES)
+        version, updates = collect_updates(collector)
+        self._cache_updates(updates, collector._moId, version, replace=True)
+
+    def _cache_updates(self, updates, collector_id, version, replace=False):
+        """ Write PropertyCollector updates to the cache """
+        changes = {vm._moId: props for vm, props in updates.items()}
+        self.cache.update(changes, collector_id, version, replace=replace)
+
+    def forget_vms(self, vms):
+        """ Drop vms, found deleted from vCenter, from the loaded inventory and its cache """
+        debug(f"Forgetting {len(vms)} deleted VMs")
+        for vm in vms:
+            self.vm_props.pop(vm, None)
+        if self._vms is not None:
+            self._vms = list(self.vm_props)
+        self.index_vms()
+        if self.cache is not None:
+            self.cache.remove([vm._moId for vm in vms])
+
+    def index_vms(self):
+        """Build the in-memory lookup tables from self.vm_props:
+        UUID -> VM, name -> [VMs], and name n-gram -> {names} for substring searches
+        """
+        self.vms_by_uuid = {}
+        self.vms_by_name = {}
+        self.name_ngrams = {}
+        for vm, props in self.vm_props.items():
+            if props.get("config.uuid"):
+                self.vms_by_uuid[props["config.uuid"]] = vm
+            self.vms_by_name.setdefault(props.get("name", ""), []).append(vm)
+        for name in self.vms_by_name:
+            for ngram in _ngrams(name):
+                self.name_ngrams.setdefault(ngram, set()).add(name)
+
+    def _names_containing(self, text):
+        """ Return the set of VM names that contain text, using the n-gram index """
+        if len(text) < NGRAM_SIZE:
+            return {name for name in self.vms_by_name if text in name}
+        # Only names holding every n-gram of text can match, start from the rarest n-gram
+        candidates = sorted(
+            (self.name_ngrams.get(ngram, set()) for ngram in _ngrams(text)), key=len
+        )
+        return {name for name in set.intersection(*candidates) if text in name}
 
     def find_vms_by_name(self, names):
         """Return a list of VMs who's names contain any element found in names.
@@ -105,8 +276,19 @@ class VMWareMgr:
         """
         if "*" in names:
             return self.vms
-        return (vm for vm in self.vms if any(name in vm.name for name in names))
+        if not self.inventory_loaded:
+            self.load_vms()
+        matches = set()
+        for name in names:
+            matches.update(self._names_containing(name))
+        return [vm for name in sorted(matches) for vm in self.vms_by_name[name]]
 
     def find_vm_by_uuid(self, uuid):
-        """ Return a single VM with a given UUID, or None """
-        return next((vm for vm in self.vms if vm.config.uuid == uuid), None)
+        """Return a single VM with a given UUID, or None
+
+        Without a loaded inventory, vCenter's SearchIndex finds the VM directly
+        """
+        if self.inventory_loaded:
+            return self.vms_by_uuid.get(uuid)
+        debug(f"Searching for VM {uuid} with SearchIndex.FindByUuid")
+        return self.conn.content.searchIndex.FindByUuid(None, uuid, True, False)
@@ -0,0 +1,125 @@
+""" Plan VM migrations into waves that fit maintenance windows """
+from voithos.lib.vmware.reports import bytes_to_gb
+
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+
+def get_transfer_bytes(vm_report):
+    """Return (estimated bytes an export of a VM transfers, basis of the estimate)
+
+    Exports only carry allocated data. The guest's used space is the best estimate of it when
+    VMware tools reports partitions, else thin disks are assumed full, like thick ones.
+    """
+    capacity = sum(disk["capacity_gb"] for disk in vm_report["storage"]["disks"]) * GB
+    used = vm_report["storage"]["partitions"]["total_used_gb"] * GB
+    if used:
+        return int(min(used, capacity)), "used"
+    return int(capacity), "capacity"
+
+
+def get_makespan(volumes, streams, rate):
+    """Return the seconds needed to transfer volumes (bytes) over streams parallel streams of
+    rate bytes/second each, assigning the largest transfer to the least busy stream first
+    """
+    loads = [0] * max(streams, 1)
+    for volume in sorted(volumes, reverse=True):
+        loads[loads.index(min(loads))] += volume
+    return max(loads) / rate
+
+
+class MigrationPlanner:
+    """Pack VMs into migration waves that each fit in a maintenance window
+
+    throughput_mbs is the measured link throughput shared by all streams, streams the number of
+    VMs exported at once and stream_mbs an optional cap on any single export's speed
+    """
+
+    def __init__(self, throughput_mbs, streams=4, window_hours=8, stream_mbs=0):
+        """ Store the link and window constraints """
+        self.throughput = throughput_mbs * MB
+        self.streams = streams
+        self.window_seconds = window_hours * 3600
+        self.stream_cap = stream_mbs * MB
+        # Rate of each stream when every stream is busy
+        self.rate = self.get_stream_rate(streams)
+
+    def get_stream_rate(self, num_vms):
+        """Return the bytes/second of each stream while num_vms VMs are exported
+
+        The link is shared by the VMs exported at once, a wave of fewer VMs than streams leaves
+        each of them a larger share, up to the per stream cap
+        """
+        rate = self.throughput / max(min(self.streams, num_vms), 1)
+        if self.stream_cap:
+            rate = min(rate, self.stream_cap)
+        return rate
+
+    def get_vm_plan(self, vm_report):
+        """ Return the transfer estimate of one VM, its hours while every stream is busy """
+        volume, basis = get_transfer_bytes(vm_report)
+        return {
+            "name": vm_report["name"],
+            "uuid": vm_report["uuid"],
+            "vcenter": vm_report.get("vcenter"),
+            "transfer_bytes": volume,
+            "transfer_gb": bytes_to_gb(volume),
+            "basis": basis,
+            "hours": round(volume / self.rate / 3600, 2),
+        }
+
+    def wave_seconds(self, vm_plans):
+        """ Return the seconds a wave of vm_plans takes """
+        return get_makespan(
+            [vm["transfer_bytes"] for vm in vm_plans],
+            self.streams,
+            self.get_stream_rate(len(vm_plans)),
+        )
+
+    def plan(self, vm_reports):
+        """Return the migration plan of vm_reports
+
+        Waves are packed first-fit decreasing: each VM, largest first, joins the first wave that
+        still fits in the window with it. A VM too large for any window gets a wave of its own.
+        """
+        vm_plans = sorted(
+            (self.get_vm_plan(vm) for vm in vm_reports),
+            key=lambda vm: vm["transfer_bytes"],
+            reverse=True,
+        )
+        waves = []
+        for vm_plan in vm_plans:
+            for wave in waves:
+                if self.wave_seconds(wave + [vm_plan]) <= self.window_seconds:
+                    wave.append(vm_plan)
+                    break
+            else:
+                waves.append([vm_plan])
+        wave_plans = []
+        for index, wave in enumerate(waves, start=1):
+            seconds = self.wave_seconds(wave)
+            transfer = sum(vm["transfer_bytes"] for vm in wave)
+            rate = self.get_stream_rate(len(wave))
+            for vm_plan in wave:
+                vm_plan["hours"] = round(vm_plan["transfer_bytes"] / rate / 3600, 2)
+            wave_plans.append(
+                {
+                    "wave": index,
+                    "num_vms": len(wave),
+                    "transfer_gb": bytes_to_gb(transfer),
+                    "hours": round(seconds / 3600, 2),
+                    "stream_mbs": round(rate / MB, 2),
+                    "exceeds_window": seconds > self.window_seconds,
+                    "vms": wave,
+                }
+            )
+        return {
+            "num_vms": len(vm_plans),
+            "num_waves": len(wave_plans),
+            "transfer_gb": bytes_to_gb(sum(vm["transfer_bytes"] for vm in vm_plans)),
+            "hours": round(sum(wave["hours"] for wave in wave_plans), 2),
+            "stream_mbs": round(self.rate / MB, 2),
+            "window_hours": self.window_seconds / 3600,
+            "waves": wave_plans,
+        }
@@ -0,0 +1,220 @@
+""" Track and report transfer progress from the byte callbacks of the transfer layer """
+import json
+import sys
+from threading import Event, Lock
+from time import monotonic, time
+
+
+EWMA_ALPHA = 0.3  # weight of the newest sample in the smoothed transfer rate
+SAMPLE_INTERVAL = 1  # seconds between rate samples
+OUTPUT_FORMATS = ["human", "json"]
+_PRINT_LOCK = Lock()  # concurrent exports share stdout, keep their lines whole
+
+
+def bytes_to_gb(qty_bytes):
+    """ Return a GB value of bytes, rounded to 2 decimals """
+    return round(qty_bytes / (1024 * 1024 * 1024), 2)
+
+
+def bytes_to_mb(qty_bytes):
+    """ Return a MB value of bytes, rounded to 2 decimals """
+    return round(qty_bytes / (1024 * 1024), 2)
+
+
+def ewma(previous, sample):
+    """ Return the exponentially weighted moving average after adding sample """
+    if not previous:
+        return sample
+    return EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * previous
+
+
+class DiskProgress:
+    """ Progress of a single disk transfer """
+
+    def __init__(self, name, total=None):
+        """ total is the expected number of bytes, when known """
+        self.name = name
+        self.total = total
+        self.bytes = 0
+        self.rate = 0.0  # EWMA bytes/second
+        self.done = False
+        self.error = None
+        self.seconds = 0
+        # Bytes of the output file, and those that weren't zeros left as holes - when known
+        self.logical_bytes = None
+        self.physical_bytes = None
+        self._last_bytes = 0
+
+    def sample(self, elapsed):
+        """ Fold the bytes received since the last sample into the smoothed rate """
+        instant = (self.bytes - self._last_bytes) / elapsed
+        self._last_bytes = self.bytes
+        self.rate = ewma(self.rate, instant)
+
+    def to_dict(self):
+        """ Return the machine-readable state of this disk """
+        return {
+            "name": self.name,
+            "bytes": self.bytes,
+            "total": self.total,
+            "rate_bps": round(self.rate),
+            "done": self.done,
+            "logical_bytes": self.logical_bytes,
+            "physical_bytes": self.physical_bytes,
+            "error": str(self.error) if self.error is not None else None,
+        }
+
+
+class ProgressTracker:
+    """Aggregate per-disk byte callbacks into rates, ETAs and periodic reports
+
+    Reports are printed every interval seconds (0 disables them) as human-readable text or as
+    one JSON object per line. wait() returns the moment the last disk finishes.
+    """
+
+    def __init__(self, label, interval=15, output="human"):
+        """ label names the transfer in reports, usually the VM UUID """
+        self.label = label
+        self.interval = interval
+        self.output = output
+        self.disks = []
+        self.lock = Lock()
+        self.all_done = Event()
+        # Nothing to wait for until a disk is added - a lease can have no disks
+        self.all_done.set()
+        self.start = monotonic()
+        self.rate = 0.0
+        self._last_bytes = 0
+
+    def add_disk(self, name, total=None):
+        """ Register a disk and return its DiskProgress """
+        disk = DiskProgress(name, total)
+        with self.lock:
+            self.disks.append(disk)
+            self.all_done.clear()
+        return disk
+
+    def callback(self, disk):
+        """ Return a thread-safe byte callback for disk, for the transfer layer """
+
+        def _update(num_bytes):
+            with self.lock:
+                disk.bytes += num_bytes
+
+        return _update
+
+    def finish(self, disk, error=None, total=None, writer=None):
+        """Mark disk finished, setting its final total size when it was only known at the end
+
+        writer is the voithos.lib.vmware.sparse.SparseWriter the disk was written with
+        """
+        with self.lock:
+            disk.done = True
+            disk.error = error
+            disk.seconds = monotonic() - self.start
+            if total is not None:
+                disk.total = total
+            if writer is not None:
+                disk.logical_bytes = writer.logical_bytes
+                disk.physical_bytes = writer.physical_bytes
+            if all(dsk.done for dsk in self.disks):
+                self.all_done.set()
+
+    @property
+    def bytes(self):
+        """ Return the bytes transferred across every disk """
+        return sum(disk.bytes for disk in self.disks)
+
+    @property
+    def total(self):
+        """ Return the expected total bytes, or None while any disk's size is unknown """
+        if any(disk.total is None for disk in self.disks):
+            return None
+        return sum(disk.total for disk in self.disks)
+
+    @property
+    def eta_seconds(self):
+        """ Return the estimated seconds remaining at the current rate, or None if unknown """
+        total = self.total
+        if total is None or not self.rate:
+            return None
+        return max(0, int((total - self.bytes) / self.rate))
+
+    def sample(self, elapsed):
+        """ Update the per-disk and aggregate smoothed rates """
+        with self.lock:
+            for disk in self.disks:
+                if not disk.done:
+                    disk.sample(elapsed)
+                else:
+                    disk.rate = 0.0
+            instant = (self.bytes - self._last_bytes) / elapsed
+            self._last_bytes = self.bytes
+            self.rate = ewma(self.rate, instant)
+
+    def wait(self):
+        """ Sample and report until every disk has finished """
+        last_sample = last_report = monotonic()
+        while not self.all_done.wait(SAMPLE_INTERVAL):
+            now = monotonic()
+            self.sample(now - last_sample)
+            last_sample = now
+            if self.interval and now - last_report >= self.interval:
+                self.report()
+                last_report = now
+        if self.interval:
+            self.report(event="done")
+
+    def to_dict(self, event="progress"):
+        """ Return the machine-readable state of the whole transfer """
+        return {
+            "event": event,
+            "label": self.label,
+            "timestamp": int(time()),
+            "elapsed_seconds": int(monotonic() - self.start),
+            "bytes": self.bytes,
+            "total": self.total,
+            "rate_bps": round(self.rate),
+            "eta_seconds": self.eta_seconds,
+            "disks": [disk.to_dict() for disk in self.disks],
+        }
+
+    def report(self, event="progress"):
+        """ Print the current progress in the configured output format """
+        if self.output == "json":
+            lines = [json.dumps(self.to_dict(event))]
+        else:
+            lines = self._human_lines(event)
+        with _PRINT_LOCK:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+
+    def _human_lines(self, event):
+        """ Return the human readable report lines """
+        elapsed = max(monotonic() - self.start, 1)
+        remaining = len([disk for disk in self.disks if not disk.done])
+        lines = ["", f"{self.label}: {remaining}/{len(self.disks)} disks remaining"]
+        for disk in self.disks:
+            total = f" / {bytes_to_gb(disk.total)} GB" if disk.total is not None else ""
+            if disk.done:
+                avg = bytes_to_mb(disk.bytes / max(disk.seconds, 1))
+                status = f"[AVG SPEED: {avg} MB/s] (DONE)" if disk.error is None else "(FAILED)"
+                if disk.error is None and disk.physical_bytes is not None:
+                    physical = bytes_to_gb(disk.physical_bytes)
+                    status += f" - wrote {physical} of {bytes_to_gb(disk.logical_bytes)} GB"
+            else:
+                status = f"[CUR SPEED: {bytes_to_mb(disk.rate)} MB/s]"
+            lines.append(f"  {disk.name} - {bytes_to_gb(disk.bytes)} GB{total}\t{status}")
+        total = self.total
+        summary = f"\\- Total Downloaded: \t{bytes_to_gb(self.bytes)} GB"
+        if total:
+            summary += f" / {bytes_to_gb(total)} GB - {int(self.bytes / total * 100)}%"
+        lines.append(summary)
+        if event == "done":
+            lines.append(f"\\- Avg Speed: \t{bytes_to_mb(self.bytes / elapsed)} MB/s")
+        else:
+            lines.append(f"\\- Cur Speed: \t{bytes_to_mb(self.rate)} MB/s")
+            eta = self.eta_seconds
+            if eta is not None:
+                lines.append(f"\\- ETA: \t\t{eta // 3600}h {eta % 3600 // 60}m {eta % 60}s")
+        return lines
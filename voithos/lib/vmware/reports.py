@@ -1,6 +1,27 @@
 """ Generate reports from VMWare VM data """
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+from threading import Event
+
 from pyVmomi import vim
 
+from voithos.lib.vmware.common import debug, iter_properties, retrieve_properties
+from voithos.lib.vmware.mgr import VMWareMgr
+
+
+# Every VM property the reports are built from
+REPORT_PROPERTIES = [
+    "name",
+    "summary.config",
+    "summary.quickStats.uptimeSeconds",
+    "summary.overallStatus",
+    "config.createDate",
+    "config.hardware.device",
+    "guest.disk",
+    "runtime.powerState",
+]
+ESTATE_QUEUE_SIZE = 1000  # reports built ahead of the output, across every vCenter
+
 
 def bytes_to_gb(bytes_val):
     """ Convert bytes to GB, rounded to 2 decimal places """
@@ -9,29 +30,44 @@ def bytes_to_gb(bytes_val):
     return round(gbytes, 2)
 
 
-def get_disk_data(vm):
-    """ Return a list of dictionaries showing useful disk-related data """
+def get_device_data(devices):
+    """ Return (disk data, network data) lists from a single pass over a VM's devices """
     disk_data = []
-    for dev in vm.config.hardware.device:
-        if not isinstance(dev, vim.vm.device.VirtualDisk):
-            continue
-        shared = dev.backing.sharing != "sharingNone"
-        thin = dev.backing.thinProvisioned if hasattr(dev.backing, "thinProvisioned") else "NoData"
-        disk_data.append(
-            {
-                "label": dev.deviceInfo.label,
-                "uuid": dev.backing.uuid,
-                "thin_provisioned": thin,
-                "shared": shared,
-                "capacity_gb": bytes_to_gb(dev.capacityInBytes),
-            }
-        )
-    return disk_data
+    net_data = []
+    for dev in devices:
+        if isinstance(dev, vim.vm.device.VirtualDisk):
+            shared = dev.backing.sharing != "sharingNone"
+            thin = (
+                dev.backing.thinProvisioned if hasattr(dev.backing, "thinProvisioned") else "NoData"
+            )
+            disk_data.append(
+                {
+                    "label": dev.deviceInfo.label,
+                    "uuid": dev.backing.uuid,
+                    "thin_provisioned": thin,
+                    "shared": shared,
+                    "capacity_gb": bytes_to_gb(dev.capacityInBytes),
+                }
+            )
+        elif hasattr(dev, "macAddress"):
+            pci_slot_num = dev.slotInfo.pciSlotNumber if dev.slotInfo is not None else ""
+            vswitch_name = " - (probably distributed)"
+            if hasattr(dev, "backing") and hasattr(dev.backing, "deviceName"):
+                vswitch_name = dev.backing.deviceName
+            net_data.append(
+                {
+                    "label": dev.deviceInfo.label,
+                    "nic_type": type(dev).__name__,
+                    "vswitch_name": vswitch_name,
+                    "connected": dev.connectable.connected,
+                    "pci_slot_num": pci_slot_num,
+                }
+            )
+    return disk_data, net_data
 
 
-def get_partition_data(vm):
-    """ Return a dictionary of this VMs available useful partition data """
-    partitions = vm.guest.disk
+def get_partition_data(partitions):
+    """ Return a dictionary of useful data about a VM's guest partitions """
     total_used_gb = 0
     # Partition info is only available when the VM is on & has vmware tools
     part_data = []
@@ -53,50 +89,139 @@ def get_partition_data(vm):
     return {"total_used_gb": total_used_gb, "paritions": part_data}
 
 
-def get_network_data(vm):
-    """ return a list of dictionaries showing useful network data """
-    net_data = []
-    for dev in vm.config.hardware.device:
-        if not hasattr(dev, "macAddress"):
-            continue
-        pci_slot_num = dev.slotInfo.pciSlotNumber if dev.slotInfo is not None else ""
-        vswitch_name = " - (probably distributed)"
-        if hasattr(dev, "backing") and hasattr(dev.backing, "deviceName"):
-            vswitch_name = dev.backing.deviceName
-        net_data.append(
-            {
-                "label": dev.deviceInfo.label,
-                "nic_type": type(dev).__name__,
-                "vswitch_name": vswitch_name,
-                "connected": dev.connectable.connected,
-                "pci_slot_num": pci_slot_num,
-            }
-        )
-    return net_data
-
-
-def get_vm_data(vm):
-    """ Return a dictionary of useful data about an entire VM """
+def build_vm_data(props):
+    """ Return a dictionary of useful data about an entire VM from its REPORT_PROPERTIES """
+    config = props["summary.config"]
+    disks, networks = get_device_data(props.get("config.hardware.device", []))
     return {
-        "name": vm.name,
-        "uuid": vm.summary.config.uuid,
-        "create_date": str(vm.config.createDate),
-        "guest_os": vm.summary.config.guestFullName,
-        "uptime_seconds": vm.summary.quickStats.uptimeSeconds,
-        "power_state": vm.runtime.powerState,
-        "status": vm.summary.overallStatus,
-        "num_cpu": vm.summary.config.numCpu,
+        "name": props.get("name"),
+        "uuid": config.uuid,
+        "create_date": str(props.get("config.createDate")),
+        "guest_os": config.guestFullName,
+        "uptime_seconds": props.get("summary.quickStats.uptimeSeconds"),
+        "power_state": props.get("runtime.powerState"),
+        "status": props.get("summary.overallStatus"),
+        "num_cpu": config.numCpu,
         "ram": {
-            "total_mb": vm.summary.config.memorySizeMB,
-            "used_mb": vm.summary.config.memorySizeMB,
+            "total_mb": config.memorySizeMB,
+            "used_mb": config.memorySizeMB,
         },
         "storage": {
-            "num_disks": vm.summary.config.numVirtualDisks,
-            "partitions": get_partition_data(vm),
-            "disks": get_disk_data(vm),
+            "num_disks": config.numVirtualDisks,
+            "partitions": get_partition_data(props.get("guest.disk", [])),
+            "disks": disks,
         },
         "network": {
-            "num_interfaces": vm.summary.config.numEthernetCards,
-            "networks": get_network_data(vm),
+            "num_interfaces": config.numEthernetCards,
+            "networks": networks,
         },
     }
+
+
+def get_vms_data(conn, vms, missing=None):
+    """Return a list of dictionaries of useful data about each of vms, in the same order
+
+    Every property the reports use is read for all of the VMs at once by the PropertyCollector,
+    rather than attribute by attribute. VMs deleted since vms was listed are left out, and
+    appended to the missing list when given.
+    """
+    vm_props = retrieve_properties(
+        conn, vim.VirtualMachine, REPORT_PROPERTIES, objs=vms, missing=missing
+    )
+    return [build_vm_data(vm_props[vm]) for vm in vms if vm in vm_props]
+
+
+def iter_vms_data(conn, vms, missing=None):
+    """Yield the report of each of vms as soon as its page of properties arrives
+
+    Unlike get_vms_data, reports come in the order vCenter returns them
+    """
+    for _, props in iter_properties(
+        conn, vim.VirtualMachine, REPORT_PROPERTIES, objs=vms, missing=missing
+    ):
+        yield build_vm_data(props)
+
+
+def iter_vcenter_data(names, ip_addr, username=None, password=None):
+    """ Yield the report of every VM matching names on one vCenter, tagged with its address """
+    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
+    count = 0
+    missing = []
+    for vm_report in iter_vms_data(mgr.conn, mgr.find_vms_by_name(names), missing=missing):
+        vm_report["vcenter"] = ip_addr
+        count += 1
+        yield vm_report
+    debug(f"Read {count} VM reports from {ip_addr}")
+    if missing:
+        # The cached inventory listed VMs that have since been deleted
+        mgr.forget_vms(missing)
+
+
+def get_vcenter_data(names, ip_addr, username=None, password=None):
+    """ Return the list of reports from iter_vcenter_data """
+    return list(iter_vcenter_data(names, ip_addr, username=username, password=password))
+
+
+def get_estate_data(names, ip_addrs, username=None, password=None):
+    """Return (reports, {ip_addr: error}) for every VM matching names across all of ip_addrs
+
+    Each vCenter is queried in its own thread, so the estate takes as long as the slowest one.
+    Reports are ordered by vCenter, in the order of ip_addrs.
+    """
+    vm_reports = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(len(ip_addrs), 1)) as pool:
+        futures = {
+            ip_addr: pool.submit(get_vcenter_data, names, ip_addr, username, password)
+            for ip_addr in ip_addrs
+        }
+        for ip_addr, future in futures.items():
+            try:
+                vm_reports.extend(future.result())
+            except (Exception, SystemExit) as exc:  # pylint: disable=broad-except
+                errors[ip_addr] = exc
+    return vm_reports, errors
+
+
+def iter_estate_data(names, ip_addrs, errors, username=None, password=None):
+    """Yield the report of every VM matching names across all of ip_addrs as soon as it is built
+
+    vCenters are queried concurrently like get_estate_data, and their reports are interleaved.
+    At most ESTATE_QUEUE_SIZE reports wait for the consumer, so memory stays flat.
+    Failures are stored in errors, a dict of {ip_addr: error}.
+    """
+    reports_queue = Queue(maxsize=ESTATE_QUEUE_SIZE)
+    stopped = Event()
+
+    def _put(item):
+        """ Queue item unless the consumer went away """
+        while not stopped.is_set():
+            try:
+                reports_queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _produce(ip_addr):
+        """ Queue every report of one vCenter, then None """
+        try:
+            for vm_report in iter_vcenter_data(names, ip_addr, username, password):
+                _put(vm_report)
+        except (Exception, SystemExit) as exc:  # pylint: disable=broad-except
+            errors[ip_addr] = exc
+        finally:
+            _put(None)
+
+    with ThreadPoolExecutor(max_workers=max(len(ip_addrs), 1)) as pool:
+        try:
+            for ip_addr in ip_addrs:
+                pool.submit(_produce, ip_addr)
+            remaining = len(ip_addrs)
+            while remaining:
+                vm_report = reports_queue.get()
+                if vm_report is None:
+                    remaining -= 1
+                    continue
+                yield vm_report
+        finally:
+            stopped.set()
@@ -0,0 +1,184 @@
+""" Export many VMware VMs concurrently within global lease, host and bandwidth limits """
+import os
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep, time
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.common import debug, retrieve_properties
+from voithos.lib.vmware.exporter import VMWareExporter, bytes_to_gb
+
+
+BURST_SECONDS = 1  # how far a transfer may run ahead of the bandwidth budget
+# VM properties the scheduler reads, in one PropertyCollector call for the whole batch
+SCHEDULE_PROPERTIES = ["name", "config.uuid", "config.hardware.device", "runtime.host"]
+
+
+class BandwidthLimiter:
+    """ Share a bytes-per-second budget between every transfer that calls consume() """
+
+    def __init__(self, bytes_per_second):
+        """ Create a limiter allowing bytes_per_second in total """
+        self.rate = bytes_per_second
+        self.lock = Lock()
+        self.next_free = monotonic()
+
+    def consume(self, num_bytes):
+        """ Account for num_bytes, sleeping when the transfers are ahead of the budget """
+        with self.lock:
+            now = monotonic()
+            self.next_free = max(self.next_free, now - BURST_SECONDS) + num_bytes / self.rate
+            delay = self.next_free - now
+        if delay > 0:
+            sleep(delay)
+
+
+def get_vm_disks(props):
+    """ Return the VirtualDisks in a VM's SCHEDULE_PROPERTIES """
+    devices = props.get("config.hardware.device") or []
+    return [dev for dev in devices if isinstance(dev, vim.vm.device.VirtualDisk)]
+
+
+def get_vm_size(props):
+    """ Return the total capacity in bytes of a VM's disks, from its SCHEDULE_PROPERTIES """
+    return sum(dev.capacityInBytes for dev in get_vm_disks(props))
+
+
+def get_host_names(conn, vm_props):
+    """ Return {host: name} of the ESXi hosts of vm_props, read in one call """
+    hosts = list({props.get("runtime.host") for props in vm_props.values()} - {None})
+    host_props = retrieve_properties(conn, vim.HostSystem, ["name"], objs=hosts) if hosts else {}
+    return {host: props.get("name", "unknown") for host, props in host_props.items()}
+
+
+class ExportScheduler:
+    """Export a batch of VMs, largest first, never exceeding:
+
+    - max_leases VMs (NFC leases) at once
+    - host_connections HTTP connections to any single ESXi host
+    - bandwidth_mbs MB/s across all transfers, when non-zero
+
+    A VM whose disks times connections exceed host_connections exports with fewer connections
+    per disk. Every disk needs at least one, so a VM with more disks than host_connections
+    still opens one per disk, and runs alone on its host.
+    """
+
+    def __init__(
+        self,
+        vmware_mgr,
+        vms,
+        base_dir,
+        max_leases=4,
+        host_connections=8,
+        connections=1,
+        bandwidth_mbs=0,
+        interval=0,
+        progress_format="human",
+    ):
+        """Queue a job for every VM - each VM downloads into base_dir/<uuid>
+
+        Each VM reports its own progress every interval seconds, 0 disables it
+        """
+        self.vmware_mgr = vmware_mgr
+        self.base_dir = base_dir
+        self.max_leases = max_leases
+        self.host_connections = host_connections
+        self.connections = connections
+        self.interval = interval
+        self.progress_format = progress_format
+        self.limiter = BandwidthLimiter(bandwidth_mbs * 1024 * 1024) if bandwidth_mbs else None
+        self.cond = Condition()
+        self.host_usage = {}
+        self.jobs = []
+        vms = list(vms)
+        conn = vmware_mgr.conn
+        vm_props = retrieve_properties(conn, vim.VirtualMachine, SCHEDULE_PROPERTIES, objs=vms)
+        host_names = get_host_names(conn, vm_props)
+        for vm in vms:
+            props = vm_props.get(vm, {})
+            num_disks = max(len(get_vm_disks(props)), 1)
+            # A VM uses connections per disk, fewer when that would overrun its host
+            vm_connections = max(1, min(connections, host_connections // num_disks))
+            self.jobs.append(
+                {
+                    "vm": vm,
+                    "uuid": props.get("config.uuid"),
+                    "name": props.get("name"),
+                    "host": host_names.get(props.get("runtime.host"), "unknown"),
+                    "size": get_vm_size(props),
+                    "connections": vm_connections,
+                    # capped so a VM with more disks than host_connections can still start
+                    "slots": min(num_disks * vm_connections, host_connections),
+                    "status": "pending",
+                    "error": None,
+                    "seconds": 0,
+                }
+            )
+        # Longest-processing-time first keeps the makespan short
+        self.pending = sorted(self.jobs, key=lambda job: job["size"], reverse=True)
+
+    def _next_job(self):
+        """ Block until a job can start on a host with free connections, return it or None """
+        with self.cond:
+            while self.pending:
+                for job in self.pending:
+                    used = self.host_usage.get(job["host"], 0)
+                    if used + job["slots"] <= self.host_connections:
+                        self.pending.remove(job)
+                        self.host_usage[job["host"]] = used + job["slots"]
+                        return job
+                self.cond.wait()
+            return None
+
+    def _finish_job(self, job):
+        """ Give the job's connections back to its host """
+        with self.cond:
+            self.host_usage[job["host"]] -= job["slots"]
+            self.cond.notify_all()
+
+    def _worker(self):
+        """ Export jobs until none are left """
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            start = time()
+            job["status"] = "running"
+            print(f"Starting export of {job['name']} ({job['uuid']}) from {job['host']}")
+            try:
+                self._export(job)
+                job["status"] = "done"
+            except (Exception, SystemExit) as exc:  # pylint: disable=broad-except
+                job["status"] = "failed"
+                job["error"] = exc
+                debug(f"Export of {job['uuid']} failed: {exc}")
+            finally:
+                job["seconds"] = int(time() - start)
+                self._finish_job(job)
+            print(f"Finished export of {job['name']} ({job['uuid']}): {job['status']}")
+
+    def _export(self, job):
+        """ Run one VM's export """
+        vm_dir = os.path.join(self.base_dir, job["uuid"])
+        os.makedirs(vm_dir, exist_ok=True)
+        exporter = VMWareExporter(
+            self.vmware_mgr,
+            job["vm"],
+            base_dir=vm_dir,
+            interval=self.interval,
+            connections=job["connections"],
+            limiter=self.limiter,
+            progress_format=self.progress_format,
+        )
+        exporter.download()
+
+    def run(self):
+        """ Export every job, return the list of jobs with their final status """
+        gb_total = bytes_to_gb(sum(job["size"] for job in self.jobs))
+        print(f"Exporting {len(self.jobs)} VMs, {gb_total} GB, {self.max_leases} at a time")
+        workers = [Thread(target=self._worker) for _ in range(min(self.max_leases, len(self.jobs)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.jobs
@@ -0,0 +1,69 @@
+""" Persist vCenter sessions between voithos commands """
+import json
+import os
+import ssl
+from threading import Lock
+
+from voithos.lib.system import get_absolute_path
+from voithos.lib.vmware.common import debug
+
+
+SESSION_CACHE_PATH = "~/.cache/voithos/vmware-sessions.json"
+# Ways to negotiate TLS with vCenter, most secure first - see get_ssl_context
+SSL_STRATEGIES = ["verify", "tlsv1", "noverify"]
+_CACHE_LOCK = Lock()  # threads of one command share the cache file
+
+
+def is_session_cache_enabled():
+    """ Return False when VMWARE_SESSION_CACHE = 'false' """
+    return os.environ.get("VMWARE_SESSION_CACHE", "true") != "false"
+
+
+def get_ssl_context(strategy):
+    """Return the SSL context for SmartConnect of an SSL_STRATEGIES strategy:
+    verify: regular SSL, tlsv1: TLSv1 with verify off, noverify: any protocol with verify off
+    """
+    if strategy == "tlsv1":
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+    if strategy == "noverify":
+        return ssl._create_unverified_context()  # pylint: disable=protected-access
+    return None
+
+
+class SessionCache:
+    """Session cookies and the SSL strategy that worked, per vCenter user and host
+
+    The file holds live session cookies, so it is only ever readable by its owner
+    """
+
+    def __init__(self, path=SESSION_CACHE_PATH):
+        """ Use the cache file at path, created on the first set() """
+        self.path = get_absolute_path(path)
+
+    def _load(self):
+        """ Return the whole cache """
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """ Return the cached values of key, ex: {"cookie": ..., "ssl": "verify"} """
+        with _CACHE_LOCK:
+            return self._load().get(key, {})
+
+    def set(self, key, **values):
+        """ Update the cached values of key """
+        with _CACHE_LOCK:
+            cache = self._load()
+            cache.setdefault(key, {}).update(values)
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(tmp_path, self.path)
+        debug(f"Cached VMware session values for {key}: {sorted(values)}")
@@ -0,0 +1,77 @@
+""" Write exported disks sparsely, leaving holes where the data is all zeros """
+import os
+from threading import Lock
+
+
+SPARSE_BLOCK_SIZE = 1024 * 64  # 64 KB - zero runs shorter than this are written out
+_ZEROS = bytes(SPARSE_BLOCK_SIZE)
+
+
+class SparseWriter:
+    """pwrite data to file descriptors, skipping all-zero blocks where the file has a hole
+
+    Counts the logical bytes written and the physical bytes that actually reached the file.
+    One writer can be shared by every thread writing the same disk.
+    """
+
+    def __init__(self, block_size=SPARSE_BLOCK_SIZE):
+        """ Skip zero runs of at least block_size bytes """
+        self.block_size = block_size
+        self.zeros = _ZEROS if block_size == SPARSE_BLOCK_SIZE else bytes(block_size)
+        self.logical_bytes = 0
+        self.physical_bytes = 0
+        self.lock = Lock()
+
+    def pwrite(self, fd, data, offset, holes=True):
+        """Write data at offset of fd, return len(data)
+
+        holes=True means the file is known to read back zeros at these offsets (a new or
+        truncated file, or a freshly created volume), so zero blocks are seeked over
+        """
+        view = memoryview(data)
+        length = len(view)
+        if not holes:
+            os.pwrite(fd, view, offset)
+            self.count(length, length)
+            return length
+        physical = 0
+        run_start = None  # start of the current run of non-zero blocks
+        for start in range(0, length, self.block_size):
+            block = view[start : start + self.block_size]
+            if block == self.zeros[: len(block)]:
+                if run_start is not None:
+                    physical += os.pwrite(fd, view[run_start:start], offset + run_start)
+                    run_start = None
+            elif run_start is None:
+                run_start = start
+        if run_start is not None:
+            physical += os.pwrite(fd, view[run_start:], offset + run_start)
+        self.count(length, physical)
+        return length
+
+    def count(self, logical, physical):
+        """ Add to the byte counters, for bytes written by other means than pwrite """
+        with self.lock:
+            self.logical_bytes += logical
+            self.physical_bytes += physical
+
+    @property
+    def saved_bytes(self):
+        """ Return how many zero bytes were never written """
+        return self.logical_bytes - self.physical_bytes
+
+    def dense(self):
+        """ Return a writer sharing these counters that never skips zeros, for files with data """
+        return _DenseWriter(self)
+
+
+class _DenseWriter:
+    """ A SparseWriter that always writes every byte """
+
+    def __init__(self, writer):
+        """ Count into writer """
+        self.writer = writer
+
+    def pwrite(self, fd, data, offset):
+        """ Write all of data at offset of fd """
+        return self.writer.pwrite(fd, data, offset, holes=False)
@@ -0,0 +1,259 @@
+""" Destinations that exported disk data can be streamed into without a staging file """
+import os
+import time
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Thread
+
+from voithos.lib.openstack import get_keystone_session
+from voithos.lib.system import error, run
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.sparse import SparseWriter
+
+
+ZERO_FILL_SIZE = 1024 * 1024 * 8  # 8 MB
+UPLOAD_QUEUE_SIZE = 256  # chunks buffered between the VMDK decoder and the upload request
+UPLOAD_POLL_SECONDS = 1  # how often a blocked writer checks the upload is still alive
+VOLUME_POLL_SECONDS = 10
+VOLUME_TIMEOUT = 3600  # seconds to wait for Cinder to fill a volume from its image
+GB = 1024 * 1024 * 1024
+
+
+class RawTarget:
+    """Write raw disk data to a file or block device at given offsets
+
+    Regular files are left sparse wherever nothing was written, or where the data is all
+    zeros. A block device may hold old data, so unless zeroed=True the gaps between written
+    ranges are explicitly zero-filled and zero blocks are written out.
+    writer is the voithos.lib.vmware.sparse.SparseWriter to write through, else a new one.
+    """
+
+    def __init__(self, path, capacity, zeroed=False, writer=None):
+        """ Open path for writing, sizing regular files to capacity """
+        self.path = path
+        self.capacity = capacity
+        self.writer = writer if writer is not None else SparseWriter()
+        self.is_block_device = Path(path).is_block_device()
+        self.zeroed = zeroed or not self.is_block_device
+        self.position = 0  # end of the highest byte written so far
+        flags = os.O_WRONLY if self.is_block_device else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        debug(f"Opened raw target {path} - capacity {capacity}, block={self.is_block_device}")
+
+    def write_at(self, offset, data):
+        """ Write data at byte offset """
+        if offset > self.position and not self.zeroed:
+            self._zero_fill(self.position, offset)
+        self.writer.pwrite(self.fd, data, offset, holes=self.zeroed)
+        self.position = max(self.position, offset + len(data))
+
+    def _zero_fill(self, start, end):
+        """ Write zeros to bytes start up to (not including) end """
+        zeros = bytes(ZERO_FILL_SIZE)
+        for offset in range(start, end, ZERO_FILL_SIZE):
+            length = min(ZERO_FILL_SIZE, end - offset)
+            self.writer.pwrite(self.fd, zeros[:length], offset, holes=False)
+
+    def close(self):
+        """ Finish the disk: zero the tail of block devices or size a file to capacity """
+        try:
+            if self.is_block_device:
+                if not self.zeroed and self.position < self.capacity:
+                    self._zero_fill(self.position, self.capacity)
+            else:
+                os.ftruncate(self.fd, self.capacity)
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+    def abort(self):
+        """ Stop writing after a failed download, leaving the disk as it is """
+        os.close(self.fd)
+
+
+class RbdTarget(RawTarget):
+    """ Write raw disk data into a new Ceph RBD image, mapped locally with the rbd client """
+
+    def __init__(self, image, capacity, writer=None):
+        """ Create and map image, given as pool/name """
+        self.image = image
+        run(f"rbd create --size {capacity}B {image}")
+        device = run(f"rbd map {image}")[0].strip()
+        if not device:
+            error(f"ERROR: Failed to map RBD image {image}", exit=True)
+        # A freshly created RBD image reads back as zeros, so gaps never need filling
+        super().__init__(device, capacity, zeroed=True, writer=writer)
+
+    def close(self):
+        """ Flush and unmap the RBD image """
+        try:
+            super().close()
+        finally:
+            run(f"rbd unmap {self.path}")
+
+    def abort(self):
+        """ Unmap the RBD image after a failed download """
+        try:
+            super().abort()
+        finally:
+            run(f"rbd unmap {self.path}")
+
+
+class _UploadAborted(Exception):
+    """ Raised inside the upload body to cancel the request """
+
+
+class GlanceTarget:
+    """Upload raw disk data into a new Glance image while it is written - nothing touches local disk
+
+    Glance takes image data as one sequential chunked HTTP request, so writes must arrive in
+    increasing offset order, as the grains of a streamOptimized VMDK do. Gaps between writes and
+    the tail of the disk are sent as zeros. volume=True then creates a Cinder volume of the same
+    name from the image. Both use the keystoneauth1 session of the sourced OpenStack RC file.
+    """
+
+    def __init__(self, name, capacity, volume=False, writer=None):
+        """ Create the image, queued, and start its upload request """
+        self.name = name
+        self.capacity = capacity
+        self.volume = volume
+        self.writer = writer if writer is not None else SparseWriter()
+        self.position = 0
+        self.upload_error = None
+        self.session = get_keystone_session()
+        resp = self.session.post(
+            "/v2/images",
+            endpoint_filter={"service_type": "image"},
+            json={"name": name, "disk_format": "raw", "container_format": "bare"},
+        )
+        self.image_id = resp.json()["id"]
+        debug(f"Created Glance image {name} ({self.image_id}) - capacity {capacity}")
+        self.queue = Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        self.thread = Thread(target=self._upload, daemon=True)
+        self.thread.start()
+
+    def _iter_chunks(self):
+        """ Yield the queued chunks until the end of the disk, the request body """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if chunk is _UploadAborted:
+                raise _UploadAborted()
+            yield chunk
+
+    def _upload(self):
+        """ Send the image data, saving any error for the writing thread """
+        try:
+            self.session.put(
+                f"/v2/images/{self.image_id}/file",
+                endpoint_filter={"service_type": "image"},
+                headers={"Content-Type": "application/octet-stream"},
+                data=self._iter_chunks(),
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            self.upload_error = exc
+
+    def _put(self, chunk):
+        """ Queue chunk for upload, failing if the upload request has ended """
+        while True:
+            if not self.thread.is_alive():
+                raise IOError(f"Upload to Glance image {self.name} failed: {self.upload_error}")
+            try:
+                self.queue.put(chunk, timeout=UPLOAD_POLL_SECONDS)
+                return
+            except Full:
+                continue
+
+    def _send_zeros(self, end):
+        """ Send zeros from the current position up to end """
+        zeros = memoryview(bytes(ZERO_FILL_SIZE))
+        while self.position < end:
+            length = min(ZERO_FILL_SIZE, end - self.position)
+            self._put(zeros[:length])
+            self.writer.count(length, length)
+            self.position += length
+
+    def write_at(self, offset, data):
+        """ Send data, which must start at or after the end of the previous write """
+        if offset < self.position:
+            raise IOError(f"Glance target {self.name}: write at {offset} is before {self.position}")
+        self._send_zeros(offset)
+        self._put(bytes(data))
+        self.writer.count(len(data), len(data))
+        self.position += len(data)
+
+    def close(self):
+        """ Send the rest of the disk, wait for Glance to store it, then create the volume """
+        try:
+            self._send_zeros(self.capacity)
+            self._put(None)
+            self.thread.join()
+            if self.upload_error is not None:
+                raise IOError(f"Upload to Glance image {self.name} failed: {self.upload_error}")
+        except IOError:
+            self._delete_image()
+            raise
+        debug(f"Uploaded {self.position} bytes to Glance image {self.name}")
+        if self.volume:
+            self._create_volume()
+
+    def abort(self):
+        """ Cancel the upload after a failed download and delete the partial image """
+        try:
+            self.queue.put_nowait(_UploadAborted)
+        except Full:
+            # The upload is blocked sending - drain it so it reaches the abort marker
+            while self.thread.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    self.queue.put(_UploadAborted)
+                    break
+        self.thread.join()
+        self._delete_image()
+
+    def _delete_image(self):
+        """ Delete the image, which holds incomplete data """
+        try:
+            self.session.delete(
+                f"/v2/images/{self.image_id}", endpoint_filter={"service_type": "image"}
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            error(f"ERROR: Failed to delete incomplete Glance image {self.image_id}: {exc}")
+
+    def _create_volume(self):
+        """ Create a Cinder volume from the image and wait until it is available """
+        size_gb = -(-self.capacity // GB)
+        endpoint_filter = {"service_type": "volumev3"}
+        resp = self.session.post(
+            "/volumes",
+            endpoint_filter=endpoint_filter,
+            json={"volume": {"name": self.name, "size": size_gb, "imageRef": self.image_id}},
+        )
+        volume_id = resp.json()["volume"]["id"]
+        debug(f"Creating Cinder volume {self.name} ({volume_id}) from image {self.image_id}")
+        deadline = time.monotonic() + VOLUME_TIMEOUT
+        while True:
+            resp = self.session.get(f"/volumes/{volume_id}", endpoint_filter=endpoint_filter)
+            status = resp.json()["volume"]["status"]
+            if status == "available":
+                return volume_id
+            if status == "error" or time.monotonic() > deadline:
+                error(f"ERROR: Cinder volume {self.name} ({volume_id}) is {status}", exit=True)
+            time.sleep(VOLUME_POLL_SECONDS)
+
+
+def open_target(spec, capacity, writer=None):
+    """Return an open target for spec, writing through writer when given
+
+    spec is rbd:<pool>/<image>, glance:<image name>, cinder:<volume name> or the path of a raw
+    file or block device. cinder: targets are uploaded to a Glance image of the same name first.
+    """
+    if spec.startswith("rbd:"):
+        return RbdTarget(spec[len("rbd:") :], capacity, writer=writer)
+    if spec.startswith("glance:"):
+        return GlanceTarget(spec[len("glance:") :], capacity, writer=writer)
+    if spec.startswith("cinder:"):
+        return GlanceTarget(spec[len("cinder:") :], capacity, volume=True, writer=writer)
+    return RawTarget(spec, capacity, writer=writer)
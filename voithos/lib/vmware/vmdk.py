@@ -0,0 +1,130 @@
+""" Parse VMDK files natively - sparse extent headers and the streamOptimized grain stream """
+import struct
+import zlib
+
+
+SECTOR_SIZE = 512
+VMDK_MAGIC = 0x564D444B  # "KDMV"
+# magic, version, flags, capacity, grainSize, descriptorOffset, descriptorSize, numGTEsPerGT,
+# rgdOffset, gdOffset, overHead, uncleanShutdown, newline detection chars, compressAlgorithm
+HEADER_FORMAT = "<IIIQQQQIQQQB4sH"
+MARKER_FORMAT = "<QI"
+MAX_DESCRIPTOR_SIZE = 1024 * 1024
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+
+class VMDKFormatError(Exception):
+    """ The data is not a VMDK this parser understands """
+
+
+def parse_header(data):
+    """ Return a dict of the sparse extent header fields at the start of data """
+    if len(data) < struct.calcsize(HEADER_FORMAT):
+        raise VMDKFormatError("ERROR: Too little data for a VMDK sparse extent header")
+    fields = struct.unpack_from(HEADER_FORMAT, data)
+    if fields[0] != VMDK_MAGIC:
+        raise VMDKFormatError("ERROR: Not a sparse VMDK - bad magic number")
+    return {
+        "version": fields[1],
+        "flags": fields[2],
+        "capacity_bytes": fields[3] * SECTOR_SIZE,
+        "grain_size_bytes": fields[4] * SECTOR_SIZE,
+        "descriptor_offset": fields[5] * SECTOR_SIZE,
+        "descriptor_size": fields[6] * SECTOR_SIZE,
+        "overhead_bytes": fields[10] * SECTOR_SIZE,
+        "compress_algorithm": fields[13],
+    }
+
+
+def parse_descriptor_capacity(text):
+    """ Return the capacity in bytes of the extents listed by a VMDK text descriptor """
+    sectors = 0
+    for line in text.splitlines():
+        # Extent lines look like: RW 41943040 VMFS "disk-flat.vmdk"
+        fields = line.split()
+        if len(fields) >= 3 and fields[0] in ("RW", "RDONLY", "NOACCESS"):
+            sectors += int(fields[1])
+    if not sectors:
+        raise VMDKFormatError("ERROR: No extents found in the VMDK descriptor")
+    return sectors * SECTOR_SIZE
+
+
+def read_capacity(file_path):
+    """Return the virtual size in bytes of the VMDK at file_path
+
+    Both sparse extents (read from their header) and text descriptors are understood
+    """
+    with open(file_path, "rb") as vmdk_file:
+        data = vmdk_file.read(SECTOR_SIZE)
+        if len(data) >= 4 and struct.unpack_from("<I", data)[0] == VMDK_MAGIC:
+            return parse_header(data)["capacity_bytes"]
+        if not data.startswith(b"# Disk DescriptorFile"):
+            raise VMDKFormatError(f"ERROR: {file_path} is not a VMDK")
+        # Standalone descriptors are small text files
+        data += vmdk_file.read(MAX_DESCRIPTOR_SIZE)
+    return parse_descriptor_capacity(data.decode("utf-8", errors="replace"))
+
+
+class StreamOptimizedReader:
+    """Decode a streamOptimized VMDK from a forward-only stream, such as an NFC download
+
+    The header is read on construction so the disk's capacity is known before any data.
+    callback(num_bytes) is called with the number of compressed bytes consumed.
+    """
+
+    def __init__(self, stream, callback=None):
+        """ Read the header and skip ahead to the first grain """
+        self.stream = stream
+        self.callback = callback
+        self.position = 0
+        self.header = parse_header(self._read(SECTOR_SIZE))
+        if not self.header["compress_algorithm"]:
+            raise VMDKFormatError("ERROR: VMDK is not streamOptimized (not compressed)")
+        self.capacity = self.header["capacity_bytes"]
+        self.grain_size = self.header["grain_size_bytes"]
+        self._skip(self.header["overhead_bytes"] - self.position)
+
+    def _read(self, length):
+        """ Read exactly length bytes from the stream """
+        chunks = []
+        remaining = length
+        while remaining:
+            chunk = self.stream.read(remaining)
+            if not chunk:
+                raise VMDKFormatError(f"ERROR: VMDK stream ended early at byte {self.position}")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self.position += length
+        if self.callback is not None:
+            self.callback(length)
+        return b"".join(chunks)
+
+    def _skip(self, length):
+        """ Discard length bytes from the stream """
+        while length > 0:
+            step = min(length, self.grain_size)
+            self._read(step)
+            length -= step
+
+    def iter_grains(self):
+        """ Yield (byte offset, decompressed data) for every grain until the end-of-stream """
+        while True:
+            marker = self._read(SECTOR_SIZE)
+            value, size = struct.unpack_from(MARKER_FORMAT, marker)
+            if size:
+                # Grain marker: LBA then compressed data, padded to a sector boundary
+                payload_len = size - (SECTOR_SIZE - 12)
+                padded = -(-payload_len // SECTOR_SIZE) * SECTOR_SIZE if payload_len > 0 else 0
+                compressed = marker[12:] + self._read(padded)
+                data = zlib.decompress(compressed[:size])
+                offset = value * SECTOR_SIZE
+                yield offset, data[: max(0, min(len(data), self.capacity - offset))]
+                continue
+            marker_type = struct.unpack_from("<I", marker, 12)[0]
+            if marker_type == MARKER_EOS:
+                return
+            # Grain tables, the grain directory and the footer are not needed when streaming
+            self._skip(value * SECTOR_SIZE)